@@ -3,6 +3,16 @@ I{TwistedSSHClient} package:
 - L{SSHClient} is a high-level representation of a session with an SSH server
 based on usage and interface of C{paramiko.client.SSHClient}
 
+- L{SSHClientPool} keeps reusable authenticated connections keyed by host, port and user
+
+- L{ReconnectingConnection} keeps a connection and its tunnels open across reconnects
+
+- L{FleetConnector} connects to many hosts with bounded concurrency
+
+- L{LocalForwarder} forwards connections accepted on a local port through pooled connections, like C{ssh -L}
+
+- L{SOCKSForwarder} is a SOCKS4a/5 server forwarding connections to any destination, like C{ssh -D}
+
 - L{DirectTcpIpChannelConnector} is a C{Connector} allowing protocol forwarding through L{twisted.conch.ssh.connection.SSHConnection}
 
 @author: Patrick Majewski <patrykm@me.com>
@@ -11,3 +21,9 @@ based on usage and interface of C{paramiko.client.SSHClient}
 from sshclient import *
 from policies import *
 from directchannel import *
+from pool import *
+from fleet import *
+from reconnect import *
+from resolver import *
+from localforward import *
+from socksforward import *
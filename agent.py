@@ -0,0 +1,196 @@
+"""
+SSH agent access shared by all connections of a process
+
+A single connection to the agent listening on C{SSH_AUTH_SOCK} is opened on
+first use and multiplexed by every L{SSHClient}: requests are queued on it and
+answered in order.  The identity list is cached, so authenticating with an
+agent key costs one sign request::
+
+    d = ssh_agent.identities()
+    d.addCallback(lambda pkeys: ssh_agent.sign(pkeys[0].blob(), data))
+"""
+
+import os, time
+
+from twisted.conch.ssh import keys
+from twisted.conch.ssh.agent import SSHAgentClient
+from twisted.internet import defer, protocol
+from twisted.python import log
+
+__all__ = ['SSHAgent', 'ssh_agent']
+
+
+class _SharedAgentClient (SSHAgentClient):
+    """ Agent protocol telling its L{SSHAgent} when the connection is gone """
+
+    def connectionLost(self, reason):
+        SSHAgentClient.connectionLost(self, reason)
+        self.owner._agentLost(self, reason)
+
+
+class SSHAgent (object):
+    """
+    Lazily connected, process-wide client of an SSH agent.
+
+    The socket path is read from C{SSH_AUTH_SOCK} when connecting, unless
+    given explicitly.  A lost agent connection is reopened by the next request.
+    """
+
+    def __init__(self, socket_path=None, identities_ttl=60.0, reactor=None, clock=time.time):
+        """
+        @param socket_path: agent socket, defaults to C{SSH_AUTH_SOCK}
+        @type socket_path: C{str}
+        @param identities_ttl: seconds the identity list is cached
+        @type identities_ttl: C{float}
+        @param reactor: reactor to use, defaults to the global reactor
+        @param clock: function returning the current time
+        """
+        self.socket_path = socket_path
+        self.identities_ttl = identities_ttl
+        self.reactor = reactor
+        self.clock = clock
+        self.client = None
+        self.sign_requests = 0
+        self.identity_requests = 0
+        self._connecting = None
+        self._identities = None
+        self._identities_at = None
+        self._identities_loading = None
+
+    def available(self):
+        """
+        @return: C{True} if an agent socket is configured
+        @rtype: C{bool}
+        """
+        return bool(self.socket_path or os.environ.get('SSH_AUTH_SOCK'))
+
+    def _getReactor(self):
+        if self.reactor is None:
+            from twisted.internet import reactor
+            return reactor
+        return self.reactor
+
+    def connect(self):
+        """
+        @return: L{Deferred} fired with the connected L{SSHAgentClient}
+        """
+        if self.client is not None:
+            return defer.succeed(self.client)
+        if self._connecting is not None:
+            d = defer.Deferred()
+            self._connecting.append(d)
+            return d
+        path = self.socket_path or os.environ.get('SSH_AUTH_SOCK')
+        if not path:
+            return defer.fail(IOError('SSH_AUTH_SOCK is not set'))
+
+        self._connecting = []
+        creator = protocol.ClientCreator(self._getReactor(), _SharedAgentClient)
+        d = creator.connectUNIX(path)
+        d.addCallbacks(self._connected, self._connectFailed)
+        return d
+
+    def _connected(self, client):
+        client.owner = self
+        self.client = client
+        waiters, self._connecting = self._connecting, None
+        for d in waiters:
+            d.callback(client)
+        return client
+
+    def _connectFailed(self, reason):
+        waiters, self._connecting = self._connecting, None
+        for d in waiters:
+            d.errback(reason)
+        return reason
+
+    def _agentLost(self, client, reason):
+        if client is self.client:
+            log.msg('Lost SSH agent connection: %s' % reason.getErrorMessage())
+            self.client = None
+        # SSHAgentClient leaves requests without an answer pending forever
+        pending, client.deferreds = client.deferreds, []
+        for d in pending:
+            d.errback(reason)
+
+    def identities(self):
+        """
+        Return the public keys held by the agent, from the cache if the list
+        is younger than C{identities_ttl}.
+
+        @return: L{Deferred} fired with a list of L{twisted.conch.ssh.keys.Key}
+        """
+        if self._identities is not None and self.clock() - self._identities_at < self.identities_ttl:
+            return defer.succeed(self._identities)
+        if self._identities_loading is not None:
+            d = defer.Deferred()
+            self._identities_loading.append(d)
+            return d
+
+        self._identities_loading = []
+        self.identity_requests += 1
+        d = self.connect()
+        d.addCallback(lambda client: client.requestIdentities())
+        d.addCallback(self._gotIdentities)
+        d.addBoth(self._identitiesDone)
+        return d
+
+    def _gotIdentities(self, identities):
+        pkeys = []
+        for blob, comment in identities:
+            try:
+                pkeys.append(keys.Key.fromString(blob))
+            except (keys.BadKeyError, ValueError), e:
+                log.msg('Ignoring SSH agent key %r: %s' % (comment, e))
+        self._identities = pkeys
+        self._identities_at = self.clock()
+        return pkeys
+
+    def _identitiesDone(self, result):
+        waiters, self._identities_loading = self._identities_loading, None
+        for d in waiters:
+            if isinstance(result, list):
+                d.callback(result)
+            else:
+                d.errback(result)
+        return result
+
+    def sign(self, blob, data):
+        """
+        Ask the agent to sign C{data} with the key C{blob}.
+
+        @param blob: public key blob of an agent identity
+        @type blob: C{str}
+        @type data: C{str}
+        @return: L{Deferred} fired with the signature, encoded like
+            L{twisted.conch.ssh.keys.Key.sign} does
+        """
+        self.sign_requests += 1
+        d = self.connect()
+        d.addCallback(lambda client: client.signData(blob, data))
+        return d
+
+    def invalidate(self):
+        """ Forget the cached identity list """
+        self._identities = None
+        self._identities_at = None
+
+    def close(self):
+        """ Close the agent connection, it's reopened on the next request """
+        self.invalidate()
+        if self.client is not None:
+            client, self.client = self.client, None
+            client.transport.loseConnection()
+
+    def stats(self):
+        """
+        @return: number of C{identity_requests} and C{sign_requests} sent to
+            the agent and whether it's C{connected}
+        @rtype: C{dict}
+        """
+        return {'identity_requests': self.identity_requests, 'sign_requests': self.sign_requests,
+                'connected': self.client is not None}
+
+
+# shared by all L{SSHClient} instances
+ssh_agent = SSHAgent()
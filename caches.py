@@ -0,0 +1,339 @@
+"""
+Caches shared by the connections of L{SSHClient}
+"""
+
+import hashlib, os, stat, threading, time
+from collections import OrderedDict
+
+from twisted.conch.ssh import keys
+
+__all__ = ['LRUCache', 'HostKeyVerificationCache', 'PrivateKeyCache', 'private_key_cache',
+           'AuthHintCache', 'auth_hint_cache']
+
+
+class LRUCache (object):
+    """
+    Bounded mapping dropping the least recently used entry when full.
+    Lookups through L{get} are counted in C{hits} and C{misses}.
+    """
+
+    def __init__(self, maxsize=1024):
+        """
+        @param maxsize: maximum number of entries
+        @type maxsize: C{int}
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        """
+        Return the value for C{key} and mark it as recently used, or
+        C{default} if C{key} isn't cached.
+        """
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data[key] = value
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = value
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """ Remove C{key} and return its value, or C{default} """
+        return self._data.pop(key, default)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        """ Remove all entries, counters are kept """
+        self._data.clear()
+
+    def stats(self):
+        """
+        @return: C{hits}, C{misses} and current C{size} of the cache
+        @rtype: C{dict}
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data)}
+
+
+class HostKeyVerificationCache (LRUCache):
+    """
+    Server host keys already verified against L{HostKeys}, keyed by
+    C{(hostkey name, raw key blob)}.
+
+    Every L{HostKeys} counts its changes in C{generation}; the cache is
+    emptied as soon as any of the L{HostKeys} it is checked against changed,
+    so a key removed or replaced there is never accepted from the cache.
+    """
+
+    def __init__(self, maxsize=1024):
+        LRUCache.__init__(self, maxsize)
+        self._generations = None
+
+    def _sync(self, hostkeys):
+        generations = tuple([(id(h), h.generation) for h in hostkeys])
+        if generations != self._generations:
+            self.clear()
+            self._generations = generations
+
+    def check(self, hostkeys, hostname, blob):
+        """
+        Return C{True} if C{blob} was verified for C{hostname} and none of
+        C{hostkeys} changed since.
+
+        @param hostkeys: host keys the verification was made against
+        @type hostkeys: list(L{HostKeys})
+        @param hostname: hostkey name of the server
+        @type hostname: C{str}
+        @param blob: raw server key
+        @type blob: C{str}
+        @rtype: C{bool}
+        """
+        self._sync(hostkeys)
+        return self.get((hostname, blob)) is not None
+
+    def add(self, hostkeys, hostname, blob):
+        """
+        Remember C{blob} as verified for C{hostname} against C{hostkeys}.
+        """
+        self._sync(hostkeys)
+        self[(hostname, blob)] = True
+
+
+class PrivateKeyCache (object):
+    """
+    Process-wide cache of private keys read from files, decrypted keys
+    included, keyed by path and validated by the file C{mtime} and size.
+
+    A file is C{stat}'ed again at most every C{recheck_interval} seconds,
+    so repeated connections don't touch the disk; use L{invalidate} to
+    pick up a changed key sooner.  Missing files are cached too.
+
+    L{load} may be called from threads, L{peek} never touches the disk and
+    is meant for the reactor thread.
+    """
+
+    def __init__(self, recheck_interval=30.0, clock=time.time):
+        """
+        @param recheck_interval: seconds during which a cached key is used
+            without checking its file
+        @type recheck_interval: C{float}
+        @param clock: function returning the current time
+        """
+        self.recheck_interval = recheck_interval
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        # path -> [stamp, checked at, key, passphrase digest]
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def peek(self, path, passphrase=None):
+        """
+        Return the key cached for C{path} if it doesn't need to be checked
+        against its file yet, without any disk access.
+
+        @return: C{(True, key)} on a hit (key is C{None} for a missing
+            file), otherwise C{(False, None)}
+        @rtype: tuple
+        """
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(path)
+            if (entry is not None and self._usable(entry, passphrase)
+                    and self.clock() - entry[1] < self.recheck_interval):
+                self.hits += 1
+                return True, entry[2]
+            return False, None
+        finally:
+            self._lock.release()
+
+    def load(self, path, passphrase=None):
+        """
+        Return the private key stored in C{path}, decrypting it with
+        C{passphrase} if needed.  A key decrypted before is only returned for
+        the same passphrase.
+
+        @param path: private key file
+        @type path: C{str}
+        @param passphrase: passphrase for encrypted keys
+        @type passphrase: C{str}
+        @return: the key, or C{None} if C{path} isn't a file
+        @rtype: L{twisted.conch.ssh.keys.Key}
+        @raise keys.EncryptedKeyError: if the key is encrypted and no or the
+            wrong passphrase was given
+        """
+        hit, key = self.peek(path, passphrase)
+        if hit:
+            return key
+        now = self.clock()
+        stamp = self._stamp(path)
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(path)
+            if entry is not None and self._usable(entry, passphrase) and stamp == entry[0]:
+                entry[1] = now
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+        finally:
+            self._lock.release()
+        if stamp is None:
+            key, digest = None, None
+        else:
+            key, digest = self._read(path, passphrase)
+        self._lock.acquire()
+        try:
+            self._entries[path] = [stamp, now, key, digest]
+        finally:
+            self._lock.release()
+        return key
+
+    def invalidate(self, path=None):
+        """
+        Forget the key read from C{path}, or all keys.
+
+        @type path: C{str}
+        """
+        self._lock.acquire()
+        try:
+            if path is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(path, None)
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """
+        @return: C{hits}, C{misses} and number of cached C{keys}
+        @rtype: C{dict}
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'keys': len(self._entries)}
+
+    def _usable(self, entry, passphrase):
+        digest = entry[3]
+        return digest is None or (passphrase is not None and hashlib.sha256(passphrase).digest() == digest)
+
+    def _stamp(self, path):
+        """ Returns C{(mtime, size)} of a regular file, otherwise C{None} """
+        try:
+            st = os.stat(path)
+        except OSError, e:
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        return (st.st_mtime, st.st_size)
+
+    def _read(self, path, passphrase):
+        """ Returns the key and the passphrase digest, if it was encrypted """
+        try:
+            return keys.Key.fromFile(path), None
+        except keys.EncryptedKeyError, e:
+            if not passphrase:
+                raise
+        return keys.Key.fromFile(path, passphrase=passphrase), hashlib.sha256(passphrase).digest()
+
+
+# shared by all L{SSHClient} instances
+private_key_cache = PrivateKeyCache()
+
+
+class AuthHintCache (LRUCache):
+    """
+    Remembers per C{(hostname, port, username)} which private key the server
+    accepted and which keys it rejected, so the next connection offers the
+    accepted key first and rejected keys last.
+
+    Rejections expire after C{reject_ttl} seconds; keys are identified by
+    their fingerprint.
+    """
+
+    def __init__(self, maxsize=1024, reject_ttl=300.0, clock=time.time):
+        """
+        @param maxsize: maximum number of remembered destinations
+        @type maxsize: C{int}
+        @param reject_ttl: seconds a rejected key is offered last
+        @type reject_ttl: C{float}
+        @param clock: function returning the current time
+        """
+        LRUCache.__init__(self, maxsize)
+        self.reject_ttl = reject_ttl
+        self.clock = clock
+
+    def _hints(self, destination):
+        hints = self.get(destination)
+        if hints is None:
+            # [accepted fingerprint, {rejected fingerprint: expires at}]
+            hints = [None, {}]
+            self[destination] = hints
+        return hints
+
+    def accepted(self, destination, pkey):
+        """
+        Remember C{pkey} as accepted by C{destination}.
+
+        @param destination: C{(hostname, port, username)}
+        @type destination: C{tuple}
+        @type pkey: L{twisted.conch.ssh.keys.Key}
+        """
+        hints = self._hints(destination)
+        fingerprint = pkey.fingerprint()
+        hints[0] = fingerprint
+        hints[1].pop(fingerprint, None)
+
+    def rejected(self, destination, pkey):
+        """
+        Remember C{pkey} as rejected by C{destination} for C{reject_ttl}
+        seconds.
+        """
+        hints = self._hints(destination)
+        fingerprint = pkey.fingerprint()
+        if hints[0] == fingerprint:
+            hints[0] = None
+        hints[1][fingerprint] = self.clock() + self.reject_ttl
+
+    def order(self, destination, pkeys):
+        """
+        Return C{pkeys} in the order they should be offered to
+        C{destination}: the accepted key first, recently rejected keys last,
+        otherwise in the given order.
+
+        @type pkeys: C{list}
+        @rtype: C{list}
+        """
+        hints = self.get(destination)
+        if hints is None:
+            return list(pkeys)
+        accepted, rejected = hints
+        now = self.clock()
+        for fingerprint, expires in rejected.items():
+            if expires <= now:
+                del rejected[fingerprint]
+
+        def rank(pkey):
+            fingerprint = pkey.fingerprint()
+            if fingerprint == accepted:
+                return 0
+            if fingerprint in rejected:
+                return 2
+            return 1
+        # sorted is stable, keys of the same rank keep their order
+        return sorted(pkeys, key=rank)
+
+
+# shared by all L{SSHClient} instances
+auth_hint_cache = AuthHintCache()
@@ -16,24 +16,74 @@ Connecting using L{DirectTcpIpChannelConnector}:
     
         c = DirectTcpIpChannelConnector(sshconnection, host, port, factory, timeout, reactor)
         c.connect()
+
+Flow control:
+    L{DirectTcpIpChannelClient} is a consumer and a push producer like TCP
+    transports, so protocols can splice it with other transports::
+
+        self.transport.registerProducer(peer.transport, True)
+        peer.transport.registerProducer(self.transport, True)
+
+    The registered producer is paused while more than C{high_water} bytes
+    wait for the remote window, and resumed once they drop to C{low_water}.
+    Pausing the channel stops delivering data and withholds window adjusts,
+    so the remote side stops sending once the window it has been given is
+    used up.  Data received while paused is delivered before an EOF or close
+    of the remote side closes the channel.
+
+Window sizing:
+    The window limits a channel to a window per round trip, 128 KiB by
+    default.  Channels given a C{max_window_size} measure the data received
+    per round trip of the connection (C{connection.rtt}) and double their
+    window while more than a quarter of it is used per round trip, up to
+    C{max_window_size} and the C{window_budget} of the connection shared by
+    all its channels::
+
+        sshconnection.connectTCP(host, port, factory, 8, max_window_size = 8 * 1024 * 1024)
+
+Write coalescing:
+    Every write is sent as its own packet, with its own padding and MAC.
+    Channels given a C{coalesce_delay} merge writes - and the strings of
+    C{writeSequence} - into packets of the maximum size the remote side
+    accepts, sent once full or C{coalesce_delay} seconds after the first
+    merged write.  A delay of C{0} merges the writes of a single reactor
+    iteration without delaying them.  Packets saved are counted in
+    C{packets_saved}.
 """
 
+from zope.interface import implementer
 from twisted.conch.ssh import channel, forwarding
-from twisted.internet import tcp, main, error, defer, address
+from twisted.internet import tcp, main, error, defer, address, abstract, interfaces
 from twisted.python import failure, log
 
 __all__ = ["DirectTcpIpChannelClient", "DirectTcpIpChannelConnector"]
 
 
+@implementer(interfaces.IConsumer, interfaces.IPushProducer)
 class DirectTcpIpChannelClient (channel.SSHChannel):
     """
     Client emulation (like L{twisted.internet.tcp.Client}) over L{twisted.conn.ssh.channel.SSHChannel}
     
     @see: L{directchannel}
+
+    @cvar high_water: buffered bytes pausing the registered producer
+    @cvar low_water: buffered bytes resuming the registered producer
+    @ivar paused: set while the channel doesn't deliver data and withholds
+        window adjusts, see L{pauseProducing}
+    @ivar max_window_size: size the window may grow to, see L{directchannel}
+    @ivar window_grows: number of times the window grew
+    @ivar coalesce_delay: maximum seconds writes are held to be merged,
+        C{None} sends every write at once, see L{directchannel}
+    @ivar packets_saved: packets not sent thanks to merged writes
+    @ivar channelClosedDefer: fired once the channel is closed or its open
+        refused, also when connecting failed or was stopped before the other
+        side answered the open
     """
     name = 'direct-tcpip'
+    high_water = 262144
+    low_water = 65536
 
-    def __init__(self, host, port, connector, reactor):
+    def __init__(self, host, port, connector, reactor, window_size = None, max_packet = None, max_window_size = None, coalesce_delay = None):
         """
         @param host: host to connect
         @type host: C{str}
@@ -43,36 +93,232 @@ class DirectTcpIpChannelClient (channel.SSHChannel):
         @type connector: L{twisted.internet.tcp.Connector}
         @param reactor: reactor to use
         @type reactor: L{twisted.internet.reactor}
+        @param window_size: initial local window, default 128 KiB
+        @type window_size: C{int}
+        @param max_packet: maximum packet size the remote side may send, default 32 KiB
+        @type max_packet: C{int}
+        @param max_window_size: grow the window with the bandwidth-delay
+            product up to this size, C{None} keeps it fixed
+        @type max_window_size: C{int}
+        @param coalesce_delay: merge writes for up to this many seconds,
+            C{None} disables merging
+        @type coalesce_delay: C{float}
         """
-        channel.SSHChannel.__init__(self, conn = connector.connection)
+        channel.SSHChannel.__init__(self, localWindow = window_size or 0, localMaxPacket = max_packet or 0, conn = connector.connection)
+        self.max_window_size = max_window_size
+        self.window_grows = 0
+        self._sampleStart = None
+        self._sampleBytes = 0
+        self.coalesce_delay = coalesce_delay
+        self.packets_saved = 0
+        self._coalesced = []
+        self._coalescedSize = 0
+        self._flush = None
+        self._addingWindow = False
         self.host = host
         self.port = port
         self.connector = connector
+        self.reactor = reactor
         self.protocol = None
         self.connected = 0
         self.disconnected = 0
         self.disconnecting = 0
+        self.producer = None
+        self.streamingProducer = False
+        self.producerPaused = False
+        self.paused = False
+        self._pausedData = []
+        self._pausedClose = False
+        self._pull = None
         reactor.callLater(0, self._connect)
         self.connectionLostDefer = defer.Deferred()
         self.connectionFailedDefer = defer.Deferred()
+        self.channelClosedDefer = defer.Deferred()
     
     def _connect(self):
         """
         Asks L{twisted.conch.sshconnection.SSHConnection} to open channel - connect
         """
+        if not hasattr(self, "connector"):
+            # connecting was stopped before the channel was opened
+            self._channelGone()
+            return
         hostport = self.getHost()
         channelOpenData = forwarding.packOpen_direct_tcpip((self.host, self.port), (hostport.host, hostport.port))
         self.connector.connection.openChannel(self, channelOpenData)
 
     def dataReceived(self, data):
         """
-        Called when we receive data.
+        Called when we receive data, kept until L{resumeProducing} while paused.
 
         @type data: C{str}
         """
-        if not self.disconnected:
+        if self.paused:
+            self._pausedData.append(data)
+        elif not self.disconnected:
+            if self.max_window_size is not None:
+                self._sampleWindow(len(data))
             self.protocol.dataReceived(data)
 
+    def _sampleWindow(self, length):
+        """ Grows the window when more than a quarter of it was received in a round trip """
+        now = self.reactor.seconds()
+        if self._sampleStart is None:
+            self._sampleStart = now
+        self._sampleBytes += length
+        rtt = getattr(self.conn, 'rtt', None)
+        elapsed = now - self._sampleStart
+        if not rtt or elapsed < rtt:
+            return
+        bdp = self._sampleBytes * rtt / elapsed
+        self._sampleStart = now
+        self._sampleBytes = 0
+        # the window is adjusted when half of it is used, so a window
+        # limited channel receives about a half of it per round trip or less
+        if bdp * 4 < self.localWindowSize:
+            return
+        size = min(self.localWindowSize * 2, self.max_window_size)
+        budget = getattr(self.conn, 'window_budget', None)
+        if budget is not None:
+            used = sum([c.localWindowSize for c in self.conn.channels.values()])
+            size = min(size, self.localWindowSize + budget - used)
+        if size <= self.localWindowSize:
+            return
+        grow = size - self.localWindowSize
+        self.localWindowSize = size
+        self.window_grows += 1
+        log.msg('growing window of channel %s to %d bytes' % (self.id, size))
+        self.conn.adjustWindow(self, grow)
+
+    def pauseProducing(self):
+        """ Stops delivering data and adjusting the window of the remote side. """
+        self.paused = True
+
+    def resumeProducing(self):
+        """ Delivers data received while paused and adjusts the window of the remote side. """
+        self.paused = False
+        self._sampleStart = None
+        self._sampleBytes = 0
+        while self._pausedData and not self.paused and not self.disconnected:
+            self.protocol.dataReceived(self._pausedData.pop(0))
+        if self.paused or self.disconnected:
+            return
+        if self._pausedClose:
+            self.loseConnection()
+        elif self.localWindowLeft < self.localWindowSize // 2:
+            self.conn.adjustWindow(self, self.localWindowSize - self.localWindowLeft)
+
+    def stopProducing(self):
+        """ Closes the channel. """
+        self.loseConnection()
+
+    def write(self, data):
+        """
+        Writes data to the channel, merged with other writes if
+        L{coalesce_delay} is set.
+
+        @type data: C{str}
+        """
+        # data waiting for the window is merged into packets anyway
+        if self.coalesce_delay is None or self.buf or self._addingWindow:
+            self._write(data)
+            return
+        self._coalesced.append(data)
+        self._coalescedSize += len(data)
+        if self._coalescedSize >= self.remoteMaxPacket:
+            self._flushCoalesced()
+        elif self._flush is None:
+            self._flush = self.reactor.callLater(self.coalesce_delay, self._flushCoalesced)
+
+    def _flushCoalesced(self):
+        """ Writes merged writes, counting packets saved """
+        if self._flush is not None:
+            if self._flush.active():
+                self._flush.cancel()
+            self._flush = None
+        if not self._coalesced:
+            return
+        packet = self.remoteMaxPacket
+        writes, self._coalesced = self._coalesced, []
+        self._coalescedSize = 0
+        data = ''.join(writes)
+        unmerged = sum([(len(write) + packet - 1) // packet for write in writes])
+        self.packets_saved += unmerged - (len(data) + packet - 1) // packet
+        self._write(data)
+
+    def _write(self, data):
+        """
+        Writes data to the channel, pausing the registered producer when
+        more than L{high_water} bytes wait for the remote window.
+
+        @type data: C{str}
+        """
+        channel.SSHChannel.write(self, data)
+        if self.producer is None:
+            return
+        if len(self.buf) > self.high_water:
+            if self.streamingProducer and not self.producerPaused:
+                self.producerPaused = True
+                self.producer.pauseProducing()
+        elif not self.streamingProducer:
+            self._schedulePull()
+
+    def addWindowBytes(self, data):
+        """ Called when the remote side adjusts the window, resumes the registered producer. """
+        # data waiting for the window is written before merged writes
+        self._addingWindow = True
+        try:
+            channel.SSHChannel.addWindowBytes(self, data)
+        finally:
+            self._addingWindow = False
+        if self.producer is None or len(self.buf) > self.low_water:
+            return
+        if not self.streamingProducer:
+            self._schedulePull()
+        elif self.producerPaused:
+            self.producerPaused = False
+            self.producer.resumeProducing()
+
+    def _schedulePull(self):
+        """ Asks the pull producer for more data in the next reactor iteration """
+        if self._pull is None:
+            self._pull = self.reactor.callLater(0, self._pullProducer)
+
+    def _pullProducer(self):
+        self._pull = None
+        if self.producer is not None and not self.streamingProducer:
+            self.producer.resumeProducing()
+
+    def registerProducer(self, producer, streaming):
+        """
+        Registers a producer paused and resumed by the remote window state.
+
+        @param streaming: C{True} for L{interfaces.IPushProducer},
+            C{False} for L{interfaces.IPullProducer}
+        """
+        if self.producer is not None:
+            raise RuntimeError("Cannot register producer %s, because producer %s was never unregistered."
+                               % (producer, self.producer))
+        if self.disconnected:
+            producer.stopProducing()
+            return
+        self.producer = producer
+        self.streamingProducer = streaming
+        self.producerPaused = False
+        if not streaming:
+            producer.resumeProducing()
+        elif len(self.buf) > self.high_water:
+            self.producerPaused = True
+            producer.pauseProducing()
+
+    def unregisterProducer(self):
+        """ Stops consuming data from the registered producer. """
+        self.producer = None
+        self.producerPaused = False
+        if self._pull is not None:
+            self._pull.cancel()
+            self._pull = None
+
     def channelOpen(self, specificData):
         """
         Called when the channel is opened.  specificData is any data that the
@@ -81,6 +327,12 @@ class DirectTcpIpChannelClient (channel.SSHChannel):
         @type specificData: C{str}
         """
         log.msg('opened forwarding channel %s to %s:%s' % (self.id, self.host, self.port))
+        if not hasattr(self, "connector"):
+            # connecting was stopped before the other side confirmed
+            channel.SSHChannel.loseConnection(self)
+            return
+        if self.max_window_size is not None and getattr(self.conn, 'measure_rtt', None) is not None:
+            self.conn.measure_rtt()
         self._connectDone()
 
     def openFailed(self, reason):
@@ -91,6 +343,7 @@ class DirectTcpIpChannelClient (channel.SSHChannel):
         @type reason: L{error.ConchError}
         """
         log.msg('other side refused open\nreason: %s'% reason)
+        self._channelGone()
         self.failIfNotConnected(error.ConnectError('Connection failed'))
     
     def _connectDone(self):
@@ -103,32 +356,49 @@ class DirectTcpIpChannelClient (channel.SSHChannel):
         self.protocol.makeConnection(self)
 
     def eofReceived(self):
-        """ Called when the other side will send no more data. """
+        """ Called when the other side will send no more data, the channel is closed once data received while paused is delivered. """
         channel.SSHChannel.eofReceived(self)
         # print 'DirectTcpIpChannelClient:: remote eof'
+        if self._pausedData:
+            self._pausedClose = True
+            return
         self.loseConnection()
     
-    # def closeReceived(self):
-    #     """ Called when the other side has closed the channel. """
-    #     channel.SSHChannel.closeReceived(self)
-    #     print 'DirectTcpIpChannelClient:: closeReceived'
-    # 
-    # def closed(self):
-    #     """
-    #     Called when the channel is closed.  This means that both our side and
-    #     the remote side have closed the channel.
-    #     """
-    #     channel.SSHChannel.closed(self)
-    #     print 'DirectTcpIpChannelClient:: closed'
+    def closeReceived(self):
+        """ Called when the other side has closed the channel, the channel is closed once data received while paused is delivered. """
+        if self._pausedData:
+            self._pausedClose = True
+            return
+        channel.SSHChannel.closeReceived(self)
     
+    def closed(self):
+        """
+        Called when the channel is closed.  This means that both our side and
+        the remote side have closed the channel, or the SSH connection was
+        lost; the protocol is notified unless it already was.
+        """
+        channel.SSHChannel.closed(self)
+        self._channelGone()
+        if not self.disconnected:
+            self.connectionLost(failure.Failure(error.ConnectionLost('SSH channel closed')))
+    
+    def _channelGone(self):
+        """ Fires L{channelClosedDefer} once """
+        if not self.channelClosedDefer.called:
+            self.channelClosedDefer.callback(1)
+
     def stopConnecting(self):
         """ Stop attempt to connect. """
         self.failIfNotConnected(error.UserError())
 
     def loseConnection(self, _connDone=failure.Failure(main.CONNECTION_DONE)):
         """ Close the channel if there is no buferred data.  Otherwise, note the request and return. """
-        channel.SSHChannel.loseConnection(self)
+        if self.connected:
+            self._flushCoalesced()
+        # the protocol is notified first, sending close after the remote
+        # side did calls closed() right away
         self.connectionLost(_connDone)
+        channel.SSHChannel.loseConnection(self)
     
     def failIfNotConnected(self, err):
         """ Generic method called when the attemps to connect failed. """
@@ -147,6 +417,15 @@ class DirectTcpIpChannelClient (channel.SSHChannel):
         else:
             self.disconnected = 1
             self.connected = 0
+            self._pausedData = []
+            self._coalesced = []
+            if self._flush is not None and self._flush.active():
+                self._flush.cancel()
+            self._flush = None
+            if self.producer is not None:
+                producer = self.producer
+                self.unregisterProducer()
+                producer.stopProducing()
             # self._closeSocket()
             protocol = self.protocol
             del self.protocol
@@ -158,15 +437,17 @@ class DirectTcpIpChannelClient (channel.SSHChannel):
         """
         Return a tuple describing the other side of the connection.
 
-        @rtype: C{IPv4Address}
+        @rtype: C{IPv4Address} or C{IPv6Address}
         """
-        return address.IPv4Address('TCP', *((self.host, self.port) + ('INET',)))
+        if abstract.isIPv6Address(self.host):
+            return address.IPv6Address('TCP', self.host, self.port)
+        return address.IPv4Address('TCP', self.host, self.port)
     
     def getHost(self):
         """
         Return a tuple describing our side of the connection.
 
-        @rtype: C{IPv4Address}
+        @rtype: C{IPv4Address} or C{IPv6Address}
         """
         return self.conn.transport.transport.getHost()
     
@@ -183,7 +464,8 @@ class DirectTcpIpChannelConnector (tcp.Connector):
     @see: L{directchannel}
     """
     
-    def __init__(self, connection, host, port, factory, timeout, reactor = None, loseconnection_on_protocollose = False, loseconnection_on_protocolfailed = False):
+    def __init__(self, connection, host, port, factory, timeout, reactor = None, loseconnection_on_protocollose = False, loseconnection_on_protocolfailed = False,
+                 window_size = None, max_packet = None, max_window_size = None, coalesce_delay = None):
         """
         @param connection: transport connection
         @type connection: L{twisted.conch.sshconnection.SSHConnection}
@@ -199,11 +481,23 @@ class DirectTcpIpChannelConnector (tcp.Connector):
         @type reactor: L{twisted.internet.reactor}
         @param loseconnection_on_protocollose: when set loses L{twisted.conch.sshconnection.SSHConnection} when channel is loses it's own connection
         @param loseconnection_on_protocolfailed: when set loses L{twisted.conch.sshconnection.SSHConnection} when channel fails to connect
+        @param window_size: initial local window of the channel
+        @type window_size: C{int}
+        @param max_packet: maximum packet size the remote side may send
+        @type max_packet: C{int}
+        @param max_window_size: size the window may grow to, see L{directchannel}
+        @type max_window_size: C{int}
+        @param coalesce_delay: maximum seconds writes are merged for, see L{directchannel}
+        @type coalesce_delay: C{float}
         """
         tcp.Connector.__init__(self, host, port, factory, timeout, None, reactor = reactor)
         self.connection = connection
         self.loseconnection_on_protocollose = loseconnection_on_protocollose
         self.loseconnection_on_protocolfailed = loseconnection_on_protocolfailed
+        self.window_size = window_size
+        self.max_packet = max_packet
+        self.max_window_size = max_window_size
+        self.coalesce_delay = coalesce_delay
     
     def _makeTransport(self):
         """ 
@@ -211,7 +505,8 @@ class DirectTcpIpChannelConnector (tcp.Connector):
         
         @rtype: L{DirectTcpIpChannelClient}
         """
-        transport = DirectTcpIpChannelClient(self.host, self.port, self, self.reactor)
+        transport = DirectTcpIpChannelClient(self.host, self.port, self, self.reactor, self.window_size, self.max_packet, self.max_window_size,
+                                             self.coalesce_delay)
         if self.loseconnection_on_protocollose:
             transport.connectionLostDefer.addCallback(self.transportProtocolDisconnected)
         if self.loseconnection_on_protocolfailed:
@@ -26,6 +26,20 @@ class BadHostKeyException (SSHException):
         self.key = got_key
         self.expected_key = expected_key
 
+class RevokedHostKeyException (SSHException):
+    """
+    The host key given by the SSH server is marked as revoked.
+
+    @param hostname: the hostname of the SSH server
+    @type hostname: str
+    @param key: the host key presented by the server
+    @type key: L{PKey}
+    """
+    def __init__(self, hostname, got_key):
+        SSHException.__init__(self, 'Host key for server %s is revoked!' % hostname)
+        self.hostname = hostname
+        self.key = got_key
+
 class UnknownHostKeyException (SSHException):
     """
     The host key given by the SSH server is unknown.
@@ -57,3 +71,23 @@ class SSHRemoteErrorException (SSHException):
         SSHException.__init__(self, 'Remote error, code: %s, reason: %s' % (code, reason))
         self.code = code
         self.reason = reason
+
+class PoolClosedException (SSHException):
+    """
+    The connection pool was closed before a connection could be acquired.
+    """
+    pass
+
+class CircuitOpenException (SSHException):
+    """
+    Connecting to the host is skipped after repeated failures.
+
+    @param hostname: the hostname of the SSH server
+    @type hostname: str
+    @param until: time until which the host is skipped
+    @type until: float
+    """
+    def __init__(self, hostname, until):
+        SSHException.__init__(self, 'Host %s is skipped after repeated failures' % hostname)
+        self.hostname = hostname
+        self.until = until
@@ -0,0 +1,161 @@
+"""
+Benchmark of the ciphers and MACs supported by L{SSHClientTransport}.
+
+Every supported cipher and MAC is measured on this machine and a preference
+order for L{SSHClient.set_preferred_algorithms} is recommended::
+
+    python benchmark_ciphers.py
+
+Given a server, every cipher (with the first recommended MAC) and every MAC
+(with the first recommended cipher) is also negotiated with it, reporting the
+handshake time and the throughput of a tunnel to a sink listening on this
+machine - the server connects to it at C{--sink-host}::
+
+    python benchmark_ciphers.py -u test -k ~/.ssh/id_rsa ssh.example.com
+
+Only algorithms implemented by L{twisted.conch} are measured, AES-GCM and
+chacha20-poly1305 aren't among them.
+"""
+
+import sys, os, time, optparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from twisted.conch.ssh import transport
+from twisted.internet import defer, protocol, reactor
+
+import sshclient
+
+PACKET_SIZE = 32768
+DURATION = 0.5
+# recommended only after the others, however fast
+WEAK = ['hmac-md5', '3des-cbc', 'blowfish-cbc', 'cast128-cbc']
+
+
+def measure(function):
+    """ Calls C{function} for L{DURATION} seconds, returns MB/s of L{PACKET_SIZE} packets """
+    calls = 0
+    start = time.time()
+    while True:
+        for i in xrange(16):
+            function()
+        calls += 16
+        elapsed = time.time() - start
+        if elapsed >= DURATION:
+            return calls * PACKET_SIZE / elapsed / 1024 / 1024
+
+def measure_cipher(name):
+    ciphers = transport.SSHCiphers(name, name, 'none', 'none')
+    ciphers.setKeys(os.urandom(32), os.urandom(32), os.urandom(32), os.urandom(32), '', '')
+    data = os.urandom(PACKET_SIZE)
+    return measure(lambda: ciphers.encrypt(data))
+
+def measure_mac(name):
+    ciphers = transport.SSHCiphers('none', 'none', name, name)
+    ciphers.setKeys('', '', '', '', os.urandom(64), os.urandom(64))
+    data = os.urandom(PACKET_SIZE)
+    return measure(lambda: ciphers.makeMAC(1, data))
+
+def rank(kind, names, measure_one):
+    """ Prints MB/s of every algorithm, returns them fastest first, L{WEAK} ones last """
+    results = [(measure_one(name), name) for name in names]
+    results.sort(reverse=True)
+    print '%-24s %10s' % (kind, 'MB/s')
+    for speed, name in results:
+        print '%-24s %10.1f' % (name, speed)
+    print
+    ranked = [name for speed, name in results]
+    return [name for name in ranked if name not in WEAK] + [name for name in ranked if name in WEAK]
+
+
+class Sink (protocol.Protocol):
+    """ Counts received bytes, fires C{factory.done} after C{factory.size} """
+
+    def dataReceived(self, data):
+        self.factory.received += len(data)
+        if self.factory.received >= self.factory.size and not self.factory.done.called:
+            self.factory.done.callback(time.time())
+
+class SinkFactory (protocol.ServerFactory):
+    protocol = Sink
+
+    def reset(self, size):
+        self.size = size
+        self.received = 0
+        self.done = defer.Deferred()
+
+class Source (protocol.Protocol):
+    """ Writes C{factory.size} bytes once the tunnel is open """
+
+    def connectionMade(self):
+        self.factory.started = time.time()
+        chunk = os.urandom(PACKET_SIZE)
+        for i in xrange(self.factory.size / PACKET_SIZE):
+            self.transport.write(chunk)
+
+class SourceFactory (protocol.ClientFactory):
+    protocol = Source
+
+    def __init__(self, size):
+        self.size = size
+        self.started = None
+
+
+@defer.inlineCallbacks
+def measure_suite(client, options, hostname, sink, sink_port, cipher, mac):
+    client.set_preferred_algorithms(ciphers=[cipher], macs=[mac])
+    sshconnection = yield client.open_connection(hostname, options.port, options.username, options.password,
+                                                 key_filename=options.key_filename, timeout=10)
+    stats = sshconnection.transport.stats()
+    size = options.megabytes * 1024 * 1024
+    sink.reset(size)
+    source = SourceFactory(size)
+    connector = sshconnection.connectTCP(options.sink_host, sink_port, source, 10)
+    finished = yield sink.done
+    connector.disconnect()
+    sshconnection.loseConnection()
+    defer.returnValue((stats['cipher'], stats['mac'], stats['handshake'], stats['authenticated'],
+                       size / (finished - source.started) / 1024 / 1024))
+
+@defer.inlineCallbacks
+def benchmark_server(options, hostname, ciphers, macs):
+    client = sshclient.SSHClient(reactor)
+    client.load_system_host_keys()
+    client.set_missing_host_key_policy(sshclient.WarningPolicy())
+    sink = SinkFactory()
+    sink_port = reactor.listenTCP(0, sink, interface=options.sink_host).getHost().port
+
+    suites = [(cipher, macs[0]) for cipher in ciphers] + [(ciphers[0], mac) for mac in macs[1:]]
+    print '%-16s %-16s %14s %14s %10s' % ('cipher', 'mac', 'handshake [s]', 'auth [s]', 'MB/s')
+    try:
+        for cipher, mac in suites:
+            try:
+                result = yield measure_suite(client, options, hostname, sink, sink_port, cipher, mac)
+            except Exception, e:
+                print '%-16s %-16s failed: %s' % (cipher, mac, e)
+            else:
+                print '%-16s %-16s %14.3f %14.3f %10.1f' % result
+    finally:
+        reactor.stop()
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] [hostname]')
+    parser.add_option('-p', '--port', type='int', default=sshclient.SSH_PORT)
+    parser.add_option('-u', '--username')
+    parser.add_option('--password')
+    parser.add_option('-k', '--key-filename', action='append')
+    parser.add_option('-m', '--megabytes', type='int', default=32, help='data sent through each tunnel')
+    parser.add_option('--sink-host', default='127.0.0.1', help='address the server connects to the sink at')
+    options, args = parser.parse_args()
+
+    ciphers = rank('cipher', transport.SSHClientTransport.supportedCiphers, measure_cipher)
+    macs = rank('mac', transport.SSHClientTransport.supportedMACs, measure_mac)
+    print 'Recommended: client.set_preferred_algorithms(ciphers = %r, macs = %r)' % (ciphers, macs)
+    print
+
+    if args:
+        reactor.callWhenRunning(benchmark_server, options, args[0], ciphers, macs)
+        reactor.run()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Benchmark of L{HostKeys} loading and lookups on generated known_hosts files.
+
+Every configuration is measured in a fresh interpreter, so the reported peak
+RSS belongs to that configuration only::
+
+    python benchmark_hostkeys.py [lines [lines ...]]
+"""
+
+import sys, os, time, base64, struct, hmac, hashlib, resource, subprocess, tempfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+SIZES = [10000, 100000]
+# 'index-build' compiles the on-disk index, 'index' reuses it,
+# 'sqlite' imports the file into a SQLiteHostKeys database
+MODES = ['eager', 'lazy', 'index-build', 'index', 'sqlite']
+LOOKUPS = 100
+
+
+def ssh_string(data):
+    return struct.pack('>L', len(data)) + data
+
+def make_known_hosts(filename, lines):
+    """ Writes C{lines} ssh-rsa entries, every tenth hostname hashed """
+    f = open(filename, 'w')
+    for i in xrange(lines):
+        blob = ssh_string('ssh-rsa') + ssh_string('\x01\x00\x01') + ssh_string('\x00' + os.urandom(128))
+        host = 'host%d.example.com' % i
+        if i % 10 == 9:
+            salt = os.urandom(20)
+            digest = hmac.new(salt, host, hashlib.sha1).digest()
+            host = '|1|%s|%s' % (base64.b64encode(salt), base64.b64encode(digest))
+        f.write('%s ssh-rsa %s\n' % (host, base64.b64encode(blob)))
+    f.close()
+
+def max_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss /= 1024
+    return rss / 1024.0
+
+def child(mode, filename, lines):
+    """ Runs a single measurement and prints it as one tab-separated line """
+    from hostkeys import HostKeys, SQLiteHostKeys
+    rss_before = max_rss_mb()
+    start = time.time()
+    if mode == 'sqlite':
+        hostkeys = SQLiteHostKeys(filename + '.sqlite')
+        hostkeys.load(filename)
+    else:
+        hostkeys = HostKeys()
+        hostkeys.load(filename, lazy=(mode == 'lazy'), index=mode.startswith('index'))
+    load_time = time.time() - start
+    rss = max_rss_mb()
+
+    step = max(1, lines / LOOKUPS)
+    names = ['host%d.example.com' % i for i in xrange(0, lines, step)][:LOOKUPS]
+    start = time.time()
+    for name in names:
+        hostkeys.lookup(name)['RSA']
+    lookup_time = time.time() - start
+
+    key = hostkeys.lookup(names[0])['RSA']
+    start = time.time()
+    for i in xrange(len(names)):
+        hostkeys.add('new%d.example.com' % i, 'RSA', key)
+    add_time = time.time() - start
+    print '%s\t%.3f\t%.1f\t%.0f\t%.0f\t%.0f' % (mode, load_time, rss, (rss - rss_before) * 1024 * 1024 / lines,
+                                              len(names) / lookup_time, len(names) / add_time)
+
+def main(sizes):
+    print '%8s %12s %10s %10s %10s %12s %12s' % ('lines', 'mode', 'load [s]', 'RSS [MB]', 'B/entry', 'lookups/s', 'adds/s')
+    for lines in sizes:
+        fd, filename = tempfile.mkstemp(prefix='known_hosts_')
+        os.close(fd)
+        try:
+            make_known_hosts(filename, lines)
+            for mode in MODES:
+                out = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--child', mode, filename, str(lines)],
+                                       stdout=subprocess.PIPE).communicate()[0]
+                print '%8d %12s %10s %10s %10s %12s %12s' % tuple([lines] + out.strip().split('\t'))
+        finally:
+            for name in (filename, filename + '.index', filename + '.sqlite',
+                         filename + '.sqlite-wal', filename + '.sqlite-shm'):
+                if os.path.exists(name):
+                    os.unlink(name)
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--child']:
+        child(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+    else:
+        main([int(arg) for arg in sys.argv[1:]] or SIZES)
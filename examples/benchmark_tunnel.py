@@ -0,0 +1,157 @@
+"""
+Benchmark of tunnel throughput with fixed and adaptive channel windows.
+
+The SSH server is reached through a local proxy delaying every chunk of data
+by half of C{--latency} each way, so a window limits a tunnel to a window per
+round trip.  For every window configuration the server connects through a
+tunnel to a source listening on this machine - at C{--source-host} - which
+sends C{--megabytes} to the client::
+
+    python benchmark_tunnel.py -u test -k ~/.ssh/id_rsa --latency 50 ssh.example.com
+"""
+
+import sys, os, time, optparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from twisted.internet import defer, protocol, reactor
+
+import sshclient
+
+MB = 1024 * 1024
+# name, window_size, max_window_size
+WINDOWS = [('default', None, None),
+           ('fixed 2M', 2 * MB, None),
+           ('adaptive', None, 16 * MB)]
+
+
+class DelayedRelay (protocol.Protocol):
+    """ Relays data to C{peer} after C{factory.delay} seconds """
+
+    peer = None
+
+    def connectionMade(self):
+        self.pending = []
+        upstream = getattr(self.factory, 'downstream', None)
+        if upstream is not None:
+            self.peer = upstream
+            upstream.peer = self
+            pending, upstream.pending = upstream.pending, []
+            for data in pending:
+                self.transport.write(data)
+
+    def dataReceived(self, data):
+        reactor.callLater(self.factory.delay, self.relay, data)
+
+    def relay(self, data):
+        if self.peer is None:
+            self.pending.append(data)
+        else:
+            self.peer.transport.write(data)
+
+    def connectionLost(self, reason):
+        reactor.callLater(self.factory.delay, self.lose)
+
+    def lose(self):
+        if self.peer is not None:
+            self.peer.transport.loseConnection()
+
+class LatencyProxy (DelayedRelay):
+    """ Accepts a connection and connects it to the server, delaying both directions """
+
+    def connectionMade(self):
+        DelayedRelay.connectionMade(self)
+        upstream = protocol.ClientFactory()
+        upstream.protocol = DelayedRelay
+        upstream.delay = self.factory.delay
+        upstream.downstream = self
+        reactor.connectTCP(self.factory.host, self.factory.port, upstream)
+
+class LatencyProxyFactory (protocol.ServerFactory):
+    protocol = LatencyProxy
+
+    def __init__(self, host, port, delay):
+        self.host = host
+        self.port = port
+        self.delay = delay
+
+
+class Source (protocol.Protocol):
+    """ Sends C{factory.size} bytes and closes the connection """
+
+    def connectionMade(self):
+        chunk = os.urandom(65536)
+        for i in xrange(self.factory.size / len(chunk)):
+            self.transport.write(chunk)
+        self.transport.loseConnection()
+
+class Counter (protocol.Protocol):
+    """ Fires C{factory.done} with the time the connection was open """
+
+    def connectionMade(self):
+        self.started = time.time()
+        self.received = 0
+
+    def dataReceived(self, data):
+        self.received += len(data)
+
+    def connectionLost(self, reason):
+        self.factory.done.callback((self.received, time.time() - self.started, self.transport.localWindowSize))
+
+class CounterFactory (protocol.ClientFactory):
+    protocol = Counter
+
+    def __init__(self):
+        self.done = defer.Deferred()
+
+    def clientConnectionFailed(self, connector, reason):
+        self.done.errback(reason)
+
+
+@defer.inlineCallbacks
+def benchmark(options, hostname):
+    client = sshclient.SSHClient(reactor)
+    client.load_system_host_keys()
+    client.set_missing_host_key_policy(sshclient.WarningPolicy())
+    proxy = reactor.listenTCP(0, LatencyProxyFactory(hostname, options.port, options.latency / 2000.0), interface='127.0.0.1')
+    source = protocol.ServerFactory()
+    source.protocol = Source
+    source.size = options.megabytes * MB
+    source_port = reactor.listenTCP(0, source, interface=options.source_host).getHost().port
+
+    try:
+        sshconnection = yield client.open_connection('127.0.0.1', proxy.getHost().port, options.username, options.password,
+                                                     key_filename=options.key_filename, timeout=10)
+        rtt = yield sshconnection.measure_rtt()
+        print 'round trip %.1f ms, %d MB per tunnel' % (rtt * 1000, options.megabytes)
+        print '%-12s %14s %10s' % ('window', 'final window', 'MB/s')
+        for name, window_size, max_window_size in WINDOWS:
+            counter = CounterFactory()
+            sshconnection.connectTCP(options.source_host, source_port, counter, 10,
+                                     window_size = window_size, max_window_size = max_window_size)
+            received, elapsed, window = yield counter.done
+            print '%-12s %14d %10.1f' % (name, window, received / elapsed / MB)
+        sshconnection.loseConnection()
+    except Exception, e:
+        print 'failed: %s' % (e,)
+    finally:
+        reactor.stop()
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] hostname')
+    parser.add_option('-p', '--port', type='int', default=sshclient.SSH_PORT)
+    parser.add_option('-u', '--username')
+    parser.add_option('--password')
+    parser.add_option('-k', '--key-filename', action='append')
+    parser.add_option('-l', '--latency', type='float', default=50, help='round trip added by the proxy [ms]')
+    parser.add_option('-m', '--megabytes', type='int', default=32, help='data sent through each tunnel')
+    parser.add_option('--source-host', default='127.0.0.1', help='address the server connects to the source at')
+    options, args = parser.parse_args()
+    if not args:
+        parser.error('hostname required')
+
+    reactor.callWhenRunning(benchmark, options, args[0])
+    reactor.run()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+"""
+Connecting to many hosts with bounded concurrency
+
+L{FleetConnector} runs connections from a single L{SSHClient} to a list of
+targets, at most C{concurrency} at a time and with a random delay before each
+connect, so thousands of hosts don't cause a burst of connects and key
+exchanges.  Results are reported as soon as each host completes::
+
+    def uptime(target, sshconnection):
+        ...  # returns a Deferred
+
+    def onResult(target, success, result):
+        print target, success, result
+
+    fleet = FleetConnector(client, concurrency = 100)
+    d = fleet.run(['host%d.example.com' % i for i in xrange(5000)], uptime, onResult)
+    d.addCallback(lambda stats: reactor.stop())
+
+Hosts failing repeatedly with L{FleetConnector.breaker_errors} are skipped
+for a while, see L{FleetConnector}.
+"""
+
+import random, time
+
+from twisted.internet import defer, task
+from twisted.python import failure, log
+
+from errors import BadHostKeyException, SSHRemoteErrorException, CircuitOpenException
+
+__all__ = ['FleetConnector']
+
+
+class FleetConnector (object):
+    """
+    Connects to many targets with a concurrency cap, jittered starts and a
+    per-host circuit breaker.
+
+    After C{breaker_threshold} consecutive failures of a host with one of
+    C{breaker_errors}, its targets fail with L{CircuitOpenException} without
+    connecting for C{breaker_timeout} seconds.  Then a single target is let
+    through as a probe while the others keep failing fast: its success closes
+    the circuit, another failure opens it again.  The state is kept across
+    L{run} calls.
+
+    @cvar breaker_errors: exceptions counted as failures of a host
+    """
+
+    breaker_errors = (BadHostKeyException, SSHRemoteErrorException)
+
+    def __init__(self, sshclient, concurrency=50, stagger=0.5, breaker_threshold=3, breaker_timeout=60.0,
+                 clock=time.time, random=random.random):
+        """
+        @param sshclient: client whose L{SSHClient.open_connection} is used
+        @type sshclient: L{SSHClient}
+        @param concurrency: maximum number of targets handled at once
+        @type concurrency: C{int}
+        @param stagger: maximum random delay in seconds before each connect
+        @type stagger: C{float}
+        @param breaker_threshold: consecutive failures opening the circuit
+        @type breaker_threshold: C{int}
+        @param breaker_timeout: seconds targets of a failing host are skipped
+        @type breaker_timeout: C{float}
+        @param clock: function returning the current time
+        @param random: function returning a random float in [0, 1)
+        """
+        self.sshclient = sshclient
+        self.reactor = sshclient.reactor
+        self.concurrency = concurrency
+        self.stagger = stagger
+        self.breaker_threshold = breaker_threshold
+        self.breaker_timeout = breaker_timeout
+        self.clock = clock
+        self.random = random
+        # hostname -> [consecutive failures, open until, probe running]
+        self._breakers = {}
+        self.running = 0
+
+    def run(self, targets, action=None, on_result=None):
+        """
+        Connect to every target.
+
+        @param targets: hostnames, or dicts of L{SSHClient.open_connection}
+            keyword arguments including C{hostname}; may be a generator, it's
+            consumed as targets are started
+        @param action: called with the target and its L{SSHConnection};
+            its result - or the result of the L{Deferred} it returns - is the
+            result of the target, the connection is closed afterwards.  Without
+            C{action} the result is the connection, left open
+        @param on_result: called with the target, a success flag and the
+            result or L{failure.Failure}, as soon as the target completes
+        @return: L{Deferred} fired with counts of C{succeeded}, C{failed} and
+            C{skipped} targets once all targets completed
+        """
+        stats = {'succeeded': 0, 'failed': 0, 'skipped': 0}
+        work = (self._runTarget(target, action, on_result, stats) for target in targets)
+        cooperator = task.Cooperator(scheduler=lambda f: self.reactor.callLater(0, f))
+        tasks = [cooperator.cooperate(work).whenDone() for i in xrange(self.concurrency)]
+        d = defer.DeferredList(tasks, fireOnOneErrback=True, consumeErrors=True)
+        d.addCallback(lambda ignored: stats)
+        return d
+
+    def _runTarget(self, target, action, on_result, stats):
+        """ Returns L{Deferred} fired when C{target} completed, C{None} if it was skipped """
+        if isinstance(target, dict):
+            kwargs = dict(target)
+        else:
+            kwargs = {'hostname': target}
+        hostname = kwargs['hostname']
+
+        until = self.circuit_open(hostname)
+        if until:
+            stats['skipped'] += 1
+            self._report(on_result, target, False, failure.Failure(CircuitOpenException(hostname, until)))
+            return None
+        breaker = self._breakers.get(hostname)
+        probe = breaker is not None and breaker[2]
+
+        self.running += 1
+        d = task.deferLater(self.reactor, self.random() * self.stagger, self.sshclient.open_connection, **kwargs)
+        if action is not None:
+            d.addCallback(self._runAction, target, action)
+        d.addCallbacks(self._succeeded, self._failed, callbackArgs=(target, hostname, on_result, stats),
+                       errbackArgs=(target, hostname, on_result, stats, probe))
+        return d
+
+    def _runAction(self, sshconnection, target, action):
+        d = defer.maybeDeferred(action, target, sshconnection)
+
+        def close(result):
+            sshconnection.loseConnection()
+            return result
+        return d.addBoth(close)
+
+    def _succeeded(self, result, target, hostname, on_result, stats):
+        self.running -= 1
+        stats['succeeded'] += 1
+        self._breakers.pop(hostname, None)
+        self._report(on_result, target, True, result)
+
+    def _failed(self, reason, target, hostname, on_result, stats, probe):
+        self.running -= 1
+        stats['failed'] += 1
+        if probe and hostname in self._breakers:
+            # another target probes if this failure doesn't count
+            self._breakers[hostname][2] = False
+        if reason.check(*self.breaker_errors):
+            breaker = self._breakers.setdefault(hostname, [0, None, False])
+            breaker[0] += 1
+            if breaker[0] >= self.breaker_threshold:
+                breaker[1] = self.clock() + self.breaker_timeout
+                log.msg('Skipping %s for %d seconds after %d failures' % (hostname, self.breaker_timeout, breaker[0]))
+        self._report(on_result, target, False, reason)
+
+    def _report(self, on_result, target, success, result):
+        if on_result is None:
+            return
+        try:
+            on_result(target, success, result)
+        except Exception:
+            log.err(None, 'Error reporting result of %r' % (target,))
+
+    def circuit_open(self, hostname):
+        """
+        Once the circuit of C{hostname} timed out, the first call lets its
+        target through as the probe and further calls skip targets until
+        the probe completed.
+
+        @return: time until which targets of C{hostname} are skipped, or
+            C{None} if they are connected
+        @rtype: C{float}
+        """
+        breaker = self._breakers.get(hostname)
+        if breaker is None or breaker[1] is None:
+            return None
+        if self.clock() >= breaker[1] and not breaker[2]:
+            # half open: the probe's failure opens the circuit again
+            breaker[2] = True
+            return None
+        return breaker[1]
+
+    def reset(self, hostname=None):
+        """ Close the circuit of C{hostname}, or of all hosts """
+        if hostname is None:
+            self._breakers.clear()
+        else:
+            self._breakers.pop(hostname, None)
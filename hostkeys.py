@@ -20,25 +20,303 @@
 L{HostKeys}
 """
 
-import base64, os
+import base64, binascii, hashlib, mmap, os, re, sqlite3, struct
 from Crypto.Hash import SHA, HMAC
 import UserDict
 
 from twisted.conch.ssh import keys
+from twisted.internet import defer, task, threads
+from twisted.python import log
 from twisted.python.randbytes import secureRandom
 
+from caches import LRUCache
 
-class HostKeyEntry:
+
+# OpenSSH key type names as reported by L{keys.Key.type}
+SSH_KEY_TYPES = {
+    'ssh-rsa': 'RSA',
+    'ssh-dss': 'DSA',
+    'ecdsa-sha2-nistp256': 'EC',
+    'ecdsa-sha2-nistp384': 'EC',
+    'ecdsa-sha2-nistp521': 'EC',
+    'ssh-ed25519': 'Ed25519',
+}
+
+
+# markers allowed in front of a known_hosts line
+MARKERS = ('cert-authority', 'revoked')
+
+
+def split_line(line):
+    """
+    Split a known_hosts line into its fields.
+
+    @param line: a line from an OpenSSH known_hosts file, without comments
+        or surrounding whitespace
+    @type line: str
+    @return: C{(marker, hostnames, keytype, base64 key)}, where marker is
+        C{None} or one of L{MARKERS}, or C{None} for a malformed line
+    @rtype: tuple
+    """
+    fields = line.split(' ')
+    marker = None
+    if fields[0].startswith('@'):
+        marker = fields.pop(0)[1:]
+        if marker not in MARKERS:
+            return None
+    if len(fields) < 3:
+        # Bad number of fields
+        return None
+    return marker, fields[0], fields[1], fields[2]
+
+
+def is_host_pattern(hostname):
+    """
+    @return: C{True} if C{hostname} contains C{*} or C{?} wildcards
+    @rtype: bool
+    """
+    return ('*' in hostname) or ('?' in hostname)
+
+
+def pattern_regex(pattern):
+    """
+    Translate an OpenSSH host pattern into a regular expression.  Only C{*}
+    and C{?} are special, unlike in L{fnmatch}.
+
+    @rtype: str
+    """
+    parts = []
+    for c in pattern:
+        if c == '*':
+            parts.append('.*')
+        elif c == '?':
+            parts.append('.')
+        else:
+            parts.append(re.escape(c))
+    return ''.join(parts)
+
+
+class HostPatternMatcher (object):
+    """
+    Wildcard host patterns of many entries compiled into one matcher.
+
+    Patterns of the form C{*suffix} (such as C{*.example.com}) are kept in a
+    dict keyed by suffix and matched with one dict lookup per suffix of the
+    hostname.  All other patterns are joined into a single regular
+    expression rejecting non-matching hostnames in one call; only when it
+    matches are the patterns tried one by one.
+    """
+
+    def __init__(self):
+        # suffix -> [value]
+        self._suffixes = {}
+        # pattern -> (compiled pattern, [value])
+        self._patterns = {}
+        self._combined = None
+
+    def __len__(self):
+        return len(self._suffixes) + len(self._patterns)
+
+    def add(self, pattern, value):
+        """ Make C{hostname}s matching C{pattern} return C{value}. """
+        suffix = pattern[1:]
+        if pattern.startswith('*') and not is_host_pattern(suffix):
+            self._suffixes.setdefault(suffix, []).append(value)
+            return
+        if pattern not in self._patterns:
+            self._patterns[pattern] = (re.compile(pattern_regex(pattern) + '$'), [])
+            self._combined = None
+        self._patterns[pattern][1].append(value)
+
+    def match(self, hostname):
+        """
+        @return: values of all patterns matching C{hostname}
+        @rtype: list
+        """
+        found = []
+        if self._suffixes:
+            suffixes = self._suffixes
+            for i in xrange(len(hostname) + 1):
+                values = suffixes.get(hostname[i:])
+                if values:
+                    found.extend(values)
+        if self._patterns:
+            if self._combined is None:
+                self._combined = re.compile('(?:%s)$' % '|'.join(
+                    [pattern_regex(pattern) for pattern in self._patterns]))
+            if self._combined.match(hostname):
+                for regex, values in self._patterns.itervalues():
+                    if regex.match(hostname):
+                        found.extend(values)
+        return found
+
+
+class HashedHostMatcher (object):
+    """
+    Hashed hostnames (C{|1|salt|hmac}) of many entries grouped by salt.
+
+    OpenSSH hashes every line with its own random salt, so a lookup still
+    computes one HMAC-SHA1 per salt.  The SHA-1 states after the inner and
+    outer pads of each salt are computed once, when the name is added; a
+    lookup copies and updates them instead of running a full HMAC.
+    """
+
+    # HMAC pads of the 64 byte SHA-1 block, see RFC 2104
+    _inner_pad = ''.join([chr(x ^ 0x36) for x in xrange(256)])
+    _outer_pad = ''.join([chr(x ^ 0x5C) for x in xrange(256)])
+
+    def __init__(self):
+        # salt -> (inner sha1 state, outer sha1 state, { hmac digest: [value] })
+        self._salts = {}
+
+    def __len__(self):
+        return len(self._salts)
+
+    def add(self, salt, digest, value):
+        """ Make hostnames whose HMAC keyed with C{salt} is C{digest} return C{value}. """
+        try:
+            digests = self._salts[salt][2]
+        except KeyError:
+            key = salt
+            if len(key) > 64:
+                key = hashlib.sha1(key).digest()
+            key = key.ljust(64, '\0')
+            digests = {}
+            self._salts[salt] = (hashlib.sha1(key.translate(self._inner_pad)),
+                                 hashlib.sha1(key.translate(self._outer_pad)), digests)
+        digests.setdefault(digest, []).append(value)
+
+    def match(self, hostname):
+        """
+        @return: values of all hashed names of C{hostname}
+        @rtype: list
+        """
+        found = []
+        for inner, outer, digests in self._salts.itervalues():
+            inner = inner.copy()
+            inner.update(hostname)
+            outer = outer.copy()
+            outer.update(inner.digest())
+            values = digests.get(outer.digest())
+            if values:
+                found.extend(values)
+        return found
+
+
+def compile_negations(patterns):
+    """
+    @param patterns: negated host patterns, without their leading C{!}
+    @type patterns: list(str)
+    @return: a compiled expression matching any of C{patterns}
+    """
+    return re.compile('(?:%s)$' % '|'.join([pattern_regex(pattern) for pattern in patterns]))
+
+
+def split_hashed_host(hostname):
+    """
+    Split a hashed known_hosts hostname (C{|1|salt|hmac}) into its raw salt
+    and HMAC digest.
+
+    @return: C{(salt, digest)}, or C{None} if C{hostname} isn't hashed
+    @rtype: tuple(str, str)
+    """
+    if not hostname.startswith('|1|'):
+        return None
+    try:
+        salt, digest = hostname.split('|')[2:4]
+        return base64.decodestring(salt), base64.decodestring(digest)
+    except (ValueError, binascii.Error):
+        return None
+
+
+def write_lines(filename, lines, append=True, sync=True):
+    """
+    Write C{lines} to C{filename} in a single write.  When not appending, the
+    lines go to a temporary file renamed over C{filename}, so readers never
+    see a partial file.
+
+    @param filename: file to write
+    @type filename: str
+    @param lines: lines to write, with trailing newlines
+    @type lines: list(str)
+    @param append: append to the file instead of replacing it
+    @type append: bool
+    @param sync: C{fsync} the file before returning
+    @type sync: bool
+
+    @raise IOError: if there was an error writing the file
+    """
+    if append:
+        target = filename
+    else:
+        target = '%s.%d.tmp' % (filename, os.getpid())
+    f = open(target, append and 'a' or 'w')
+    try:
+        f.write(''.join(lines))
+        f.flush()
+        if sync:
+            os.fsync(f.fileno())
+    finally:
+        f.close()
+    if not append:
+        os.rename(target, filename)
+
+
+class HostKeyEntry (object):
     """
     Representation of a line in an OpenSSH-style "known hosts" file.
+
+    The key can be kept as its raw base64 blob, in which case it is only
+    parsed into a L{keys.Key} the first time C{key} is read.  C{order} is
+    the position of the entry in its L{HostKeys}, C{rowid} its row in a
+    L{HostKeyDatabase}.  C{marker} is C{None} or one of L{MARKERS}
+    (C{"cert-authority"}, C{"revoked"}).
     """
 
-    def __init__(self, hostnames=None, key=None):
-        self.valid = (hostnames is not None) and (key is not None)
+    __slots__ = ('hostnames', 'order', 'rowid', 'marker', '_key', '_blob', '_keytype')
+
+    def __init__(self, hostnames=None, key=None, keytype=None, blob=None, marker=None):
         self.hostnames = hostnames
-        self.key = key
+        self.order = 0
+        self.rowid = None
+        self.marker = marker
+        self._key = key
+        self._blob = blob
+        if keytype is None and key is not None:
+            keytype = key.type()
+        self._keytype = keytype
+
+    def _get_key(self):
+        if self._blob is not None:
+            blob, self._blob = self._blob, None
+            try:
+                self._key = keys.Key.fromString(base64.decodestring(blob))
+            except Exception, e:
+                self._key = None
+        return self._key
 
-    def from_line(cls, line):
+    def _set_key(self, key):
+        self._blob = None
+        self._key = key
+        self._keytype = (key is not None and key.type()) or None
+
+    key = property(_get_key, _set_key)
+
+    def _get_keytype(self):
+        if self._keytype is None and self._blob is not None:
+            # unknown key type name, the key has to be decoded to tell
+            key = self.key
+            self._keytype = (key is not None and key.type()) or None
+        return self._keytype
+
+    keytype = property(_get_keytype)
+
+    def _get_valid(self):
+        return (self.hostnames is not None) and (self.key is not None)
+
+    valid = property(_get_valid)
+
+    def from_line(cls, line, lazy=False):
         """
         Parses the given line of text to find the names for the host,
         the type of key, and the key data. The line is expected to be in the
@@ -50,36 +328,110 @@ class HostKeyEntry:
 
         @param line: a line from an OpenSSH known_hosts file
         @type line: str
+        @param lazy: keep the key as raw base64 data and decode it on first
+            use; an undecodable key then makes the entry invalid instead of
+            being skipped here
+        @type lazy: bool
         """
-        fields = line.split(' ')
-        if len(fields) < 3:
-            # Bad number of fields
+        fields = split_line(line)
+        if fields is None:
             return None
-        fields = fields[:3]
 
-        names, keytype, key = fields
+        marker, names, keytype, key = fields
         names = names.split(',')
+        if lazy:
+            return cls(names, keytype=SSH_KEY_TYPES.get(keytype), blob=key, marker=marker)
         try:
             key = keys.Key.fromString(base64.decodestring(key))
         except Exception, e:
             return None
 
-        return cls(names, key)
+        return cls(names, key, marker=marker)
     from_line = classmethod(from_line)
 
-    # def to_line(self):
-    #     """
-    #     Returns a string in OpenSSH known_hosts file format, or None if
-    #     the object is not in a valid state.  A trailing newline is
-    #     included.
-    #     """
-    #     if self.valid:
-    #         return '%s %s %s\n' % (','.join(self.hostnames), self.key.type(),
-    #                self.key.get_base64())
-    #     return None
-    # 
-    # def __repr__(self):
-    #     return '<HostKeyEntry %r: %r>' % (self.hostnames, self.key)
+    def blob(self):
+        """
+        @return: the raw key data, without decoding the key
+        @rtype: str
+        """
+        if self._blob is not None:
+            return base64.decodestring(self._blob)
+        if self._key is not None:
+            return self._key.blob()
+        return None
+
+    def to_line(self):
+        """
+        Returns a string in OpenSSH known_hosts file format, or None if
+        the object is not in a valid state.  A trailing newline is
+        included.  A key still held as raw base64 data is written as is.
+        """
+        if self.hostnames is None:
+            return None
+        prefix = (self.marker and '@%s ' % self.marker) or ''
+        if self._blob is not None:
+            try:
+                data = base64.decodestring(self._blob)
+                sshtype = data[4:4 + struct.unpack('>L', data[:4])[0]]
+            except (struct.error, binascii.Error):
+                return None
+            return '%s%s %s %s\n' % (prefix, ','.join(self.hostnames), sshtype, self._blob)
+        if self._key is None:
+            return None
+        return '%s%s %s %s\n' % (prefix, ','.join(self.hostnames), self._key.sshType(),
+               base64.b64encode(self._key.blob()))
+
+    def __repr__(self):
+        return '<HostKeyEntry %r: %r>' % (self.hostnames, self.key)
+
+
+class HostKeysLookup (UserDict.DictMixin, object):
+    """
+    Keys of a single host, as returned by L{HostKeys.lookup}: a dict of
+    keytype to key.  Setting a keytype replaces or adds the key in the
+    L{HostKeys} it came from.
+    """
+
+    __slots__ = ('_hostname', '_entries', '_hostkeys')
+
+    def __init__(self, hostname, entries, hostkeys):
+        self._hostname = hostname
+        # shared with the lookup cache of hostkeys, never changed in place
+        self._entries = entries
+        self._hostkeys = hostkeys
+
+    def __getitem__(self, key):
+        for e in self._entries:
+            if e.keytype == key and e.key is not None:
+                return e.key
+        raise KeyError(key)
+
+    def get_all(self, key):
+        """
+        @return: keys of type C{key} of all matching entries, in table
+            order; a host matched by several lines, e.g. a wildcard and
+            its own name, may have several keys of a type
+        @rtype: list(L{keys.Key})
+        """
+        return [e.key for e in self._entries if e.keytype == key and e.key is not None]
+
+    def __setitem__(self, key, val):
+        for e in self._entries:
+            if e.keytype is None:
+                continue
+            if e.keytype == key:
+                # replace
+                e.key = val
+                self._hostkeys._entry_changed(e)
+                break
+        else:
+            # add a new one
+            e = HostKeyEntry([self._hostname], val)
+            self._entries = self._entries + [e]
+            self._hostkeys._add_entry(e)
+
+    def keys(self):
+        return [e.keytype for e in self._entries if e.keytype is not None]
 
 
 class HostKeys (UserDict.DictMixin):
@@ -91,9 +443,20 @@ class HostKeys (UserDict.DictMixin):
     A HostKeys object can be treated like a dict; any dict lookup is equivalent
     to calling L{lookup}.
 
+    Host patterns with C{*}/C{?} wildcards and C{!} negations are compiled
+    into a L{HostPatternMatcher} as they are loaded.  Keys of C{@revoked}
+    lines are kept in a set checked by L{is_revoked}; C{@cert-authority}
+    lines are kept (and saved) but never returned by L{lookup}, since host
+    certificates aren't verified.
+
     @since: 1.5.3
+
+    @cvar lookup_cache_size: maximum number of hostnames kept in the lookup
+        result cache before it is emptied
     """
 
+    lookup_cache_size = 4096
+
     def __init__(self, filename=None):
         """
         Create a new HostKeys object, optionally loading keys from an openssh
@@ -104,6 +467,24 @@ class HostKeys (UserDict.DictMixin):
         """
         # emulate a dict of { hostname: { keytype: PKey } }
         self._entries = []
+        # hostname -> [HostKeyEntry]
+        self._plain = {}
+        # hashed hostnames -> HostKeyEntry
+        self._hashed = HashedHostMatcher()
+        # wildcard patterns -> HostKeyEntry
+        self._patterns = HostPatternMatcher()
+        # HostKeyEntry -> compiled negated patterns
+        self._negations = {}
+        # raw blobs of @revoked keys
+        self._revoked = set()
+        # hostname -> [HostKeyEntry] or None, dropped on every change
+        self._lookup_cache = {}
+        # bumped on every change, see L{caches.HostKeyVerificationCache}
+        self.generation = 0
+        self.writer = None
+        # [(seq, HostKeyIndex)] of files loaded through their compiled index
+        self._sources = []
+        self._seq = 0
         if filename is not None:
             self.load(filename)
 
@@ -119,13 +500,80 @@ class HostKeys (UserDict.DictMixin):
         @param key: the key to add
         @type key: L{PKey}
         """
-        for e in self._entries:
-            if (hostname in e.hostnames) and (e.key.type() == keytype):
+        for e in self._plain_entries(hostname):
+            if e.keytype == keytype:
                 e.key = key
+                self._entry_changed(e)
                 return
-        self._entries.append(HostKeyEntry([hostname], key))
+        self._add_entry(HostKeyEntry([hostname], key))
+
+    def _plain_entries(self, hostname):
+        """ Yields entries listing C{hostname} in clear text, in memory and in indexes. """
+        for e in self._plain.get(hostname, ()):
+            yield e
+        for seq, source in self._sources:
+            for rowid, e in source.find(hostname, hashed=False):
+                yield e
 
-    def load(self, filename):
+    def _add_entry(self, entry):
+        """
+        Append C{entry} to the table and to the hostname indexes.
+
+        @param entry: the entry to add
+        @type entry: L{HostKeyEntry}
+        """
+        self._entries.append(entry)
+        self._index_entry(entry)
+        self._invalidate()
+        if self.writer is not None:
+            self.writer.append(entry)
+
+    def _index_entry(self, entry):
+        """
+        Index C{entry} by plain hostname and by salt for hashed hostnames.
+        Entry order is kept in C{entry.order}, so lookup results are
+        returned in the order the entries were added.
+        """
+        entry.order = self._seq
+        self._seq += 1
+        if entry.marker == 'revoked':
+            try:
+                blob = entry.blob()
+            except binascii.Error:
+                blob = None
+            if blob:
+                self._revoked.add(blob)
+            return
+        if entry.marker is not None:
+            # cert-authority keys only sign host certificates
+            return
+        negations = []
+        for h in entry.hostnames:
+            if h.startswith('!'):
+                negations.append(h[1:])
+            elif h.startswith('|1|'):
+                hashed = split_hashed_host(h)
+                if hashed is not None:
+                    self._hashed.add(hashed[0], hashed[1], entry)
+            elif is_host_pattern(h):
+                self._patterns.add(h, entry)
+            else:
+                self._plain.setdefault(h, []).append(entry)
+        if negations:
+            self._negations[entry] = compile_negations(negations)
+
+    def _entry_changed(self, entry):
+        """ Called after the key of an existing C{entry} was replaced. """
+        self._invalidate()
+        if self.writer is not None:
+            self.writer.rewrite()
+
+    def _invalidate(self):
+        """ Drops cached lookup results, called on every change of the table. """
+        self._lookup_cache.clear()
+        self.generation += 1
+
+    def load(self, filename, lazy=False, index=False):
         """
         Read a file of known SSH host keys, in the format used by openssh.
         This type of file unfortunately doesn't exist on Windows, but on
@@ -136,41 +584,103 @@ class HostKeys (UserDict.DictMixin):
         not cleared.  So multiple calls to C{load} will just call L{add},
         replacing any existing entries and adding new ones.
 
+        With C{lazy} set the file is memory-mapped and only the host field
+        and the base64 key data of each line are kept; keys are parsed when
+        a lookup first needs them.
+
+        With C{index} set the file is not read into memory at all; it is
+        compiled into a L{HostKeyIndex} next to it (rebuilt only when the file
+        changed) and lookups query that index.  If the index can't be used,
+        for example because the directory isn't writable, the file is loaded
+        as usual.
+
         @param filename: name of the file to read host keys from
         @type filename: str
+        @param lazy: defer decoding of keys until they are used
+        @type lazy: bool
+        @param index: use a compiled on-disk index of the file
+        @type index: bool
 
         @raise IOError: if there was an error reading the file
         """
+        if index:
+            source = HostKeyIndex(filename)
+            try:
+                source.open()
+            except (EnvironmentError, sqlite3.Error), e:
+                source.close()
+            else:
+                self.attach(source)
+                return
+
         f = open(filename, 'r')
-        for line in f:
+        try:
+            data = None
+            if lazy:
+                try:
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except (ValueError, EnvironmentError):
+                    # empty or unmappable file, fall back to plain reads
+                    data = None
+            if data is not None:
+                try:
+                    self._load_lines(iter(data.readline, ''), lazy)
+                finally:
+                    data.close()
+            else:
+                self._load_lines(f, lazy)
+        finally:
+            f.close()
+        self._invalidate()
+
+    def _load_lines(self, lines, lazy):
+        """ Parses known_hosts C{lines} into entries. """
+        from_line = HostKeyEntry.from_line
+        for line in lines:
             line = line.strip()
             if (len(line) == 0) or (line[0] == '#'):
                 continue
-            e = HostKeyEntry.from_line(line)
+            e = from_line(line, lazy)
             if e is not None:
                 self._entries.append(e)
-        f.close()
+                self._index_entry(e)
+
+    def save(self, filename):
+        """
+        Save host keys into a file, in the format used by openssh.  The order of
+        keys in the file will be preserved when possible (if these keys were
+        loaded from a file originally).  The file is written to a temporary
+        file first and renamed over C{filename}.
+
+        @param filename: name of the file to write
+        @type filename: str
+
+        @raise IOError: if there was an error writing the file
+
+        @since: 1.6.1
+        """
+        write_lines(filename, self.to_lines(), append=False)
+
+    def to_lines(self):
+        """
+        @return: all entries in OpenSSH known_hosts format
+        @rtype: list(str)
+        """
+        lines = []
+        for e in self._iter_entries():
+            line = e.to_line()
+            if line:
+                lines.append(line)
+        return lines
+
+    def set_writer(self, writer):
+        """
+        Set a L{HostKeysWriter} persisting entries added or changed from now
+        on, or C{None} to stop persisting them.
 
-    # def save(self, filename):
-    #     """
-    #     Save host keys into a file, in the format used by openssh.  The order of
-    #     keys in the file will be preserved when possible (if these keys were
-    #     loaded from a file originally).  The single exception is that combined
-    #     lines will be split into individual key lines, which is arguably a bug.
-    # 
-    #     @param filename: name of the file to write
-    #     @type filename: str
-    # 
-    #     @raise IOError: if there was an error writing the file
-    # 
-    #     @since: 1.6.1
-    #     """
-    #     f = open(filename, 'w')
-    #     for e in self._entries:
-    #         line = e.to_line()
-    #         if line:
-    #             f.write(line)
-    #     f.close()
+        @type writer: L{HostKeysWriter}
+        """
+        self.writer = writer
 
     def lookup(self, hostname):
         """
@@ -181,50 +691,80 @@ class HostKeys (UserDict.DictMixin):
         @param hostname: the hostname (or IP) to lookup
         @type hostname: str
         @return: keys associated with this host (or C{None})
-        @rtype: dict(str, L{PKey})
-        """
-        class SubDict (UserDict.DictMixin):
-            def __init__(self, hostname, entries, hostkeys):
-                self._hostname = hostname
-                self._entries = entries
-                self._hostkeys = hostkeys
-
-            def __getitem__(self, key):
-                for e in self._entries:
-                    if e.key.type() == key:
-                        return e.key
-                raise KeyError(key)
-
-            def __setitem__(self, key, val):
-                for e in self._entries:
-                    if e.key is None:
-                        continue
-                    if e.key.type() == key:
-                        # replace
-                        e.key = val
-                        break
-                else:
-                    # add a new one
-                    e = HostKeyEntry([hostname], val)
-                    self._entries.append(e)
-                    self._hostkeys._entries.append(e)
-
-            def keys(self):
-                return [e.key.type() for e in self._entries if e.key is not None]
+        @rtype: L{HostKeysLookup}
+        """
+        try:
+            entries = self._lookup_cache[hostname]
+        except KeyError:
+            if len(self._lookup_cache) >= self.lookup_cache_size:
+                self._lookup_cache.clear()
+            entries = self._lookup_cache[hostname] = self._find_entries(hostname)
+        if entries is None:
+            return None
+        return HostKeysLookup(hostname, entries, self)
 
-        entries = []
-        for e in self._entries:
-            for h in e.hostnames:
-                if (h.startswith('|1|') and (self.hash_host(hostname, h) == h)) or (h == hostname):
-                    entries.append(e)
-        if len(entries) == 0:
+    def _find_entries(self, hostname):
+        """
+        Collect entries matching C{hostname} from the plain and hashed
+        indexes.  Hashed names cost one HMAC per salt, see
+        L{HashedHostMatcher}.
+
+        @return: matching entries in table order, or C{None}
+        @rtype: list(L{HostKeyEntry})
+        """
+        found = [((e.order, 0), e) for e in self._plain.get(hostname, ())]
+        if len(self._hashed):
+            found.extend([((e.order, 0), e) for e in self._hashed.match(hostname)])
+        if len(self._patterns):
+            found.extend([((e.order, 0), e) for e in self._patterns.match(hostname)])
+        if self._negations:
+            negations = self._negations
+            found = [item for item in found if item[1] not in negations or not negations[item[1]].match(hostname)]
+        for seq, source in self._sources:
+            found.extend([((seq, rowid), e) for rowid, e in source.find(hostname)])
+        if len(found) == 0:
             return None
-        return SubDict(hostname, entries, self)
+        found.sort(key=lambda item: item[0])
+        entries = []
+        for order, e in found:
+            if not entries or entries[-1] is not e:
+                entries.append(e)
+        return entries
+
+    def is_revoked(self, blob):
+        """
+        Return True if the key is marked C{@revoked}.
+
+        @param blob: raw key data, as sent by the server
+        @type blob: str
+        @rtype: bool
+        """
+        if blob in self._revoked:
+            return True
+        for seq, source in self._sources:
+            if source.is_revoked(blob):
+                return True
+        return False
+
+    def get_keys(self, hostname, keytype):
+        """
+        Find all keys of C{keytype} of entries matching C{hostname}.
+
+        @param hostname: the hostname (or IP) to lookup
+        @type hostname: str
+        @param keytype: key type as returned by L{keys.Key.type}
+        @type keytype: str
+        @rtype: list(L{keys.Key})
+        """
+        k = self.lookup(hostname)
+        if k is None:
+            return []
+        return k.get_all(keytype)
 
     def check(self, hostname, key):
         """
         Return True if the given key is associated with the given hostname
-        in this dictionary.
+        in this dictionary, by any of the entries matching it.
 
         @param hostname: hostname (or IP) of the SSH server
         @type hostname: str
@@ -234,19 +774,27 @@ class HostKeys (UserDict.DictMixin):
             if not
         @rtype: bool
         """
-        k = self.lookup(hostname)
-        if k is None:
+        if self.is_revoked(key.blob()):
             return False
-        host_key = k.get(key.type(), None)
-        if host_key is None:
-            return False
-        return str(host_key) == str(key)
+        for host_key in self.get_keys(hostname, key.type()):
+            if str(host_key) == str(key):
+                return True
+        return False
 
     def clear(self):
         """
         Remove all host keys from the dictionary.
         """
         self._entries = []
+        self._plain = {}
+        self._hashed = HashedHostMatcher()
+        self._patterns = HostPatternMatcher()
+        self._negations = {}
+        self._revoked = set()
+        for seq, source in self._sources:
+            source.close()
+        self._sources = []
+        self._invalidate()
 
     def __getitem__(self, key):
         ret = self.lookup(key)
@@ -257,27 +805,86 @@ class HostKeys (UserDict.DictMixin):
     def __setitem__(self, hostname, entry):
         # don't use this please.
         if len(entry) == 0:
-            self._entries.append(HostKeyEntry([hostname], None))
+            self._add_entry(HostKeyEntry([hostname], None))
             return
         for key_type in entry.keys():
             found = False
-            for e in self._entries:
-                if (hostname in e.hostnames) and (e.key.type() == key_type):
+            for e in self._plain_entries(hostname):
+                if e.keytype == key_type:
                     # replace
                     e.key = entry[key_type]
                     found = True
+                    self._entry_changed(e)
             if not found:
-                self._entries.append(HostKeyEntry([hostname], entry[key_type]))
+                self._add_entry(HostKeyEntry([hostname], entry[key_type]))
 
     def keys(self):
         # python 2.4 sets would be nice here.
         ret = []
-        for e in self._entries:
+        seen = set()
+        for e in self._iter_entries():
             for h in e.hostnames:
-                if h not in ret:
+                if h not in seen:
+                    seen.add(h)
                     ret.append(h)
         return ret
 
+    def _iter_entries(self):
+        """ Yields all entries, the ones held in memory first, then indexed ones. """
+        for e in self._entries:
+            yield e
+        for seq, source in self._sources:
+            for rowid, e in source.entries():
+                yield e
+
+    def attach(self, source):
+        """
+        Attach a source of entries, looked up after the entries already
+        loaded.  A source is a L{HostKeyIndex}, a L{HostKeyDatabase} or
+        another L{HostKeys} object; L{find}, L{entries}, L{is_revoked} and
+        L{close} are called on it.
+        """
+        self._sources.append((self._seq, source))
+        self._seq += 1
+        self._invalidate()
+
+    def replace(self, source, new_source):
+        """
+        Swap an attached C{source} for C{new_source} in a single step and
+        close the old one.
+        """
+        for i, (seq, attached) in enumerate(self._sources):
+            if attached is source:
+                self._sources[i] = (seq, new_source)
+                break
+        else:
+            raise ValueError('Source not attached')
+        source.close()
+        self._invalidate()
+
+    def find(self, hostname, hashed=True):
+        """
+        Find entries for C{hostname}, when attached to another L{HostKeys}.
+
+        @param hashed: also match hashed hostnames and patterns
+        @type hashed: bool
+        @return: C{(position, entry)} pairs
+        @rtype: list
+        """
+        if hashed:
+            entries = self._find_entries(hostname) or []
+        else:
+            entries = self._plain_entries(hostname)
+        return list(enumerate(entries))
+
+    def entries(self):
+        """ Yields all C{(position, entry)} pairs, when attached to another L{HostKeys}. """
+        return enumerate(self._iter_entries())
+
+    def close(self):
+        """ Called when detached from another L{HostKeys}. """
+        self.clear()
+
     def values(self):
         ret = []
         for k in self.keys():
@@ -307,3 +914,688 @@ class HostKeys (UserDict.DictMixin):
         hostkey = '|1|%s|%s' % (base64.encodestring(salt), base64.encodestring(hmac))
         return hostkey.replace('\n', '')
     hash_host = staticmethod(hash_host)
+
+
+class HostKeyDatabase (object):
+    """
+    Storage of known_hosts entries in a sqlite database.  Clear text
+    hostnames are indexed by hostname and key type, hashed hostnames by salt
+    and HMAC digest, and keys are stored as raw base64 data, decoded only
+    when an entry's key is used.  Wildcard and negated patterns are read into
+    a L{HostPatternMatcher} on the first lookup, and keys of C{@revoked}
+    lines are indexed by their raw data.
+
+    @cvar entry_cache_size: number of entries read from the database kept
+        in memory, so looking up the same hosts again doesn't decode their
+        keys again
+    """
+
+    entry_cache_size = 1024
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS entries (id INTEGER PRIMARY KEY, marker TEXT, hostnames TEXT, keytype TEXT, blob TEXT);
+        CREATE TABLE IF NOT EXISTS plain (hostname TEXT, keytype TEXT, entry INTEGER);
+        CREATE TABLE IF NOT EXISTS hashed (salt BLOB, digest BLOB, entry INTEGER);
+        CREATE TABLE IF NOT EXISTS patterns (pattern TEXT, negated INTEGER, entry INTEGER);
+        CREATE TABLE IF NOT EXISTS revoked (blob BLOB PRIMARY KEY);
+        CREATE INDEX IF NOT EXISTS plain_hostname ON plain (hostname, keytype);
+        CREATE INDEX IF NOT EXISTS entries_keytype ON entries (keytype);
+    """
+
+    def __init__(self, db=None):
+        """
+        @param db: connection to the database
+        @type db: L{sqlite3.Connection}
+        """
+        self._db = db
+        # hashed hostnames -> rowid, read on the first hashed lookup
+        self._hashed = None
+        # wildcard patterns -> rowid, read with the hashed names
+        self._patterns = None
+        # rowid -> [negated pattern]
+        self._negations = None
+        # rowid -> recently used HostKeyEntry; changes are written to the
+        # database by update, so evicted entries are read back changed
+        self._entries = LRUCache(self.entry_cache_size)
+
+    def create(self):
+        """ Create missing tables and indexes. """
+        self._db.executescript(self.schema)
+
+    def close(self):
+        """ Closes the database. """
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+        self._forget()
+
+    def _forget(self):
+        self._hashed = None
+        self._patterns = None
+        self._negations = None
+        self._entries.clear()
+
+    def insert(self, line):
+        """
+        Insert a line in OpenSSH known_hosts format, without comments or
+        surrounding whitespace.
+
+        @return: row id of the new entry, or C{None} for a malformed line
+        @rtype: C{int}
+        """
+        fields = split_line(line)
+        if fields is None:
+            return None
+        marker, names, keytype, blob = fields
+        execute = self._db.execute
+        rowid = execute('INSERT INTO entries (marker, hostnames, keytype, blob) VALUES (?, ?, ?, ?)',
+                        (marker, names, keytype, blob)).lastrowid
+        if marker == 'revoked':
+            try:
+                execute('INSERT OR IGNORE INTO revoked VALUES (?)', (sqlite3.Binary(base64.decodestring(blob)),))
+            except binascii.Error:
+                pass
+            return rowid
+        if marker is not None:
+            # cert-authority keys only sign host certificates
+            return rowid
+        negations = []
+        for h in names.split(','):
+            if h.startswith('!'):
+                execute('INSERT INTO patterns VALUES (?, 1, ?)', (h[1:], rowid))
+                negations.append(h[1:])
+            elif h.startswith('|1|'):
+                hashed = split_hashed_host(h)
+                if hashed is not None:
+                    execute('INSERT INTO hashed VALUES (?, ?, ?)',
+                            (sqlite3.Binary(hashed[0]), sqlite3.Binary(hashed[1]), rowid))
+                    if self._hashed is not None:
+                        self._hashed.add(hashed[0], hashed[1], rowid)
+            elif is_host_pattern(h):
+                execute('INSERT INTO patterns VALUES (?, 0, ?)', (h, rowid))
+                if self._patterns is not None:
+                    self._patterns.add(h, rowid)
+            else:
+                execute('INSERT INTO plain VALUES (?, ?, ?)', (h, keytype, rowid))
+        if negations and self._negations is not None:
+            self._negations[rowid] = compile_negations(negations)
+        return rowid
+
+    def insert_lines(self, lines):
+        """ Insert known_hosts C{lines}, skipping comments and empty lines. """
+        for line in lines:
+            line = line.strip()
+            if (len(line) == 0) or (line[0] == '#'):
+                continue
+            self.insert(line)
+
+    def add(self, entry):
+        """
+        Store C{entry}, which from now on is returned by L{find} for its
+        hostnames.
+
+        @type entry: L{HostKeyEntry}
+        """
+        line = entry.to_line()
+        if line:
+            rowid = self.insert(line.strip())
+            entry.rowid = rowid
+            self._entries[rowid] = entry
+
+    def update(self, entry):
+        """
+        Store the current key of C{entry}, an entry returned by L{find}.
+
+        @type entry: L{HostKeyEntry}
+        """
+        rowid = entry.rowid
+        line = entry.to_line()
+        if rowid is None or not line:
+            return
+        marker, names, keytype, blob = split_line(line.strip())
+        self._db.execute('UPDATE entries SET keytype = ?, blob = ? WHERE id = ?', (keytype, blob, rowid))
+        self._db.execute('UPDATE plain SET keytype = ? WHERE entry = ?', (keytype, rowid))
+
+    def clear(self):
+        """ Remove all entries. """
+        self._db.executescript("""
+            DELETE FROM entries;
+            DELETE FROM plain;
+            DELETE FROM hashed;
+            DELETE FROM patterns;
+            DELETE FROM revoked;
+        """)
+        self._forget()
+
+    def commit(self):
+        self._db.commit()
+
+    def find(self, hostname, hashed=True):
+        """
+        Find entries for C{hostname}.
+
+        @param hostname: the hostname (or IP) to look up
+        @type hostname: str
+        @param hashed: also match hashed hostnames
+        @type hashed: bool
+        @return: C{(rowid, entry)} pairs in insertion order
+        @rtype: list
+        """
+        rowids = set([row[0] for row in self._db.execute('SELECT entry FROM plain WHERE hostname = ?', (hostname,))])
+        if hashed:
+            if self._hashed is None:
+                self._load_matchers()
+            rowids.update(self._hashed.match(hostname))
+            rowids.update(self._patterns.match(hostname))
+            for rowid, patterns in self._negations.iteritems():
+                if rowid in rowids and patterns.match(hostname):
+                    rowids.discard(rowid)
+        return [(rowid, self._entry(rowid)) for rowid in sorted(rowids)]
+
+    def _load_matchers(self):
+        """ Reads hashed hostnames and patterns into memory. """
+        self._hashed = HashedHostMatcher()
+        for salt, digest, rowid in self._db.execute('SELECT salt, digest, entry FROM hashed'):
+            self._hashed.add(str(salt), str(digest), rowid)
+        self._patterns = HostPatternMatcher()
+        negations = {}
+        for pattern, negated, rowid in self._db.execute('SELECT pattern, negated, entry FROM patterns'):
+            if negated:
+                negations.setdefault(rowid, []).append(str(pattern))
+            else:
+                self._patterns.add(str(pattern), rowid)
+        self._negations = dict([(rowid, compile_negations(patterns)) for rowid, patterns in negations.iteritems()])
+
+    def is_revoked(self, blob):
+        """
+        @param blob: raw key data
+        @type blob: str
+        @return: C{True} if the key is marked C{@revoked}
+        @rtype: bool
+        """
+        return self._db.execute('SELECT 1 FROM revoked WHERE blob = ?', (sqlite3.Binary(blob),)).fetchone() is not None
+
+    def entries(self):
+        """
+        Yields all C{(rowid, entry)} pairs in insertion order.  Entries
+        not already cached aren't added to the cache.
+        """
+        cursor = self._db.execute('SELECT id, marker, hostnames, keytype, blob FROM entries ORDER BY id')
+        for row in cursor:
+            e = self._entries.pop(row[0])
+            if e is None:
+                e = self._make_entry(*row)
+            else:
+                self._entries[row[0]] = e
+            yield row[0], e
+
+    def __len__(self):
+        return self._db.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    def _entry(self, rowid):
+        e = self._entries.get(rowid)
+        if e is None:
+            row = self._db.execute('SELECT id, marker, hostnames, keytype, blob FROM entries WHERE id = ?', (rowid,)).fetchone()
+            e = self._entries[rowid] = self._make_entry(*row)
+        return e
+
+    def _make_entry(self, rowid, marker, names, keytype, blob):
+        e = HostKeyEntry(str(names).split(','), keytype=SSH_KEY_TYPES.get(keytype), blob=str(blob),
+                         marker=marker and str(marker))
+        e.rowid = rowid
+        return e
+
+
+class HostKeyIndex (HostKeyDatabase):
+    """
+    Compiled index of an openssh-style "known hosts" file, kept in a
+    L{HostKeyDatabase} next to it (C{<filename>.index}), so opening the index
+    costs the same whatever the size of the source file.
+
+    The index records the C{mtime}, size and inode of the file it was built
+    from and is rebuilt, into a temporary file renamed over the old one, when
+    any of them changed.
+
+    @cvar version: format version, indexes of other versions are rebuilt
+    @cvar suffix: suffix added to the source filename
+    """
+
+    version = 3
+    suffix = '.index'
+
+    def __init__(self, filename, index_filename=None):
+        """
+        @param filename: known_hosts file to index
+        @type filename: str
+        @param index_filename: index file, defaults to C{filename} with
+            L{suffix} appended
+        @type index_filename: str
+        """
+        HostKeyDatabase.__init__(self)
+        self.filename = filename
+        self.index_filename = index_filename or (filename + self.suffix)
+
+    def open(self):
+        """
+        Open the index, building or rebuilding it first if it doesn't match
+        the source file.
+
+        @raise EnvironmentError: if the source file can't be read or the
+            index can't be written
+        @raise sqlite3.Error: on database errors
+        """
+        stamp = self._stamp()
+        db = self._connect(stamp)
+        if db is None:
+            self.build(stamp)
+            db = sqlite3.connect(self.index_filename)
+        self._db = db
+
+    def _stamp(self):
+        st = os.stat(self.filename)
+        return '%s:%r:%d:%d' % (self.version, st.st_mtime, st.st_size, st.st_ino)
+
+    def _connect(self, stamp):
+        """ Returns a connection to the index if it is up to date, otherwise C{None} """
+        if not os.path.exists(self.index_filename):
+            return None
+        db = sqlite3.connect(self.index_filename)
+        try:
+            row = db.execute("SELECT value FROM meta WHERE name = 'stamp'").fetchone()
+        except sqlite3.DatabaseError, e:
+            row = None
+        if row is None or str(row[0]) != stamp:
+            db.close()
+            return None
+        return db
+
+    def build(self, stamp=None):
+        """
+        Compile the source file into the index.  The index is written to a
+        temporary file first and renamed into place, so readers never see a
+        partial index.
+
+        @param stamp: stamp of the source file taken before reading it
+        @type stamp: str
+        """
+        if stamp is None:
+            stamp = self._stamp()
+        tmp_filename = '%s.%d.tmp' % (self.index_filename, os.getpid())
+        if os.path.exists(tmp_filename):
+            os.unlink(tmp_filename)
+        db = HostKeyDatabase(sqlite3.connect(tmp_filename))
+        try:
+            db.create()
+            f = open(self.filename, 'r')
+            try:
+                db.insert_lines(f)
+            finally:
+                f.close()
+            db._db.execute("INSERT INTO meta VALUES ('stamp', ?)", (stamp,))
+            db.commit()
+            db.close()
+            os.rename(tmp_filename, self.index_filename)
+        except:
+            db.close()
+            if os.path.exists(tmp_filename):
+                os.unlink(tmp_filename)
+            raise
+
+
+class SQLiteHostKeys (HostKeys):
+    """
+    L{HostKeys} kept in a local sqlite database instead of in memory, for
+    very large numbers of hosts.  Lookups and additions use the database
+    indexes, so their cost doesn't grow with the number of entries.
+
+    L{load} imports an OpenSSH known_hosts file into the database and
+    L{save} exports the database in the same format.
+    """
+
+    def __init__(self, database, filename=None):
+        """
+        @param database: sqlite database file, created if missing
+            (C{":memory:"} keeps it in memory)
+        @type database: str
+        @param filename: known_hosts file to import, or C{None}
+        @type filename: str
+        """
+        db = sqlite3.connect(database)
+        # one small transaction per added key, don't sync the journal for each
+        db.execute('PRAGMA journal_mode = WAL')
+        db.execute('PRAGMA synchronous = NORMAL')
+        self.database = HostKeyDatabase(db)
+        self.database.create()
+        HostKeys.__init__(self)
+        self._sources.append((0, self.database))
+        self._seq = 1
+        if filename is not None:
+            self.load(filename)
+
+    def _add_entry(self, entry):
+        self.database.add(entry)
+        self.database.commit()
+        self._invalidate()
+        if self.writer is not None:
+            self.writer.append(entry)
+
+    def _entry_changed(self, entry):
+        self.database.update(entry)
+        self.database.commit()
+        HostKeys._entry_changed(self, entry)
+
+    def load(self, filename, lazy=False, index=False):
+        """
+        Import a file of known SSH host keys, in the format used by openssh,
+        into the database.  C{lazy} and C{index} are accepted for
+        compatibility with L{HostKeys.load}; keys are always decoded lazily.
+
+        @param filename: name of the file to import
+        @type filename: str
+
+        @raise IOError: if there was an error reading the file
+        """
+        f = open(filename, 'r')
+        try:
+            self.database.insert_lines(f)
+        finally:
+            f.close()
+        self.database.commit()
+        self._invalidate()
+
+    def clear(self):
+        """
+        Remove all host keys from the database.
+        """
+        self.database.clear()
+        self.database.commit()
+        self._invalidate()
+
+    def close(self):
+        """ Closes the database. """
+        self.database.close()
+
+
+class HostKeysWriter (object):
+    """
+    Write-behind persistence of a L{HostKeys} object.  New entries are
+    buffered and appended to the file in batches, one write and C{fsync}
+    per batch, in the reactor thread pool.  A batch is flushed every
+    C{interval} seconds, or as soon as C{batch_size} entries are pending.
+    When an existing entry changed, the next flush rewrites the whole file
+    instead.
+
+    Pending entries are flushed when the reactor shuts down.
+    """
+
+    def __init__(self, hostkeys, filename, reactor, interval=5.0, batch_size=100):
+        """
+        @param hostkeys: host keys to persist
+        @type hostkeys: L{HostKeys}
+        @param filename: known_hosts file to write
+        @type filename: str
+        @param reactor: reactor to use
+        @type reactor: L{twisted.internet.reactor}
+        @param interval: seconds between flushes
+        @type interval: C{float}
+        @param batch_size: number of pending entries forcing a flush
+        @type batch_size: C{int}
+        """
+        self.hostkeys = hostkeys
+        self.filename = filename
+        self.reactor = reactor
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pending = []
+        self.needs_rewrite = False
+        self.flushes = 0
+        self._lock = defer.DeferredLock()
+        self._loop = None
+        self._shutdown_trigger = None
+
+    def start(self):
+        """ Attach to the host keys and start flushing periodically. """
+        self.hostkeys.set_writer(self)
+        self._loop = task.LoopingCall(self.flush)
+        self._loop.clock = self.reactor
+        self._loop.start(self.interval, now=False)
+        self._shutdown_trigger = self.reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def stop(self):
+        """
+        Detach from the host keys and flush pending entries.
+
+        @return: L{Deferred} fired when pending entries are written
+        """
+        if self.hostkeys.writer is self:
+            self.hostkeys.set_writer(None)
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+        if self._shutdown_trigger is not None:
+            try:
+                self.reactor.removeSystemEventTrigger(self._shutdown_trigger)
+            except (ValueError, KeyError), e:
+                # we are the trigger being run
+                pass
+            self._shutdown_trigger = None
+        return self.flush()
+
+    def append(self, entry):
+        """ Called by L{HostKeys} when C{entry} was added. """
+        line = entry.to_line()
+        if line:
+            self.pending.append(line)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def rewrite(self):
+        """ Called by L{HostKeys} when an existing entry changed. """
+        self.needs_rewrite = True
+
+    def flush(self):
+        """
+        Write pending entries now.
+
+        @return: L{Deferred} fired when they are written
+        """
+        if self.needs_rewrite:
+            lines, append = self.hostkeys.to_lines(), False
+        elif self.pending:
+            lines, append = self.pending, True
+        else:
+            return defer.succeed(None)
+        self.pending = []
+        self.needs_rewrite = False
+        self.flushes += 1
+        d = self._lock.run(threads.deferToThreadPool, self.reactor, self.reactor.getThreadPool(),
+                           write_lines, self.filename, lines, append)
+        d.addErrback(self._flushFailed, lines, append)
+        return d
+
+    def _flushFailed(self, reason, lines, append):
+        log.msg('Unable to save host keys to %s: %s' % (self.filename, reason.getErrorMessage()))
+        if append:
+            # keep them for the next flush
+            self.pending[:0] = lines
+        else:
+            self.needs_rewrite = True
+
+
+class HostKeysReloader (object):
+    """
+    Keeps the entries of a known_hosts file attached to a L{HostKeys} object
+    up to date with the file, for long running processes.
+
+    The file is loaded into its own L{HostKeys}, attached to C{hostkeys}
+    with L{HostKeys.attach}.  Every C{interval} seconds the file is
+    C{stat}'ed: if it only grew, the appended lines are parsed and added;
+    if it was rewritten, or changed without growing, it is parsed again in the reactor thread pool and
+    the new entries replace the old ones in a single step once ready.
+    Changes made in memory to entries of the file are lost on a full
+    reload.
+    """
+
+    # bytes before the end of the parsed part compared to detect rewrites
+    marker_size = 64
+
+    def __init__(self, hostkeys, filename, reactor, interval=5.0, lazy=False, index=False):
+        """
+        @param hostkeys: host keys the file entries are attached to
+        @type hostkeys: L{HostKeys}
+        @param filename: known_hosts file to watch
+        @type filename: str
+        @param reactor: reactor to use
+        @type reactor: L{twisted.internet.reactor}
+        @param interval: seconds between checks of the file
+        @type interval: C{float}
+        @param lazy: load keys lazily, see L{HostKeys.load}
+        @type lazy: bool
+        @param index: look up through a compiled L{HostKeyIndex}; any change
+            of the file rebuilds the index in the thread pool
+        @type index: bool
+        """
+        self.hostkeys = hostkeys
+        self.filename = filename
+        self.reactor = reactor
+        self.interval = interval
+        self.lazy = lazy
+        self.index = index
+        self.keys = None
+        self.reloads = 0
+        self.tail_loads = 0
+        self._stat = None
+        self._offset = 0
+        self._marker = ''
+        self._reloading = False
+        self._loop = None
+
+    def start(self):
+        """
+        Load the file and start watching it.
+
+        @raise IOError: if the file can't be read
+        """
+        st = self._stat_file()
+        if self.index:
+            keys = self._open_index()
+        else:
+            keys, self._offset, self._marker = self._parse()
+        self.keys = keys
+        self._stat = st
+        self.hostkeys.attach(keys)
+        self._loop = task.LoopingCall(self.check)
+        self._loop.clock = self.reactor
+        self._loop.start(self.interval, now=False)
+
+    def stop(self):
+        """ Stop watching the file, its entries stay attached. """
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+
+    def _stat_file(self):
+        try:
+            st = os.stat(self.filename)
+        except OSError, e:
+            raise IOError(e.errno, e.strerror, self.filename)
+        return (st.st_ino, st.st_size, st.st_mtime)
+
+    def _parse(self):
+        """
+        Parse the whole file into a new L{HostKeys}, or rebuild its index.
+
+        @return: C{(hostkeys, parsed size, marker)}
+        """
+        f = open(self.filename, 'r')
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        end = data.rfind('\n') + 1
+        if self.index:
+            HostKeyIndex(self.filename).build()
+            keys = None
+        else:
+            keys = HostKeys()
+            keys._load_lines(data[:end].splitlines(), self.lazy)
+            keys._invalidate()
+        return keys, end, data[max(0, end - self.marker_size):end]
+
+    def _open_index(self):
+        keys = HostKeys()
+        keys.load(self.filename, self.lazy, index=True)
+        return keys
+
+    def check(self):
+        """ Compare the file with what was loaded and reload what changed. """
+        if self._reloading:
+            return
+        try:
+            st = self._stat_file()
+        except IOError, e:
+            # removed or being replaced, keep what we have
+            return
+        if st == self._stat:
+            return
+        inode, size, mtime = st
+        # only a file that grew can have been appended to; a change of the
+        # mtime alone is a rewrite in place, e.g. a key swapped for another
+        # of the same length
+        grew = size > self._stat[1] and size > self._offset
+        if (not self.index) and (inode == self._stat[0]) and grew and self._unchanged():
+            self._stat = st
+            self._load_tail(size)
+        else:
+            self._reload(st)
+
+    def _unchanged(self):
+        """ Returns C{True} if the end of the parsed part of the file is unchanged """
+        start = max(0, self._offset - len(self._marker))
+        f = open(self.filename, 'r')
+        try:
+            f.seek(start)
+            return f.read(self._offset - start) == self._marker
+        finally:
+            f.close()
+
+    def _load_tail(self, size):
+        """ Parse lines appended since the last load. """
+        f = open(self.filename, 'r')
+        try:
+            f.seek(self._offset)
+            data = f.read(size - self._offset)
+        finally:
+            f.close()
+        end = data.rfind('\n') + 1
+        if end == 0:
+            # no complete line yet
+            return
+        self.keys._load_lines(data[:end].splitlines(), self.lazy)
+        self.keys._invalidate()
+        self.hostkeys._invalidate()
+        self._marker = (self._marker + data[:end])[-self.marker_size:]
+        self._offset += end
+        self.tail_loads += 1
+
+    def _reload(self, st):
+        """ Parse the whole file in the thread pool and swap the entries in. """
+        self._reloading = True
+        d = threads.deferToThreadPool(self.reactor, self.reactor.getThreadPool(), self._parse)
+        d.addCallback(self._reloaded, st)
+        d.addErrback(self._reloadFailed)
+
+    def _reloaded(self, result, st):
+        keys, self._offset, self._marker = result
+        if self.index:
+            keys = self._open_index()
+        self.hostkeys.replace(self.keys, keys)
+        self.keys = keys
+        self._stat = st
+        self._reloading = False
+        self.reloads += 1
+
+    def _reloadFailed(self, reason):
+        self._reloading = False
+        log.msg('Unable to reload host keys from %s: %s' % (self.filename, reason.getErrorMessage()))
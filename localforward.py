@@ -0,0 +1,266 @@
+"""
+Local port forwarding (like C{ssh -L}) through pooled SSH connections
+
+L{LocalForwarder} listens on a local port and forwards every accepted
+connection through its own direct-tcpip channel to a fixed destination, so
+programs not using this package can reach it through the bastions::
+
+    pool = SSHClientPool(client, max_channels = 100, max_connections = 8)
+    forwarder = LocalForwarder(pool, ['bastion1.example.com', 'bastion2.example.com'], 'db.example.com', 5432,
+                               username = 'test')
+    forwarder.listen(15432)
+
+Channels are spread over the bastions and their pooled connections, see
+L{LocalForwarder}.  Bytes are passed between the two transports as they
+are received, without copying, with flow control in both directions.
+"""
+
+import getpass
+
+from twisted.internet import protocol
+from twisted.python import log
+
+from sshclient import SSH_PORT
+
+__all__ = ['LocalForwarder']
+
+
+class _LocalProtocol (protocol.Protocol):
+    """ Accepted local connection, spliced with the channel protocol C{peer} """
+
+    peer = None
+    bastion = None
+    tried = ()
+    # leased connection, until given back to the pool
+    sshconnection = None
+    released = False
+    closed = False
+    done = False
+
+    def connectionMade(self):
+        # nothing is read before the channel is open
+        self.transport.pauseProducing()
+        self.factory.forwarder._open(self)
+
+    def dataReceived(self, data):
+        self.factory.forwarder.bytes_sent += len(data)
+        self.peer.transport.write(data)
+
+    def connectionLost(self, reason):
+        self.closed = True
+        if self.peer is not None:
+            self.peer.transport.loseConnection()
+        self.factory.forwarder._closed(self)
+
+
+class _LocalFactory (protocol.ServerFactory):
+    protocol = _LocalProtocol
+    noisy = False
+
+    def __init__(self, forwarder):
+        self.forwarder = forwarder
+
+
+class _ChannelProtocol (protocol.Protocol):
+    """ Protocol of the direct-tcpip channel of a local connection """
+
+    def connectionMade(self):
+        local = self.factory.local
+        if local.closed:
+            self.transport.loseConnection()
+            return
+        self.local = local
+        local.peer = self
+        local.transport.registerProducer(self.transport, True)
+        self.transport.registerProducer(local.transport, True)
+        local.transport.resumeProducing()
+
+    def dataReceived(self, data):
+        self.factory.forwarder.bytes_received += len(data)
+        self.local.transport.write(data)
+
+    def connectionLost(self, reason):
+        local = self.factory.local
+        if not local.closed:
+            local.transport.loseConnection()
+        self.factory.forwarder._release(local)
+
+
+class _ChannelFactory (protocol.ClientFactory):
+    protocol = _ChannelProtocol
+    noisy = False
+    channel = None
+
+    def __init__(self, forwarder, local):
+        self.forwarder = forwarder
+        self.local = local
+
+    def startedConnecting(self, connector):
+        self.channel = connector.transport
+
+    def clientConnectionFailed(self, connector, reason):
+        self.forwarder._failed(reason, self.local, self.channel)
+
+
+class LocalForwarder (object):
+    """
+    Forwards connections accepted on local ports to C{remote_host} and
+    C{remote_port}, one direct-tcpip channel per connection.
+
+    Channels are spread over C{bastions}: each is opened to the bastion with
+    the fewest channels opening or open, and L{SSHClientPool.acquire} picks
+    its least loaded connection.  A connection carries at most
+    C{max_channels} of the pool, more bastion connections are opened up to
+    its C{max_connections}, further local connections wait for a free
+    channel.  When connecting to a bastion fails, the other bastions are
+    tried, and it's chosen last for C{retry_delay} seconds.
+    """
+
+    def __init__(self, pool, bastions, remote_host, remote_port, username=None, timeout=30, retry_delay=30.0, **connect_kwargs):
+        """
+        @param pool: pool the SSH connections are taken from
+        @type pool: L{SSHClientPool}
+        @param bastions: hostnames, or dicts of L{SSHClient.open_connection}
+            keyword arguments including C{hostname}
+        @param remote_host: host the bastions connect to
+        @type remote_host: C{str}
+        @param remote_port: port the bastions connect to
+        @type remote_port: C{int}
+        @param username: default username for the bastions
+        @type username: C{str}
+        @param timeout: seconds to wait for a channel to open
+        @param retry_delay: seconds a failing bastion is avoided
+        @type retry_delay: C{float}
+        @param connect_kwargs: default keyword arguments of
+            L{SSHClient.open_connection}, e.g. C{key_filename}
+        """
+        self.pool = pool
+        self.remote_host = remote_host
+        self.remote_port = remote_port
+        self.timeout = timeout
+        self.retry_delay = retry_delay
+        self.bastions = []
+        for bastion in bastions:
+            kwargs = dict(connect_kwargs)
+            if isinstance(bastion, dict):
+                kwargs.update(bastion)
+            else:
+                kwargs['hostname'] = bastion
+            kwargs.setdefault('port', SSH_PORT)
+            kwargs.setdefault('username', username or getpass.getuser())
+            self.bastions.append(kwargs)
+        self.ports = []
+        # index of bastion -> time until which it's avoided
+        self._failing = {}
+        # channels opening or open, by index of bastion
+        self._channels = [0] * len(self.bastions)
+
+        self.accepted = 0
+        self.active = 0
+        self.failed = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def listen(self, port, interface='127.0.0.1', backlog=1024):
+        """
+        Starts accepting connections on C{port}.
+
+        @param interface: local address to listen on
+        @param backlog: size of the queue of connections not yet accepted
+        @return: the listening port
+        @rtype: L{twisted.internet.interfaces.IListeningPort}
+        """
+        listening = self.pool.reactor.listenTCP(port, _LocalFactory(self), backlog, interface)
+        self.ports.append(listening)
+        return listening
+
+    def stopListening(self):
+        """ Stops accepting connections, forwarded connections are kept open """
+        ports, self.ports = self.ports, []
+        for listening in ports:
+            listening.stopListening()
+
+    def _choose(self, tried):
+        """ Returns index of the bastion with the fewest channels, C{None} if all were tried """
+        now = self.pool.reactor.seconds()
+        loads = [(self._failing.get(index, 0) > now, self._channels[index], index)
+                 for index in xrange(len(self.bastions)) if index not in tried]
+        if not loads:
+            return None
+        return min(loads)[2]
+
+    def _open(self, local):
+        self.accepted += 1
+        self.active += 1
+        local.tried = set()
+        self._acquire(local, self._choose(local.tried))
+
+    def _acquire(self, local, index):
+        local.bastion = index
+        local.tried.add(index)
+        self._channels[index] += 1
+        kwargs = dict(self.bastions[index])
+        d = self.pool.acquire(kwargs.pop('hostname'), kwargs.pop('port'), kwargs.pop('username'), **kwargs)
+        d.addCallbacks(self._acquired, self._acquireFailed, callbackArgs=(local,), errbackArgs=(local, index))
+
+    def _acquireFailed(self, reason, local, index):
+        """ Avoids the bastion for a while and tries the next one """
+        self._failing[index] = self.pool.reactor.seconds() + self.retry_delay
+        if not local.done:
+            other = self._choose(local.tried)
+            if other is not None:
+                self._channels[index] -= 1
+                self._acquire(local, other)
+                return
+        self._failed(reason, local)
+
+    def _acquired(self, sshconnection, local):
+        local.sshconnection = sshconnection
+        if local.done:
+            self._release(local)
+            return
+        sshconnection.connectTCP(self.remote_host, self.remote_port, _ChannelFactory(self, local), self.timeout)
+
+    def _failed(self, reason, local, channel=None):
+        self.failed += 1
+        log.msg('Forwarding to %s:%d failed: %s' % (self.remote_host, self.remote_port, reason.getErrorMessage()))
+        if channel is None:
+            self._release(local)
+        else:
+            # an open given up on by a timeout is still pending on the
+            # connection until the other side confirms or refuses it
+            channel.channelClosedDefer.addCallback(lambda ignored: self._release(local))
+        if not local.closed:
+            local.transport.loseConnection()
+
+    def _release(self, local):
+        """
+        Gives the channel back to the pool once, when it's closed or failed
+        to open.  A local connection closed while its channel is opening,
+        or whose channel open timed out, keeps the lease until the channel is
+        closed or refused, so the pool doesn't undercount channels of the
+        connection.
+        """
+        if local.released:
+            return
+        local.released = True
+        self._channels[local.bastion] -= 1
+        if local.sshconnection is not None:
+            self.pool.release(local.sshconnection)
+            local.sshconnection = None
+
+    def _closed(self, local):
+        """ Counts the local connection closed once, when either side is closed """
+        if not local.done:
+            local.done = True
+            self.active -= 1
+
+    def stats(self):
+        """
+        @return: C{accepted} connections, C{active} forwarded connections,
+            C{failed} channel opens and payload C{bytes_sent} and
+            C{bytes_received}
+        @rtype: C{dict}
+        """
+        return {'accepted': self.accepted, 'active': self.active, 'failed': self.failed,
+                'bytes_sent': self.bytes_sent, 'bytes_received': self.bytes_received}
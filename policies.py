@@ -2,6 +2,8 @@
 Various policies for accepting, rejecting, etc. missing server hostkeys
 """
 
+import warnings
+
 from twisted.python import log
 
 __all__ = ['AutoAddPolicy', 'RejectPolicy', 'WarningPolicy']
@@ -32,6 +34,10 @@ class AutoAddPolicy (MissingHostKeyPolicy):
     """
     Policy for automatically adding the hostname and new host key to the
     local L{HostKeys} object, and saving it.  This is used by L{SSHClient}.
+
+    Keys are saved by the L{HostKeysWriter} set up with
+    L{SSHClient.set_host_keys_write_behind}; without one they are only kept
+    in memory.
     """
 
     def missing_host_key(self, client, hostname, key):
@@ -0,0 +1,410 @@
+"""
+Pool of authenticated L{SSHConnection}s keyed by host, port and user
+
+Connections are opened on demand and reused by later callers, so a tunnel
+only pays the TCP connect, key exchange and authentication once per pool
+slot::
+
+    pool = SSHClientPool(client)
+
+    def onConnection(sshconnection):
+        connector = sshconnection.connectTCP('smtp.google.com', 25, factory, timeout = 8)
+        ...
+        pool.release(sshconnection)
+
+    pool.acquire('bastion.example.com', username = 'test').addCallback(onConnection)
+
+Every acquired connection counts against C{max_channels} of its slot until
+L{SSHClientPool.release} is called for it.
+
+Latency sensitive callers can keep authenticated spare connections ready,
+so acquiring only costs the channel open of the tunnel::
+
+    pool.warm('bastion.example.com', username = 'test', spares = 2)
+"""
+
+import getpass, random, time
+
+from twisted.internet import defer, task
+from twisted.python import log
+
+from sshclient import SSH_PORT
+from errors import PoolClosedException
+
+__all__ = ['SSHClientPool', 'PooledConnection']
+
+
+class PooledConnection (object):
+    """
+    A pool slot: one authenticated L{SSHConnection} and its usage.
+    """
+
+    def __init__(self, key, sshconnection, now):
+        """
+        @param key: C{(hostname, port, username)} of the connection
+        @type key: C{tuple}
+        @param sshconnection: the connection
+        @type sshconnection: L{SSHConnection}
+        @param now: creation time
+        @type now: C{float}
+        """
+        self.key = key
+        self.connection = sshconnection
+        self.created = now
+        self.last_used = now
+        self.leases = 0
+        self.retired = False
+        self.checking = False
+        self.lost = False
+
+    def channels(self):
+        """ Returns number of channels currently open on the connection """
+        return len(self.connection.channels)
+
+    def close(self):
+        """ Loses the connection, the pool forgets it once it's lost """
+        self.retired = True
+        if not self.lost:
+            self.connection.loseConnection()
+
+    def __repr__(self):
+        return '<PooledConnection %s@%s:%d leases=%d%s>' % (self.key[2], self.key[0], self.key[1], self.leases,
+                                                             self.retired and ' retired' or '')
+
+
+class SSHClientPool (object):
+    """
+    Reusable authenticated connections keyed by C{(hostname, port, username)}.
+
+    Connections are opened with L{SSHClient.open_connection} of the given
+    client, so its host keys, policy and caches are shared by all of them.
+
+    A background check, every C{check_interval} seconds, closes connections
+    idle for C{idle_timeout} seconds, retires connections older than
+    C{max_lifetime} (they are closed once released) and sends a keepalive
+    global request to every connection, closing those not answering within
+    C{health_check_timeout} seconds.
+
+    Targets registered with L{warm} keep spare, unleased connections open
+    regardless of C{idle_timeout}; spares taken, lost or retired are replaced
+    in the background.  Failing refills are retried after a randomized delay
+    doubling from C{refill_backoff} up to C{max_refill_backoff} seconds.
+    """
+
+    def __init__(self, sshclient, max_channels=10, max_connections=4, idle_timeout=300.0, max_lifetime=3600.0,
+                 check_interval=30.0, health_check_timeout=10.0, refill_backoff=1.0, max_refill_backoff=60.0,
+                 clock=time.time):
+        """
+        @param sshclient: configured client whose host keys and policy are used
+        @type sshclient: L{SSHClient}
+        @param max_channels: maximum number of leases of a single connection
+        @type max_channels: C{int}
+        @param max_connections: maximum number of connections per key,
+            C{None} for no limit
+        @type max_connections: C{int}
+        @param idle_timeout: seconds an unused connection is kept open
+        @type idle_timeout: C{float}
+        @param max_lifetime: seconds after which a connection isn't reused
+        @type max_lifetime: C{float}
+        @param check_interval: seconds between background checks, C{None}
+            disables them
+        @type check_interval: C{float}
+        @param health_check_timeout: seconds to wait for a keepalive reply
+        @type health_check_timeout: C{float}
+        @param refill_backoff: seconds before retrying a failed spare refill
+        @type refill_backoff: C{float}
+        @param max_refill_backoff: maximum seconds between refill retries
+        @type max_refill_backoff: C{float}
+        @param clock: function returning the current time
+        """
+        self.sshclient = sshclient
+        self.reactor = sshclient.reactor
+        self.max_channels = max_channels
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.check_interval = check_interval
+        self.health_check_timeout = health_check_timeout
+        self.refill_backoff = refill_backoff
+        self.max_refill_backoff = max_refill_backoff
+        self.clock = clock
+        self.closed = False
+
+        # key -> [PooledConnection]
+        self._slots = {}
+        # id(sshconnection) -> PooledConnection
+        self._by_connection = {}
+        # key -> [(Deferred, connect kwargs)]
+        self._waiters = {}
+        # key -> number of connects in progress
+        self._connecting = {}
+        # key -> [spares, connect kwargs, consecutive failures, delayed refill]
+        self._warm = {}
+
+        self.acquired = 0
+        self.reused = 0
+        self.connects = 0
+        self.connect_failures = 0
+        self.health_failures = 0
+        self.refill_failures = 0
+
+        self._checker = None
+        if check_interval:
+            self._checker = task.LoopingCall(self.check)
+            self._checker.clock = self.reactor
+            self._checker.start(check_interval, now=False)
+
+    def acquire(self, hostname, port=SSH_PORT, username=None, **connect_kwargs):
+        """
+        Get a live connection to C{hostname}, opening one if no pooled
+        connection has a free channel.
+
+        @param connect_kwargs: passed to L{SSHClient.open_connection} when a new
+            connection is opened, e.g. C{password} or C{key_filename}
+        @return: L{Deferred} fired with L{SSHConnection}, to be given back
+            with L{release}
+        """
+        if self.closed:
+            return defer.fail(PoolClosedException('Pool is closed'))
+        if username is None:
+            username = getpass.getuser()
+        key = (hostname, port, username)
+        self.acquired += 1
+
+        slot = self._free_slot(key)
+        if slot is not None:
+            self.reused += 1
+            connection = self._lease(slot)
+            self._refill(key)
+            return defer.succeed(connection)
+
+        d = defer.Deferred()
+        self._waiters.setdefault(key, []).append((d, connect_kwargs))
+        self._connect_more(key)
+        return d
+
+    def release(self, sshconnection):
+        """
+        Give back a connection returned by L{acquire}.
+
+        @type sshconnection: L{SSHConnection}
+        """
+        slot = self._by_connection.get(id(sshconnection))
+        if slot is None or slot.leases <= 0:
+            return
+        slot.leases -= 1
+        slot.last_used = self.clock()
+        if slot.retired and slot.leases == 0:
+            slot.close()
+        else:
+            self._serve(slot.key, reused=True)
+
+    def _free_slot(self, key):
+        """ Returns the least loaded usable connection for C{key} or C{None} """
+        best = None
+        for slot in self._slots.get(key, ()):
+            if slot.retired or slot.lost or slot.leases >= self.max_channels:
+                continue
+            if best is None or slot.leases < best.leases:
+                best = slot
+        return best
+
+    def _lease(self, slot):
+        slot.leases += 1
+        slot.last_used = self.clock()
+        return slot.connection
+
+    def _serve(self, key, reused=False):
+        """ Hands free channels of C{key} connections to waiting callers """
+        waiters = self._waiters.get(key)
+        while waiters:
+            slot = self._free_slot(key)
+            if slot is None:
+                break
+            d, connect_kwargs = waiters.pop(0)
+            if reused:
+                self.reused += 1
+            d.callback(self._lease(slot))
+        if not waiters:
+            self._waiters.pop(key, None)
+        self._refill(key)
+
+    def warm(self, hostname, port=SSH_PORT, username=None, spares=1, **connect_kwargs):
+        """
+        Keep C{spares} authenticated connections to C{hostname} ready for
+        L{acquire}, within C{max_connections}.  Calling it again changes the
+        number of spares, C{0} stops keeping them.
+
+        @param connect_kwargs: passed to L{SSHClient.open_connection}
+        """
+        key = (hostname, port, username or getpass.getuser())
+        warm = self._warm.pop(key, None)
+        if warm is not None and warm[3] is not None and warm[3].active():
+            warm[3].cancel()
+        if spares > 0:
+            self._warm[key] = [spares, connect_kwargs, 0, None]
+            self._refill(key)
+
+    def _idle(self, key):
+        """ Returns unleased usable connections of C{key} """
+        return [slot for slot in self._slots.get(key, ()) if slot.leases == 0 and not slot.retired and not slot.lost]
+
+    def _refill(self, key):
+        """ Opens connections missing to keep the spares of C{key} """
+        warm = self._warm.get(key)
+        if self.closed or warm is None or (warm[3] is not None and warm[3].active()):
+            return
+        connecting = self._connecting.get(key, 0)
+        needed = warm[0] - len(self._idle(key)) - connecting
+        if self.max_connections is not None:
+            needed = min(needed, self.max_connections - len(self._slots.get(key, ())) - connecting)
+        for i in xrange(needed):
+            self._connect(key, warm[1])
+
+    def _refillFailed(self, key):
+        """ Retries refilling spares of C{key} after a growing, randomized delay """
+        warm = self._warm.get(key)
+        if self.closed or warm is None:
+            return
+        self.refill_failures += 1
+        if warm[3] is not None and warm[3].active():
+            # another connect of the same refill already failed
+            return
+        warm[2] += 1
+        delay = min(self.max_refill_backoff, self.refill_backoff * 2 ** (warm[2] - 1))
+        delay *= 0.5 + random.random() / 2
+        warm[3] = self.reactor.callLater(delay, self._refill, key)
+
+    def _connect_more(self, key):
+        """ Opens connections for waiting callers of C{key}, within C{max_connections} """
+        waiters = self._waiters.get(key, ())
+        connecting = self._connecting.get(key, 0)
+        # a new connection serves up to max_channels waiters
+        needed = (len(waiters) + self.max_channels - 1) // self.max_channels - connecting
+        if self.max_connections is not None:
+            needed = min(needed, self.max_connections - len(self._slots.get(key, ())) - connecting)
+        for i in xrange(needed):
+            self._connect(key, waiters[0][1])
+
+    def _connect(self, key, connect_kwargs):
+        hostname, port, username = key
+        self.connects += 1
+        self._connecting[key] = self._connecting.get(key, 0) + 1
+
+        d = self.sshclient.open_connection(hostname, port, username, **connect_kwargs)
+        d.addCallbacks(self._connected, self._connectFailed, callbackArgs=(key,), errbackArgs=(key,))
+
+    def _connected(self, sshconnection, key):
+        self._connecting[key] -= 1
+        slot = PooledConnection(key, sshconnection, self.clock())
+        if self.closed:
+            slot.close()
+            return
+        self._slots.setdefault(key, []).append(slot)
+        self._by_connection[id(sshconnection)] = slot
+        sshconnection.connectionLostDefer.addCallback(lambda ignored: self._lost(slot))
+        if key in self._warm:
+            self._warm[key][2] = 0
+        self._serve(key)
+        self._connect_more(key)
+
+    def _connectFailed(self, reason, key):
+        self._connecting[key] -= 1
+        self.connect_failures += 1
+        log.msg('Pooled connection to %s@%s:%d failed: %s' % (key[2], key[0], key[1], reason.getErrorMessage()))
+        if key in self._warm:
+            self._refillFailed(key)
+        if self._connecting[key] or self._slots.get(key):
+            # remaining waiters are served by other connections
+            return
+        for d, connect_kwargs in self._waiters.pop(key, ()):
+            d.errback(reason)
+
+    def _lost(self, slot):
+        slot.lost = True
+        slots = self._slots.get(slot.key, [])
+        if slot in slots:
+            slots.remove(slot)
+        if not slots:
+            self._slots.pop(slot.key, None)
+        self._by_connection.pop(id(slot.connection), None)
+        if not self.closed:
+            self._connect_more(slot.key)
+            self._refill(slot.key)
+
+    def check(self):
+        """ Closes idle and expired connections, health checks the others and refills spares """
+        now = self.clock()
+        for key, slots in self._slots.items():
+            spares = key in self._warm and self._warm[key][0] or 0
+            # the youngest idle connections are kept as spares
+            for slot in sorted(slots, key=lambda slot: -slot.created):
+                if slot.lost:
+                    continue
+                if now - slot.created > self.max_lifetime:
+                    slot.retired = True
+                if slot.leases == 0 and not slot.retired and spares > 0:
+                    spares -= 1
+                    idle = False
+                else:
+                    idle = now - slot.last_used > self.idle_timeout
+                if slot.leases == 0 and (slot.retired or idle):
+                    slot.close()
+                elif not slot.checking:
+                    self._health_check(slot)
+        for key in self._warm.keys():
+            self._refill(key)
+
+    def _health_check(self, slot):
+        """ Sends a keepalive, any reply - even a failure - means alive """
+        slot.checking = True
+        d = slot.connection.sendGlobalRequest('keepalive@openssh.com', '', wantReply=1)
+        timeout = self.reactor.callLater(self.health_check_timeout, self._health_timeout, slot)
+
+        def answered(ignored):
+            slot.checking = False
+            if timeout.active():
+                timeout.cancel()
+        d.addBoth(answered)
+
+    def _health_timeout(self, slot):
+        self.health_failures += 1
+        log.msg('Pooled connection %r did not answer keepalive, closing' % (slot,))
+        slot.close()
+
+    def connections(self, hostname=None, port=SSH_PORT, username=None):
+        """
+        @return: pooled connections, all of them or those of a single key
+        @rtype: list(L{PooledConnection})
+        """
+        if hostname is None:
+            return [slot for slots in self._slots.values() for slot in slots]
+        return list(self._slots.get((hostname, port, username or getpass.getuser()), ()))
+
+    def stats(self):
+        """
+        @return: pool counters and current number of C{connections},
+            C{leases}, C{waiting} callers and C{idle} connections
+        @rtype: C{dict}
+        """
+        slots = self.connections()
+        return {'connections': len(slots), 'leases': sum([slot.leases for slot in slots]),
+                'idle': len([slot for slot in slots if slot.leases == 0 and not slot.retired]),
+                'waiting': sum([len(waiters) for waiters in self._waiters.values()]),
+                'acquired': self.acquired, 'reused': self.reused, 'connects': self.connects,
+                'connect_failures': self.connect_failures, 'health_failures': self.health_failures,
+                'refill_failures': self.refill_failures}
+
+    def close(self):
+        """ Closes all connections and fails waiting callers """
+        self.closed = True
+        if self._checker is not None and self._checker.running:
+            self._checker.stop()
+        for key in self._warm.keys():
+            self.warm(*key, spares=0)
+        waiters, self._waiters = self._waiters, {}
+        for key in waiters:
+            for d, connect_kwargs in waiters[key]:
+                d.errback(PoolClosedException('Pool is closed'))
+        for slot in self.connections():
+            slot.close()
@@ -0,0 +1,220 @@
+"""
+Persistent SSH connection re-establishing its forwarded channels
+
+L{ReconnectingConnection} keeps an L{SSHConnection} open, reconnecting with
+jittered exponential backoff when it's lost.  Tunnels opened through it are
+remembered and all of them are reopened at once on every new connection::
+
+    persistent = client.open_persistent('bastion.example.com', username = 'test')
+    persistent.connectTCP('smtp.example.com', 25, smtpFactory, timeout = 8)
+    persistent.connectTCP('db.example.com', 5432, dbFactory, timeout = 8)
+
+Factories of the tunnels are reused for every connection, like factories of
+L{twisted.internet.protocol.ReconnectingClientFactory}.
+"""
+
+import random
+
+from twisted.internet import defer
+from twisted.python import log
+
+from errors import BadHostKeyException, RevokedHostKeyException, UnknownHostKeyException
+
+__all__ = ['ReconnectingConnection', 'PersistentTunnel']
+
+
+class PersistentTunnel (object):
+    """
+    A tunnel of L{ReconnectingConnection}, reopened on every new connection.
+
+    @ivar connector: L{DirectTcpIpChannelConnector} of the current connection
+        or C{None} while disconnected
+    """
+
+    def __init__(self, persistent, host, port, factory, timeout, loseconnection_on_protocollose, loseconnection_on_protocolfailed):
+        self.persistent = persistent
+        self.host = host
+        self.port = port
+        self.factory = factory
+        self.timeout = timeout
+        self.loseconnection_on_protocollose = loseconnection_on_protocollose
+        self.loseconnection_on_protocolfailed = loseconnection_on_protocolfailed
+        self.connector = None
+        self.opened = 0
+
+    def open(self, sshconnection):
+        """ Opens the tunnel through C{sshconnection} """
+        self.opened += 1
+        self.connector = sshconnection.connectTCP(self.host, self.port, self.factory, self.timeout, None,
+                                                  self.loseconnection_on_protocollose, self.loseconnection_on_protocolfailed)
+
+    def stop(self):
+        """ Closes the tunnel and stops reopening it """
+        if self in self.persistent.tunnels:
+            self.persistent.tunnels.remove(self)
+        if self.connector is not None:
+            self.connector.disconnect()
+            self.connector = None
+
+    def __repr__(self):
+        return '<PersistentTunnel %s:%s>' % (self.host, self.port)
+
+
+class ReconnectingConnection (object):
+    """
+    SSH connection reopened after it's lost, see L{SSHClient.open_persistent}.
+
+    Reconnecting waits C{initial_delay} seconds, multiplied by C{factor} after
+    every failed attempt up to C{max_delay}, each delay randomized by up to
+    C{jitter} of its length.  Host key errors (C{fatal_errors}) stop
+    reconnecting, as do C{max_retries} consecutive failures.
+
+    @cvar fatal_errors: exceptions after which reconnecting is pointless
+    @ivar connection: current L{SSHConnection} or C{None}
+    @ivar tunnels: remembered L{PersistentTunnel}s
+    """
+
+    fatal_errors = (BadHostKeyException, RevokedHostKeyException, UnknownHostKeyException)
+
+    def __init__(self, sshclient, connect_kwargs, initial_delay=1.0, max_delay=60.0, factor=2.0, jitter=0.5, max_retries=None):
+        """
+        @param sshclient: client whose L{SSHClient.open_connection} is used
+        @type sshclient: L{SSHClient}
+        @param connect_kwargs: keyword arguments of L{SSHClient.open_connection}
+        @type connect_kwargs: C{dict}
+        @param initial_delay: seconds before the first reconnect
+        @type initial_delay: C{float}
+        @param max_delay: maximum seconds between reconnects
+        @type max_delay: C{float}
+        @param factor: multiplier of the delay after a failed attempt
+        @type factor: C{float}
+        @param jitter: part of the delay randomized
+        @type jitter: C{float}
+        @param max_retries: consecutive failures before giving up, C{None}
+            retries forever
+        @type max_retries: C{int}
+        """
+        self.sshclient = sshclient
+        self.reactor = sshclient.reactor
+        self.connect_kwargs = connect_kwargs
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.factor = factor
+        self.jitter = jitter
+        self.max_retries = max_retries
+
+        self.connection = None
+        self.tunnels = []
+        self.retries = 0
+        self.connects = 0
+        self.stopped = True
+        self._attempt = None
+        self._delayed = None
+        self._waiters = []
+        self._listeners = []
+
+    def start(self):
+        """ Connects, and keeps reconnecting until L{stop} """
+        if not self.stopped:
+            return
+        self.stopped = False
+        self.retries = 0
+        self._connect()
+
+    def stop(self):
+        """ Stops reconnecting and closes the connection, tunnels are kept for L{start} """
+        self.stopped = True
+        if self._delayed is not None and self._delayed.active():
+            self._delayed.cancel()
+        self._delayed = None
+        if self._attempt is not None:
+            self._attempt.cancel()
+        if self.connection is not None:
+            self.connection.loseConnection()
+
+    def connectTCP(self, host, port, factory, timeout, loseconnection_on_protocollose = False, loseconnection_on_protocolfailed = False):
+        """
+        Like L{SSHConnection.connectTCP}, but the tunnel is reopened with the
+        same factory on every new connection.
+
+        @return: the tunnel, L{PersistentTunnel.stop} closes it for good
+        @rtype: L{PersistentTunnel}
+        """
+        tunnel = PersistentTunnel(self, host, port, factory, timeout, loseconnection_on_protocollose, loseconnection_on_protocolfailed)
+        self.tunnels.append(tunnel)
+        if self.connection is not None:
+            tunnel.open(self.connection)
+        return tunnel
+
+    def addConnectCallback(self, callback):
+        """ Calls C{callback} with every new L{SSHConnection}, after its tunnels were opened """
+        self._listeners.append(callback)
+
+    def whenConnected(self):
+        """
+        @return: L{Deferred} fired with the current or next L{SSHConnection}
+        """
+        if self.connection is not None:
+            return defer.succeed(self.connection)
+        d = defer.Deferred()
+        self._waiters.append(d)
+        return d
+
+    def _connect(self):
+        self._delayed = None
+        self.connects += 1
+        self._attempt = self.sshclient.open_connection(**self.connect_kwargs)
+        self._attempt.addCallbacks(self._connected, self._failed)
+
+    def _connected(self, sshconnection):
+        self._attempt = None
+        self.retries = 0
+        self.connection = sshconnection
+        sshconnection.connectionLostDefer.addCallback(self._lost)
+        # channel opens are pipelined, no tunnel waits for another
+        for tunnel in self.tunnels:
+            tunnel.open(sshconnection)
+        log.msg('Connected to %s, reopened %d tunnels' % (self.connect_kwargs.get('hostname'), len(self.tunnels)))
+        waiters, self._waiters = self._waiters, []
+        for d in waiters:
+            d.callback(sshconnection)
+        for callback in self._listeners:
+            try:
+                callback(sshconnection)
+            except Exception:
+                log.err(None, 'Error in connect callback')
+
+    def _failed(self, reason):
+        self._attempt = None
+        if self.stopped:
+            return
+        if reason.check(*self.fatal_errors):
+            log.msg('Not reconnecting to %s: %s' % (self.connect_kwargs.get('hostname'), reason.getErrorMessage()))
+            self._giveUp(reason)
+            return
+        self.retries += 1
+        if self.max_retries is not None and self.retries > self.max_retries:
+            self._giveUp(reason)
+            return
+        self._schedule()
+
+    def _lost(self, sshconnection):
+        if sshconnection is not self.connection:
+            return
+        self.connection = None
+        for tunnel in self.tunnels:
+            tunnel.connector = None
+        if not self.stopped:
+            self._schedule()
+
+    def _schedule(self):
+        delay = min(self.max_delay, self.initial_delay * self.factor ** self.retries)
+        delay *= 1 - self.jitter * random.random()
+        log.msg('Reconnecting to %s in %.1f seconds' % (self.connect_kwargs.get('hostname'), delay))
+        self._delayed = self.reactor.callLater(delay, self._connect)
+
+    def _giveUp(self, reason):
+        self.stopped = True
+        waiters, self._waiters = self._waiters, []
+        for d in waiters:
+            d.errback(reason)
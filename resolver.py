@@ -0,0 +1,366 @@
+"""
+Name resolution cache and dual-stack connects for L{SSHClient}
+
+L{ResolverCache} resolves SSH targets once per C{ttl} and shares concurrent
+lookups of the same name.  L{HappyEyeballsConnector} connects to the resolved
+addresses like RFC 6555 describes: IPv6 and IPv4 addresses alternate and the
+next address is tried C{delay} seconds after the previous one unless it
+connected, so a dead address family doesn't stall the connect.
+
+Lookups are pluggable; to resolve through a DNS server, for example a local
+stub resolver, use L{NamesLookup}::
+
+    from twisted.names import client
+    cache = ResolverCache(reactor, NamesLookup(client.Resolver(servers = [('127.0.0.1', 5353)])))
+"""
+
+import socket, time
+
+from twisted.internet import abstract, defer, error, protocol, threads
+from twisted.python import failure
+
+__all__ = ['ResolverCache', 'GetAddrInfoLookup', 'NamesLookup', 'HappyEyeballsConnector']
+
+
+def is_ip_address(host):
+    """ Returns C{True} for IPv4 and IPv6 address literals """
+    return abstract.isIPAddress(host) or abstract.isIPv6Address(host)
+
+
+def interleave(addresses):
+    """
+    Orders C{(family, address)} tuples alternating families, starting with
+    the family of the first address.
+    """
+    families = []
+    by_family = {}
+    for family, address in addresses:
+        if family not in by_family:
+            families.append(family)
+            by_family[family] = []
+        by_family[family].append((family, address))
+    ordered = []
+    while by_family:
+        for family in families:
+            if by_family.get(family):
+                ordered.append(by_family[family].pop(0))
+            elif family in by_family:
+                del by_family[family]
+    return ordered
+
+
+class GetAddrInfoLookup (object):
+    """
+    Resolves names with C{socket.getaddrinfo} in the reactor thread pool.
+    """
+
+    def __init__(self, reactor):
+        self.reactor = reactor
+
+    def __call__(self, hostname):
+        """
+        @return: L{Deferred} fired with a list of C{(family, address, ttl)},
+            C{ttl} is always C{None}
+        """
+        return threads.deferToThreadPool(self.reactor, self.reactor.getThreadPool(), self._lookup, hostname)
+
+    def _lookup(self, hostname):
+        addresses = []
+        for family, socktype, proto, canonname, sockaddr in socket.getaddrinfo(hostname, None, 0, socket.SOCK_STREAM):
+            if family in (socket.AF_INET, socket.AF_INET6) and (family, sockaddr[0], None) not in addresses:
+                addresses.append((family, sockaddr[0], None))
+        return addresses
+
+
+class NamesLookup (object):
+    """
+    Resolves names with a L{twisted.names} resolver, querying AAAA and A
+    records at once.  Record TTLs limit how long results are cached.
+    """
+
+    def __init__(self, resolver):
+        """
+        @param resolver: e.g. L{twisted.names.client.Resolver}
+        """
+        self.resolver = resolver
+
+    def __call__(self, hostname):
+        """
+        @return: L{Deferred} fired with a list of C{(family, address, ttl)}
+        """
+        d = defer.DeferredList([self.resolver.lookupIPV6Address(hostname), self.resolver.lookupAddress(hostname)],
+                               consumeErrors=True)
+        d.addCallback(self._records, hostname)
+        return d
+
+    def _records(self, results, hostname):
+        from twisted.names import dns
+        addresses = []
+        errors = []
+        for success, result in results:
+            if not success:
+                errors.append(result)
+                continue
+            answers, authority, additional = result
+            for record in answers:
+                if record.type == dns.AAAA:
+                    addresses.append((socket.AF_INET6, socket.inet_ntop(socket.AF_INET6, record.payload.address), record.ttl))
+                elif record.type == dns.A:
+                    addresses.append((socket.AF_INET, socket.inet_ntoa(record.payload.address), record.ttl))
+        if not addresses:
+            if errors:
+                return errors[0]
+            raise error.DNSLookupError(hostname)
+        return addresses
+
+
+class ResolverCache (object):
+    """
+    Caches addresses of hostnames for C{ttl} seconds, or shorter if the
+    lookup returned a lower TTL, and failed lookups for C{negative_ttl}
+    seconds.  Concurrent lookups of a name share a single query.
+    """
+
+    def __init__(self, reactor, lookup=None, ttl=300.0, negative_ttl=30.0, maxsize=4096, clock=time.time):
+        """
+        @param reactor: reactor to use
+        @param lookup: callable returning a L{Deferred} fired with a list of
+            C{(family, address, ttl)}, defaults to L{GetAddrInfoLookup}
+        @param ttl: maximum seconds addresses are cached
+        @type ttl: C{float}
+        @param negative_ttl: seconds a failed lookup is cached
+        @type negative_ttl: C{float}
+        @param maxsize: maximum number of cached names
+        @type maxsize: C{int}
+        @param clock: function returning the current time
+        """
+        self.reactor = reactor
+        self.lookup = lookup or GetAddrInfoLookup(reactor)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.maxsize = maxsize
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        # hostname -> (expires at, addresses or Failure)
+        self._cache = {}
+        # hostname -> [Deferred]
+        self._pending = {}
+
+    def resolve(self, hostname):
+        """
+        @return: L{Deferred} fired with a list of C{(family, address)},
+            IPv6 and IPv4 addresses interleaved
+        """
+        if is_ip_address(hostname):
+            family = abstract.isIPv6Address(hostname) and socket.AF_INET6 or socket.AF_INET
+            return defer.succeed([(family, hostname)])
+
+        entry = self._cache.get(hostname)
+        if entry is not None:
+            if self.clock() < entry[0]:
+                self.hits += 1
+                if isinstance(entry[1], failure.Failure):
+                    return defer.fail(entry[1])
+                return defer.succeed(list(entry[1]))
+            del self._cache[hostname]
+
+        d = defer.Deferred()
+        if hostname in self._pending:
+            self.hits += 1
+            self._pending[hostname].append(d)
+            return d
+        self.misses += 1
+        self._pending[hostname] = [d]
+        self.lookup(hostname).addBoth(self._resolved, hostname)
+        return d
+
+    def _resolved(self, result, hostname):
+        now = self.clock()
+        if isinstance(result, failure.Failure):
+            value = result
+            expires = now + self.negative_ttl
+        else:
+            ttls = [ttl for family, address, ttl in result if ttl is not None]
+            value = interleave([(family, address) for family, address, ttl in result])
+            expires = now + min([self.ttl] + ttls)
+            if not value:
+                value = failure.Failure(error.DNSLookupError(hostname))
+                expires = now + self.negative_ttl
+        if len(self._cache) >= self.maxsize:
+            self._cache.clear()
+        self._cache[hostname] = (expires, value)
+
+        for d in self._pending.pop(hostname):
+            if isinstance(value, failure.Failure):
+                d.errback(value)
+            else:
+                d.callback(list(value))
+
+    def invalidate(self, hostname=None):
+        """ Forget addresses of C{hostname}, or of all names """
+        if hostname is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(hostname, None)
+
+    def stats(self):
+        """
+        @return: C{hits}, C{misses} and number of cached C{names}
+        @rtype: C{dict}
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'names': len(self._cache)}
+
+
+class _AttemptFactory (protocol.ClientFactory):
+    """ Factory of a single connect attempt of L{HappyEyeballsConnector} """
+
+    noisy = False
+
+    def __init__(self, race):
+        self.race = race
+
+    def buildProtocol(self, addr):
+        return self.race._won(self.connector, addr)
+
+    def clientConnectionFailed(self, connector, reason):
+        self.race._attemptFailed(connector, reason)
+
+    def clientConnectionLost(self, connector, reason):
+        self.race._lost(connector, reason)
+
+
+class HappyEyeballsConnector (object):
+    """
+    Connector resolving C{host} and racing connects to its addresses, see
+    L{resolver}.  Only the first connected address gets a protocol of
+    C{factory}, the other attempts are stopped.
+
+    Like L{twisted.internet.tcp.Connector}, C{factory} is told about the
+    connection being lost or failed, and L{connect} may be called again then.
+    """
+
+    def __init__(self, reactor, host, port, factory, timeout=30, resolver=None, delay=0.25):
+        """
+        @param host: hostname or address to connect to
+        @type host: C{str}
+        @param port: port to connect to
+        @type port: C{int}
+        @param factory: client factory
+        @param timeout: timeout of each connect attempt
+        @param resolver: cache used to resolve C{host}, C{None} for a
+            C{host} which is an address
+        @type resolver: L{ResolverCache}
+        @param delay: seconds before trying the next address
+        @type delay: C{float}
+        """
+        self.reactor = reactor
+        self.host = host
+        self.port = port
+        self.factory = factory
+        self.timeout = timeout
+        self.resolver = resolver
+        self.delay = delay
+        self.state = 'disconnected'
+        self.winner = None
+        self._attempts = []
+        self._addresses = []
+        self._delayed = None
+        self._lastFailure = None
+
+    def connect(self):
+        """ Resolves C{host} and starts connecting """
+        self.state = 'connecting'
+        self.winner = None
+        self._lastFailure = None
+        self.factory.doStart()
+        self.factory.startedConnecting(self)
+        if self.resolver is None:
+            d = defer.succeed([(abstract.isIPv6Address(self.host) and socket.AF_INET6 or socket.AF_INET, self.host)])
+        else:
+            d = self.resolver.resolve(self.host)
+        d.addCallbacks(self._resolved, self._failed)
+
+    def _resolved(self, addresses):
+        if self.state != 'connecting':
+            return
+        self._addresses = list(addresses)
+        self._next()
+
+    def _next(self):
+        """ Starts an attempt to the next address """
+        self._delayed = None
+        if self.state != 'connecting' or not self._addresses:
+            return
+        family, address = self._addresses.pop(0)
+        attempt = _AttemptFactory(self)
+        attempt.connector = self.reactor.connectTCP(address, self.port, attempt, self.timeout)
+        self._attempts.append(attempt.connector)
+        if self._addresses:
+            self._delayed = self.reactor.callLater(self.delay, self._next)
+
+    def _won(self, connector, addr):
+        if self.state != 'connecting':
+            return None
+        self.state = 'connected'
+        self.winner = connector
+        self._stopAttempts(connector)
+        return self.factory.buildProtocol(addr)
+
+    def _attemptFailed(self, connector, reason):
+        if connector in self._attempts:
+            self._attempts.remove(connector)
+        if self.state != 'connecting':
+            return
+        self._lastFailure = reason
+        if self._addresses:
+            # don't wait for the delay once an attempt failed
+            if self._delayed is not None and self._delayed.active():
+                self._delayed.cancel()
+            self._next()
+        elif not self._attempts:
+            self._failed(reason)
+
+    def _lost(self, connector, reason):
+        if connector is not self.winner:
+            return
+        self.state = 'disconnected'
+        self.winner = None
+        self.factory.clientConnectionLost(self, reason)
+        self.factory.doStop()
+
+    def _failed(self, reason):
+        if self.state != 'connecting':
+            return
+        self.state = 'disconnected'
+        self._stopAttempts()
+        self.factory.clientConnectionFailed(self, reason)
+        self.factory.doStop()
+
+    def _stopAttempts(self, keep=None):
+        if self._delayed is not None and self._delayed.active():
+            self._delayed.cancel()
+        self._delayed = None
+        self._addresses = []
+        attempts, self._attempts = self._attempts, []
+        for connector in attempts:
+            if connector is not keep and connector.state == 'connecting':
+                connector.stopConnecting()
+
+    def stopConnecting(self):
+        """ Stops connecting, the factory gets L{error.UserError} """
+        if self.state != 'connecting':
+            raise error.NotConnectingError("we're not trying to connect")
+        self._failed(failure.Failure(error.UserError()))
+
+    def disconnect(self):
+        """ Stops connecting or loses the connection """
+        if self.state == 'connecting':
+            self.stopConnecting()
+        elif self.state == 'connected':
+            self.winner.disconnect()
+
+    def getDestination(self):
+        if self.winner is not None:
+            return self.winner.getDestination()
+        return self.host, self.port
@@ -0,0 +1,325 @@
+"""
+Dynamic forwarding (like C{ssh -D}) with a SOCKS server
+
+L{SOCKSForwarder} accepts SOCKS4, SOCKS4a and SOCKS5 clients on a local port
+and opens a direct-tcpip channel for each CONNECT request, so a single SSH
+connection reaches any destination its server can connect to::
+
+    def onConnect(sshconnection):
+        socks = SOCKSForwarder(sshconnection, max_per_destination = 20)
+        socks.listen(1080)
+
+Hostnames of SOCKS4a and SOCKS5 requests are resolved by the SSH server.
+The SOCKS reply is sent when the channel is opened, together with data the
+client sent after its request without waiting for the reply.
+"""
+
+import socket, struct
+
+from twisted.internet import error, protocol
+from twisted.python import log
+
+__all__ = ['SOCKSForwarder']
+
+# SOCKS5 reply codes
+SUCCEEDED = 0x00
+GENERAL_FAILURE = 0x01
+NOT_ALLOWED = 0x02
+HOST_UNREACHABLE = 0x04
+CONNECTION_REFUSED = 0x05
+COMMAND_NOT_SUPPORTED = 0x07
+ADDRESS_NOT_SUPPORTED = 0x08
+
+
+class _SOCKSProtocol (protocol.Protocol):
+    """ SOCKS client connection, spliced with the channel protocol C{peer} once connected """
+
+    peer = None
+    version = None
+    destination = None
+    closed = False
+    released = False
+
+    def connectionMade(self):
+        self.state = 'greeting'
+        self.buffer = ''
+
+    def dataReceived(self, data):
+        if self.state == 'forwarding':
+            self.factory.forwarder.bytes_sent += len(data)
+            self.peer.transport.write(data)
+            return
+        self.buffer += data
+        if self.state == 'greeting':
+            self._greeting()
+        if self.state == 'request':
+            self._request()
+
+    def _greeting(self):
+        if not self.buffer:
+            return
+        self.version = ord(self.buffer[0])
+        if self.version == 4:
+            self.state = 'request'
+        elif self.version == 5:
+            if len(self.buffer) < 2 or len(self.buffer) < 2 + ord(self.buffer[1]):
+                return
+            methods = self.buffer[2:2 + ord(self.buffer[1])]
+            self.buffer = self.buffer[2 + len(methods):]
+            if '\x00' not in methods:
+                # only no authentication is supported
+                self.transport.write('\x05\xff')
+                self.transport.loseConnection()
+                self.state = 'failed'
+                return
+            self.transport.write('\x05\x00')
+            self.state = 'request'
+        else:
+            self.transport.loseConnection()
+            self.state = 'failed'
+
+    def _request(self):
+        if self.version == 4:
+            parsed = self._parseSOCKS4()
+        else:
+            parsed = self._parseSOCKS5()
+        if parsed is None:
+            return
+        command, host, port, length = parsed
+        self.buffer = self.buffer[length:]
+        if command != 1:
+            self.fail(COMMAND_NOT_SUPPORTED)
+            return
+        self.state = 'connecting'
+        # data sent ahead of the reply waits in the buffer for the channel
+        self.transport.pauseProducing()
+        self.factory.forwarder._open(self, host, port)
+
+    def _parseSOCKS4(self):
+        """ Returns C{(command, host, port, length)} of a complete request or C{None} """
+        end = self.buffer.find('\x00', 8)
+        if end < 0:
+            return None
+        command, port = struct.unpack('>xBH', self.buffer[:4])
+        address = self.buffer[4:8]
+        if address[:3] == '\x00\x00\x00' and address[3] != '\x00':
+            # SOCKS4a: the hostname follows the user id
+            host_end = self.buffer.find('\x00', end + 1)
+            if host_end < 0:
+                return None
+            return command, self.buffer[end + 1:host_end], port, host_end + 1
+        return command, socket.inet_ntoa(address), port, end + 1
+
+    def _parseSOCKS5(self):
+        """ Returns C{(command, host, port, length)} of a complete request or C{None} """
+        if len(self.buffer) < 5:
+            return None
+        if ord(self.buffer[0]) != 5 or self.buffer[2] != '\x00':
+            # not a request of the version greeted with, RSV must be zero
+            self.fail(GENERAL_FAILURE)
+            return None
+        command, address_type = ord(self.buffer[1]), ord(self.buffer[3])
+        if address_type == 1:
+            length = 4 + 4
+        elif address_type == 3:
+            length = 5 + ord(self.buffer[4])
+        elif address_type == 4:
+            length = 4 + 16
+        else:
+            self.fail(ADDRESS_NOT_SUPPORTED)
+            return None
+        if len(self.buffer) < length + 2:
+            return None
+        if address_type == 1:
+            host = socket.inet_ntoa(self.buffer[4:8])
+        elif address_type == 3:
+            host = self.buffer[5:length]
+        else:
+            host = socket.inet_ntop(socket.AF_INET6, self.buffer[4:20])
+        port, = struct.unpack('>H', self.buffer[length:length + 2])
+        return command, host, port, length + 2
+
+    def _reply(self, code):
+        if self.version == 4:
+            self.transport.write('\x00' + (code == SUCCEEDED and '\x5a' or '\x5b') + '\x00' * 6)
+        else:
+            self.transport.write('\x05' + chr(code) + '\x00\x01' + '\x00' * 6)
+
+    def fail(self, code):
+        """ Replies with an error and closes the connection """
+        self.state = 'failed'
+        self._reply(code)
+        self.transport.loseConnection()
+
+    def channelOpened(self, peer):
+        """ Replies and forwards data sent ahead of the reply, all in the same reactor iteration """
+        self.state = 'forwarding'
+        self.peer = peer
+        self._reply(SUCCEEDED)
+        if self.buffer:
+            data, self.buffer = self.buffer, ''
+            self.factory.forwarder.bytes_sent += len(data)
+            peer.transport.write(data)
+        self.transport.registerProducer(peer.transport, True)
+        peer.transport.registerProducer(self.transport, True)
+        self.transport.resumeProducing()
+
+    def connectionLost(self, reason):
+        self.closed = True
+        if self.peer is not None:
+            self.peer.transport.loseConnection()
+
+
+class _SOCKSFactory (protocol.ServerFactory):
+    protocol = _SOCKSProtocol
+    noisy = False
+
+    def __init__(self, forwarder):
+        self.forwarder = forwarder
+
+
+class _ChannelProtocol (protocol.Protocol):
+    """ Protocol of the direct-tcpip channel of a SOCKS connection """
+
+    def connectionMade(self):
+        socks = self.factory.socks
+        if socks.closed or socks.state != 'connecting':
+            self.transport.loseConnection()
+            return
+        socks.channelOpened(self)
+
+    def dataReceived(self, data):
+        self.factory.forwarder.bytes_received += len(data)
+        self.factory.socks.transport.write(data)
+
+    def connectionLost(self, reason):
+        socks = self.factory.socks
+        if not socks.closed:
+            socks.transport.loseConnection()
+        self.factory.forwarder._release(socks)
+
+
+class _ChannelFactory (protocol.ClientFactory):
+    protocol = _ChannelProtocol
+    noisy = False
+    channel = None
+
+    def __init__(self, forwarder, socks):
+        self.forwarder = forwarder
+        self.socks = socks
+
+    def startedConnecting(self, connector):
+        self.channel = connector.transport
+
+    def clientConnectionFailed(self, connector, reason):
+        self.forwarder._failed(reason, self.socks, self.channel)
+
+
+class SOCKSForwarder (object):
+    """
+    SOCKS server opening a direct-tcpip channel of C{sshconnection} for
+    every CONNECT request.
+
+    At most C{max_per_destination} channels to the same host are open or
+    opening at once, further requests are refused with a I{not allowed}
+    reply.  Channels not opened within C{timeout} seconds are refused with
+    I{host unreachable}.
+
+    @ivar sshconnection: the connection channels are opened on, may be
+        replaced, e.g. by a callback of L{ReconnectingConnection}
+    """
+
+    def __init__(self, sshconnection, max_per_destination=None, timeout=30):
+        """
+        @param sshconnection: connection to open channels on
+        @type sshconnection: L{SSHConnection}
+        @param max_per_destination: maximum channels to a single host,
+            C{None} for no limit
+        @type max_per_destination: C{int}
+        @param timeout: seconds to wait for a channel to open
+        """
+        self.sshconnection = sshconnection
+        self.max_per_destination = max_per_destination
+        self.timeout = timeout
+        self.ports = []
+        # host -> channels opening or open
+        self.destinations = {}
+
+        self.connects = 0
+        self.active = 0
+        self.failed = 0
+        self.rejected = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def listen(self, port, interface='127.0.0.1', backlog=1024):
+        """
+        Starts accepting SOCKS clients on C{port}.
+
+        @param interface: local address to listen on
+        @param backlog: size of the queue of connections not yet accepted
+        @return: the listening port
+        @rtype: L{twisted.internet.interfaces.IListeningPort}
+        """
+        listening = self.sshconnection.transport.sshclient.reactor.listenTCP(port, _SOCKSFactory(self), backlog, interface)
+        self.ports.append(listening)
+        return listening
+
+    def stopListening(self):
+        """ Stops accepting clients, forwarded connections are kept open """
+        ports, self.ports = self.ports, []
+        for listening in ports:
+            listening.stopListening()
+
+    def _open(self, socks, host, port):
+        destination = host.lower()
+        if self.max_per_destination is not None and self.destinations.get(destination, 0) >= self.max_per_destination:
+            self.rejected += 1
+            socks.fail(NOT_ALLOWED)
+            return
+        socks.destination = destination
+        self.destinations[destination] = self.destinations.get(destination, 0) + 1
+        self.connects += 1
+        self.active += 1
+        self.sshconnection.connectTCP(host, port, _ChannelFactory(self, socks), self.timeout)
+
+    def _failed(self, reason, socks, channel):
+        self.failed += 1
+        log.msg('SOCKS connect to %s failed: %s' % (socks.destination, reason.getErrorMessage()))
+        # an open given up on by a timeout is still pending on the
+        # connection until the other side confirms or refuses it
+        channel.channelClosedDefer.addCallback(lambda ignored: self._release(socks))
+        if socks.closed or socks.state != 'connecting':
+            return
+        if reason.check(error.TimeoutError):
+            socks.fail(HOST_UNREACHABLE)
+        elif reason.check(error.ConnectError):
+            socks.fail(CONNECTION_REFUSED)
+        else:
+            socks.fail(GENERAL_FAILURE)
+
+    def _release(self, socks):
+        """
+        Forgets the channel of C{socks} once, when it's closed or failed to
+        open.  A SOCKS client closed while its channel is opening, or whose
+        channel open timed out, keeps its destination slot until the channel
+        is closed or refused.
+        """
+        if socks.released:
+            return
+        socks.released = True
+        self.active -= 1
+        self.destinations[socks.destination] -= 1
+        if not self.destinations[socks.destination]:
+            del self.destinations[socks.destination]
+
+    def stats(self):
+        """
+        @return: C{active} channels opening or open, their number by
+            C{destinations} host, C{connects}, C{failed} and C{rejected}
+            requests and payload C{bytes_sent} and C{bytes_received}
+        @rtype: C{dict}
+        """
+        return {'active': self.active, 'destinations': dict(self.destinations), 'connects': self.connects,
+                'failed': self.failed, 'rejected': self.rejected,
+                'bytes_sent': self.bytes_sent, 'bytes_received': self.bytes_received}
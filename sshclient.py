@@ -3,13 +3,18 @@ L{SSHClient} is a high-level representation of a session with an SSH server
 based on usage and interface of C{paramiko.client.SSHClient}.
 """
 
-import os, sys, warnings, getpass
+import os, sys, time, errno, warnings, getpass
 from twisted.conch.ssh import transport, userauth, connection, keys
-from twisted.internet import defer, protocol, reactor
+from twisted.conch import error
+from twisted.internet import defer, protocol, reactor, threads
 from twisted.python import log, failure
 
 from directchannel import DirectTcpIpChannelConnector
-from hostkeys import HostKeys
+from hostkeys import HostKeys, HostKeysWriter, HostKeysReloader
+from caches import HostKeyVerificationCache, private_key_cache, auth_hint_cache
+from agent import ssh_agent
+from reconnect import ReconnectingConnection
+from resolver import ResolverCache, HappyEyeballsConnector
 from errors import *
 from policies import *
 
@@ -37,6 +42,10 @@ class SSHClient (object):
 
         client.addCallback(onConnect)
         client.addErrback(onConnectFailure)
+
+    To drive many concurrent connections with one client, sharing its host
+    keys, policy and caches, use L{open_connection} which returns a
+    L{Deferred} per connection.
     """
     def __init__(self, reactor):
         """
@@ -49,6 +58,16 @@ class SSHClient (object):
         self.system_host_keys = HostKeys()
         self.host_keys = HostKeys()
         self.missing_host_key_policy = RejectPolicy()
+        self.use_host_key_index = False
+        self.host_key_cache = HostKeyVerificationCache()
+        self.host_keys_filename = None
+        self.host_keys_writer = None
+        self.host_keys_reloaders = []
+        # None connects to hostnames with reactor.connectTCP
+        self.resolver = ResolverCache(reactor)
+        self.happy_eyeballs_delay = 0.25
+        # hostname (None for all hosts) -> {'ciphers': [...], 'macs': [...], 'key_exchanges': [...]}
+        self.algorithm_preferences = {}
         self.closeRequest = defer.Deferred()
         self.callback = None
         self.errback = None
@@ -60,8 +79,9 @@ class SSHClient (object):
         self.pkey = None
         self.key_filenames = []
         self.look_for_keys = False
+        self.allow_agent = False
     
-    def load_system_host_keys(self, filename=None):
+    def load_system_host_keys(self, filename=None, lazy=False, reload_interval=None):
         """
         Load host keys from a system (read-only) file.
         
@@ -76,6 +96,13 @@ class SSHClient (object):
 
         @param filename: the filename to read, or C{None}
         @type filename: str
+        @param lazy: defer parsing of keys until they are needed, see
+            L{HostKeys.load}
+        @type lazy: bool
+        @param reload_interval: if set, the file is checked every
+            C{reload_interval} seconds and changes are picked up without
+            blocking the reactor, see L{HostKeysReloader}
+        @type reload_interval: C{float}
 
         @raise IOError: if a filename was provided and the file could not be
             read
@@ -84,13 +111,22 @@ class SSHClient (object):
         if filename is None:
             filename = os.path.expanduser('~/.ssh/known_hosts')
             try:
-                self.system_host_keys.load(filename)
+                self._load_system_host_keys(filename, lazy, reload_interval)
             except IOError:
                 pass
             return
-        self.system_host_keys.load(filename)
+        self._load_system_host_keys(filename, lazy, reload_interval)
+
+    def _load_system_host_keys(self, filename, lazy, reload_interval):
+        if reload_interval is None:
+            self.system_host_keys.load(filename, lazy, self.use_host_key_index)
+            return
+        reloader = HostKeysReloader(self.system_host_keys, filename, self.reactor, reload_interval,
+                                    lazy, self.use_host_key_index)
+        reloader.start()
+        self.host_keys_reloaders.append(reloader)
 
-    def load_host_keys(self, filename):
+    def load_host_keys(self, filename, lazy=False):
         """
         Load host keys from a local host-key file.  Host keys read with this
         method will be checked I{after} keys loaded via L{load_system_host_keys}.
@@ -103,10 +139,54 @@ class SSHClient (object):
 
         @param filename: the filename to read
         @type filename: str
+        @param lazy: defer parsing of keys until they are needed, see
+            L{HostKeys.load}
+        @type lazy: bool
 
         @raise IOError: if the filename could not be read
         """
-        self.host_keys.load(filename)
+        self.host_keys_filename = filename
+        self.host_keys.load(filename, lazy, self.use_host_key_index)
+
+    def save_host_keys(self, filename):
+        """
+        Save the host keys back to a file.  Only the host keys loaded with
+        L{load_host_keys} (plus any added directly) will be saved -- not any
+        host keys loaded with L{load_system_host_keys}.
+
+        @param filename: the filename to save to
+        @type filename: str
+
+        @raise IOError: if the file could not be written
+        """
+        self.host_keys.save(filename)
+
+    def set_host_keys_write_behind(self, filename=None, interval=5.0, batch_size=100):
+        """
+        Persist host keys added to the local L{HostKeys} object (for example by
+        L{AutoAddPolicy}) in the background.  New keys are appended to the file
+        in batches, every C{interval} seconds or every C{batch_size} keys, in
+        the reactor thread pool; pending keys are written on reactor shutdown.
+
+        @param filename: the file to write, defaults to the last file loaded
+            with L{load_host_keys}
+        @type filename: str
+        @param interval: seconds between writes
+        @type interval: C{float}
+        @param batch_size: number of pending keys forcing a write
+        @type batch_size: C{int}
+        @return: the writer, its C{flush} and C{stop} methods return Deferreds
+        @rtype: L{HostKeysWriter}
+        """
+        if filename is None:
+            filename = self.host_keys_filename
+        if filename is None:
+            raise ValueError('No host keys file to write to')
+        if self.host_keys_writer is not None:
+            self.host_keys_writer.stop()
+        self.host_keys_writer = HostKeysWriter(self.host_keys, filename, self.reactor, interval, batch_size)
+        self.host_keys_writer.start()
+        return self.host_keys_writer
 
     def get_host_keys(self):
         """
@@ -118,6 +198,18 @@ class SSHClient (object):
         """
         return self.host_keys
     
+    def set_host_key_index(self, enabled):
+        """
+        Set whether host key files loaded from now on are looked up through a
+        compiled on-disk index kept next to them (see L{HostKeyIndex}) instead
+        of being parsed into memory.  The index is rebuilt automatically
+        whenever the file changes.
+
+        @param enabled: use compiled host key indexes
+        @type enabled: bool
+        """
+        self.use_host_key_index = enabled
+
     def set_missing_host_key_policy(self, policy):
         """
         Set the policy to use when connecting to a server that doesn't have a
@@ -131,6 +223,58 @@ class SSHClient (object):
         """
         self.missing_host_key_policy = policy
 
+    def set_preferred_algorithms(self, ciphers=None, macs=None, key_exchanges=None, hostname=None):
+        """
+        Set the algorithms offered first to all servers, or to C{hostname}
+        only.  Preferred algorithms are offered in the given order, followed
+        by the remaining supported ones in their default order; C{None} keeps
+        the default order of that kind.  A faster cipher and MAC can be found
+        with C{examples/benchmark_ciphers.py}::
+
+            client.set_preferred_algorithms(ciphers = ['aes128-ctr'], macs = ['hmac-sha1'])
+            client.set_preferred_algorithms(ciphers = ['aes256-ctr'], hostname = 'vault.example.com')
+
+        The negotiated algorithms and handshake time of a connection are
+        reported by L{SSHClientTransport.stats}.
+
+        @param ciphers: names of preferred ciphers
+        @type ciphers: list(str)
+        @param macs: names of preferred MACs
+        @type macs: list(str)
+        @param key_exchanges: names of preferred key exchange algorithms
+        @type key_exchanges: list(str)
+        @param hostname: the server the preferences apply to, C{None} for
+            the servers without own preferences
+        @type hostname: str
+
+        @raise ValueError: if an algorithm is not supported
+        """
+        preferences = {}
+        for kind, names in (('ciphers', ciphers), ('macs', macs), ('key_exchanges', key_exchanges)):
+            if names is None:
+                continue
+            supported = SSHClientTransport.supportedAlgorithms(kind)
+            unsupported = [name for name in names if name not in supported]
+            if unsupported:
+                raise ValueError('Unsupported %s: %s' % (kind, ', '.join(unsupported)))
+            preferences[kind] = list(names) + [name for name in supported if name not in names]
+        if preferences:
+            self.algorithm_preferences[hostname] = preferences
+        else:
+            self.algorithm_preferences.pop(hostname, None)
+
+    def get_preferred_algorithms(self, hostname=None):
+        """
+        @return: algorithms offered to C{hostname} by kind (C{ciphers},
+            C{macs}, C{key_exchanges}), in order of preference
+        @rtype: C{dict}
+        """
+        preferences = self.algorithm_preferences.get(hostname)
+        if preferences is None:
+            preferences = self.algorithm_preferences.get(None, {})
+        return dict([(kind, preferences.get(kind) or SSHClientTransport.supportedAlgorithms(kind))
+                     for kind in ('ciphers', 'macs', 'key_exchanges')])
+
     def close(self):
         """
         Close this SSHClient and its underlying L{SSHClientTransport}.
@@ -139,7 +283,7 @@ class SSHClient (object):
         self.closeRequest = defer.Deferred()
     disconnect = close
 
-    def connect(self, hostname, port = SSH_PORT, username = None, password = None, pkey = None, key_filename = None, timeout = None, look_for_keys = True, factory = protocol.ClientFactory):
+    def connect(self, hostname, port = SSH_PORT, username = None, password = None, pkey = None, key_filename = None, timeout = None, look_for_keys = True, factory = protocol.ClientFactory, allow_agent = True):
         """
         Connect to an SSH server and authenticate to it.  The server's host key
         is checked against the system host keys (see L{load_system_host_keys})
@@ -180,32 +324,96 @@ class SSHClient (object):
         @type look_for_keys: bool
         @param factory: factory to use, default is: L{twisted.internet.protocol.ClientFactory}
         @type factory: L{twisted.internet.protocol.ClientFactory}
+        @param allow_agent: set to False to disable connecting to the SSH agent
+            (see L{agent.ssh_agent})
+        @type allow_agent: bool
         """
+        settings = ConnectionSettings(hostname, port, username, password, pkey, key_filename, look_for_keys, allow_agent)
         
-        new_factory = type('SSHClientSpecializedFactoryOf%s' % factory.__name__, (SSHClientSpecializedFactory, factory), {})()
-        new_factory.protocol = SSHClientTransport
+        self.hostname = settings.hostname
+        self.port = settings.port
+        self.username = settings.username
+        self.password = settings.password
+        self.pkey = settings.pkey
+        self.key_filenames = settings.key_filenames
+        self.look_for_keys = settings.look_for_keys
+        self.allow_agent = settings.allow_agent
         
-        if username is None:
-            username = getpass.getuser()
-        
-        if key_filename is None:
-            key_filenames = []
-        elif isinstance(key_filename, (str, unicode)):
-            key_filenames = [ key_filename ]
-        else:
-            key_filenames = key_filename
+        self._connectTCP(settings, factory, timeout, None)
+        return self
+
+    def open_connection(self, hostname, port = SSH_PORT, username = None, password = None, pkey = None, key_filename = None, timeout = None, look_for_keys = True, factory = protocol.ClientFactory, allow_agent = True):
+        """
+        Connect to an SSH server and authenticate to it like L{connect}, but
+        report the result of this connection only through the returned
+        L{Deferred}.  Callbacks added with L{addCallback}/L{addErrback} aren't
+        called and L{close} doesn't close the connection, so a single
+        L{SSHClient} - with its host keys, policy and caches - can drive any
+        number of concurrent connections::
+
+            d = client.open_connection('ssh.example.com')
+            d.addCallback(onConnect)
+
+        The connection is closed with C{sshconnection.loseConnection()};
+        cancelling the L{Deferred} aborts a connection in progress.
+
+        Parameters are the same as those of L{connect}.
+
+        @return: L{Deferred} fired with the authenticated L{SSHConnection},
+            or failing with the reason the connection failed
+        """
+        settings = ConnectionSettings(hostname, port, username, password, pkey, key_filename, look_for_keys, allow_agent)
+        connectors = []
         
-        self.hostname = hostname
-        self.port = port
-        self.username = username
-        self.password = password
-        self.pkey = pkey
-        self.key_filenames = key_filenames
-        self.look_for_keys = look_for_keys
+        def cancel(d):
+            d.errback(defer.CancelledError())
+            for connector in connectors:
+                connector.disconnect()
         
+        d = defer.Deferred(cancel)
+        connectors.append(self._connectTCP(settings, factory, timeout, d))
+        return d
+
+    def open_persistent(self, hostname, port = SSH_PORT, username = None, initial_delay = 1.0, max_delay = 60.0, max_retries = None, **connect_kwargs):
+        """
+        Open a connection which is reconnected with jittered exponential
+        backoff whenever it's lost.  Tunnels opened with its C{connectTCP}
+        are reopened together on every new connection.
+
+        @param initial_delay: seconds before the first reconnect
+        @type initial_delay: float
+        @param max_delay: maximum seconds between reconnects
+        @type max_delay: float
+        @param max_retries: consecutive failures before giving up, C{None}
+            retries forever
+        @type max_retries: int
+        @param connect_kwargs: other parameters of L{open_connection}
+        @return: the started persistent connection
+        @rtype: L{ReconnectingConnection}
+        """
+        connect_kwargs.update(hostname = hostname, port = port, username = username)
+        persistent = ReconnectingConnection(self, connect_kwargs, initial_delay, max_delay, max_retries = max_retries)
+        persistent.start()
+        return persistent
+
+    def _connectTCP(self, settings, factory, timeout, connected):
+        """
+        Connects L{SSHClientTransport} for C{settings}.  Hostnames are
+        resolved through L{resolver} and connected to with
+        L{HappyEyeballsConnector}, trying the next address after
+        C{happy_eyeballs_delay} seconds.
+        """
+        new_factory = type('SSHClientSpecializedFactoryOf%s' % factory.__name__, (SSHClientSpecializedFactory, factory), {})()
+        new_factory.protocol = SSHClientTransport
         new_factory.sshclient = self
-        self.reactor.connectTCP(hostname, port, new_factory)
-        return self
+        new_factory.settings = settings
+        new_factory.connected = connected
+        if self.resolver is None:
+            return self.reactor.connectTCP(settings.hostname, settings.port, new_factory, timeout or 30)
+        connector = HappyEyeballsConnector(self.reactor, settings.hostname, settings.port, new_factory, timeout or 30,
+                                           self.resolver, self.happy_eyeballs_delay)
+        connector.connect()
+        return connector
     
     def addCallback(self, callback):
         """ Adds callback called after successful connection. Callback is called by L{SSHConnection.serviceStarted}"""
@@ -233,37 +441,139 @@ class SSHClient (object):
         if self.errback:
             self.errback(reason)
 
+class ConnectionSettings (object):
+    """
+    Parameters of a single connection made by L{SSHClient}, see
+    L{SSHClient.connect}.
+    """
+
+    def __init__(self, hostname, port = SSH_PORT, username = None, password = None, pkey = None, key_filename = None, look_for_keys = True, allow_agent = True):
+        if username is None:
+            username = getpass.getuser()
+        
+        if key_filename is None:
+            key_filenames = []
+        elif isinstance(key_filename, (str, unicode)):
+            key_filenames = [ key_filename ]
+        else:
+            key_filenames = key_filename
+        
+        self.hostname = hostname
+        self.port = port
+        self.username = username
+        self.password = password
+        self.pkey = pkey
+        self.key_filenames = key_filenames
+        self.look_for_keys = look_for_keys
+        self.allow_agent = allow_agent
+
 class SSHClientSpecializedFactory (object):
-    """ Specialized factory with support for calling errbacks by L{SSHClient}"""
+    """
+    Specialized factory with support for calling errbacks by L{SSHClient}
+
+    Connections made by L{SSHClient.open_connection} report failures to
+    their C{connected} Deferred instead.
+    """
+    
+    connected = None
     
     def buildProtocol(self, addr):
         """ Builds protocol """
         proto = super(SSHClientSpecializedFactory, self).buildProtocol(addr)
         proto.sshclient = self.sshclient
+        proto.settings = self.settings
         return proto
 
+    def _failed(self, reason):
+        """ Fails C{connected} with any reason, otherwise calls L{SSHClient} errorback with L{SSHException} """
+        if self.connected is not None:
+            if not self.connected.called:
+                self.connected.errback(reason)
+        elif isinstance(reason, SSHException) or (isinstance(reason, failure.Failure) and reason.check(SSHException)):
+            self.sshclient.processErrback(reason)
+
     def clientConnectionLost(self, connector, reason):
         """ Calls L{SSHClient} errorback before invoking orginal factory clientConnectionLost method """
-        if isinstance(reason, SSHException) or (isinstance(reason, failure.Failure) and reason.check(SSHException)):
-            self.sshclient.processErrback(reason)
+        self._failed(reason)
         return super(SSHClientSpecializedFactory, self).clientConnectionLost(connector, reason)
 
     def clientConnectionFailed(self, connector, reason):
         """ Calls L{SSHClient} errorback before invoking orginal factory clientConnectionLost method """
-        if isinstance(reason, SSHException) or (isinstance(reason, failure.Failure) and reason.check(SSHException)):
-            self.sshclient.processErrback(reason)
+        self._failed(reason)
         return super(SSHClientSpecializedFactory, self).clientConnectionFailed(connector, reason)
 
 class SSHClientTransport (transport.SSHClientTransport):
-    """ SSH Transport with hostkeys verification. """
-    
+    """
+    SSH Transport with hostkeys verification.
+
+    Offers the algorithms preferred for the server by
+    L{SSHClient.set_preferred_algorithms} and measures the handshake and
+    the payload bytes sent and received, see L{stats}.
+    """
+
+    started = None
+    secured = None
+    authenticated = None
+    bytes_sent = 0
+    bytes_received = 0
+
+    @classmethod
+    def supportedAlgorithms(cls, kind):
+        """
+        @param kind: C{ciphers}, C{macs} or C{key_exchanges}
+        @return: supported algorithms of C{kind} in default order
+        @rtype: list(str)
+        """
+        return list({'ciphers': cls.supportedCiphers,
+                     'macs': cls.supportedMACs,
+                     'key_exchanges': cls.supportedKeyExchanges}[kind])
+
+    def connectionMade(self):
+        """ Offers the preferred algorithms before sending our KEXINIT """
+        self.started = time.time()
+        preferences = self.sshclient.get_preferred_algorithms(self.settings.hostname)
+        self.supportedCiphers = preferences['ciphers']
+        self.supportedMACs = preferences['macs']
+        self.supportedKeyExchanges = preferences['key_exchanges']
+        transport.SSHClientTransport.connectionMade(self)
+
+    def sendPacket(self, messageType, payload):
+        self.bytes_sent += len(payload) + 1
+        transport.SSHClientTransport.sendPacket(self, messageType, payload)
+
+    def dispatchMessage(self, messageNum, payload):
+        self.bytes_received += len(payload) + 1
+        transport.SSHClientTransport.dispatchMessage(self, messageNum, payload)
+
+    def stats(self):
+        """
+        @return: negotiated C{kex}, C{cipher} and C{mac}, seconds to finish
+            the C{handshake} and to get C{authenticated} since connecting
+            (C{None} until done), and payload C{bytes_sent} and
+            C{bytes_received}
+        @rtype: C{dict}
+        """
+        encryptions = getattr(self, 'currentEncryptions', None)
+        return {'kex': getattr(self, 'kexAlg', None),
+                'cipher': encryptions and encryptions.outCipType,
+                'mac': encryptions and encryptions.outMACType,
+                'handshake': self.secured and self.secured - self.started,
+                'authenticated': self.authenticated and self.authenticated - self.started,
+                'bytes_sent': self.bytes_sent,
+                'bytes_received': self.bytes_received}
+
     def connectionSecure(self):
         """
         Called when the encryption has been set up.  Generally,
         requestService() is called to run another service over the transport.
         """
-        self.sshclient.closeRequest.addCallback(self.closeRequested)
-        self.requestService(SSHUserAuthClient(self.sshclient, SSHConnection()))
+        if self.secured is None:
+            self.secured = time.time()
+            log.msg('Key exchange with %s: %s, %s, %s in %.3f seconds' % (self.settings.hostname, self.kexAlg,
+                    self.currentEncryptions.outCipType, self.currentEncryptions.outMACType, self.secured - self.started))
+        if self.factory.connected is None:
+            self.sshclient.closeRequest.addCallback(self.closeRequested)
+        self.requestService(SSHUserAuthClient(self.sshclient, SSHConnection(), self.settings))
     
     def closeRequested(self, result):
         """ Callback for L{SSHClient.closeRequest}, loses current connection. """
@@ -272,30 +582,45 @@ class SSHClientTransport (transport.SSHClientTransport):
             self.loseConnection()
 
     def verifyHostKey(self, hostKey, fingerprint):
-        """ Host Keys verification """
+        """
+        Host Keys verification.  Keys found in L{SSHClient} host keys are
+        remembered in L{SSHClient.host_key_cache}, so reconnecting to the
+        same server skips parsing and comparing its key again.
+        """
+        if self.settings.port == SSH_PORT:
+            server_hostkey_name = self.settings.hostname
+        else:
+            server_hostkey_name = "[%s]:%d" % (self.settings.hostname, self.settings.port)
+
+        hostkeys = (self.sshclient.system_host_keys, self.sshclient.host_keys)
+        if self.sshclient.host_key_cache.check(hostkeys, server_hostkey_name, hostKey):
+            return defer.succeed(1)
+
         server_key = keys.Key.fromString(hostKey)
         keytype = server_key.type()
 
-        if self.sshclient.port == SSH_PORT:
-            server_hostkey_name = self.sshclient.hostname
-        else:
-            server_hostkey_name = "[%s]:%d" % (self.sshclient.hostname, self.sshclient.port)
-        
-        our_server_key = self.sshclient.system_host_keys.get(server_hostkey_name, {}).get(keytype, None)
-        if our_server_key is None:
-            our_server_key = self.sshclient.host_keys.get(server_hostkey_name, {}).get(keytype, None)
-        if our_server_key is None:
-            status = self.sshclient.missing_host_key_policy.missing_host_key(self.sshclient, server_hostkey_name, server_key)
-            if status is False:
-                self.transport.connectionLost(failure.Failure(UnknownHostKeyException(self.sshclient.hostname, server_key)))
+        for known_keys in hostkeys:
+            if known_keys.is_revoked(hostKey):
+                self.transport.connectionLost(failure.Failure(RevokedHostKeyException(self.settings.hostname, server_key)))
                 return defer.fail(0)
-            our_server_key = server_key
-        
-        if server_key != our_server_key:
-            self.transport.connectionLost(failure.Failure(BadHostKeyException(self.sshclient.hostname, server_key, our_server_key)))
+
+        # any matching line may hold the key, like in OpenSSH: a wildcard
+        # line doesn't shadow the lines of the host's own name
+        our_server_keys = []
+        for known_keys in hostkeys:
+            our_server_keys.extend(known_keys.get_keys(server_hostkey_name, keytype))
+        if server_key in our_server_keys:
+            self.sshclient.host_key_cache.add(hostkeys, server_hostkey_name, hostKey)
+            return defer.succeed(1)
+
+        if our_server_keys:
+            self.transport.connectionLost(failure.Failure(BadHostKeyException(self.settings.hostname, server_key, our_server_keys[0])))
             return defer.fail(0)
 
-        
+        status = self.sshclient.missing_host_key_policy.missing_host_key(self.sshclient, server_hostkey_name, server_key)
+        if status is False:
+            self.transport.connectionLost(failure.Failure(UnknownHostKeyException(self.settings.hostname, server_key)))
+            return defer.fail(0)
         return defer.succeed(1)
 
     # def connectionLost(self, reason):
@@ -321,18 +646,82 @@ class SSHConnection (connection.SSHConnection):
     An implementation of the 'ssh-connection' service.  It is used to
     multiplex multiple channels over the single SSH connection.
     
-    Notifies L{SSHClient} when service is started.
+    Notifies L{SSHClient} when service is started and fires
+    C{connectionLostDefer} when it's stopped.
+
+    @cvar window_budget: bytes the windows of all channels with adaptive
+        windows may grow to together, see L{directchannel}
+    @ivar rtt: smoothed round trip time in seconds, C{None} until measured
+        with L{measure_rtt}
     """
 
+    window_budget = 16 * 1024 * 1024
+
+    def __init__(self):
+        connection.SSHConnection.__init__(self)
+        self.connectionLostDefer = defer.Deferred()
+        self.rtt = None
+        # Deferreds waiting for the keepalive in flight, None without one
+        self._rtt_waiters = None
+
     def serviceStarted(self):
-        """ Calls L{SSHClient} callback when service is started. """
-        self.transport.sshclient.processCallback(self)
+        """
+        Fires the Deferred of L{SSHClient.open_connection} or calls
+        L{SSHClient} callback when service is started.
+        """
+        connected = self.transport.factory.connected
+        if connected is None:
+            self.transport.sshclient.processCallback(self)
+        elif not connected.called:
+            connected.callback(self)
+
+    def serviceStopped(self):
+        """ Fires C{connectionLostDefer} when the transport is lost. """
+        connection.SSHConnection.serviceStopped(self)
+        if not self.connectionLostDefer.called:
+            self.connectionLostDefer.callback(self)
 
     def loseConnection(self):
         """ Loses transport connection. """
         self.transport.loseConnection()
+
+    def measure_rtt(self):
+        """
+        Sends a keepalive, any reply - even a failure - updates L{rtt} like
+        TCP smooths its round trip time.  Calls made while a keepalive is in
+        flight wait for its reply.
+
+        @return: L{Deferred} fired with L{rtt}
+        """
+        d = defer.Deferred()
+        if self._rtt_waiters is not None:
+            self._rtt_waiters.append(d)
+            return d
+        self._rtt_waiters = [d]
+        reactor = self.transport.sshclient.reactor
+        sent = reactor.seconds()
+
+        def answered(result):
+            if not isinstance(result, failure.Failure) or result.check(error.ConchError):
+                sample = reactor.seconds() - sent
+                if self.rtt is None:
+                    self.rtt = sample
+                else:
+                    self.rtt = 0.875 * self.rtt + 0.125 * sample
+            waiters, self._rtt_waiters = self._rtt_waiters, None
+            for waiter in waiters:
+                waiter.callback(self.rtt)
+        self.sendGlobalRequest('keepalive@openssh.com', '', wantReply=1).addBoth(answered)
+        return d
+
+    def adjustWindow(self, channel, bytesToAdd):
+        """ Withholds window adjusts of paused channels, see L{DirectTcpIpChannelClient.pauseProducing} """
+        if getattr(channel, 'paused', False):
+            return
+        connection.SSHConnection.adjustWindow(self, channel, bytesToAdd)
     
-    def connectTCP(self, host, port, factory, timeout, reactor = None, loseconnection_on_protocollose = False, loseconnection_on_protocolfailed = False):
+    def connectTCP(self, host, port, factory, timeout, reactor = None, loseconnection_on_protocollose = False, loseconnection_on_protocolfailed = False,
+                   window_size = None, max_packet = None, max_window_size = None, coalesce_delay = None):
         """
         Helper method for L{DirectTcpIpChannelConnector}
 
@@ -350,11 +739,22 @@ class SSHConnection (connection.SSHConnection):
         @type reactor: L{twisted.internet.reactor}
         @param loseconnection_on_protocollose: when set loses L{twisted.conch.sshconnection.SSHConnection} when channel is loses it's own connection
         @param loseconnection_on_protocolfailed: when set loses L{twisted.conch.sshconnection.SSHConnection} when channel fails to connect
+        @param window_size: initial local window of the channel, default 128 KiB
+        @type window_size: C{int}
+        @param max_packet: maximum packet size the remote side may send, default 32 KiB
+        @type max_packet: C{int}
+        @param max_window_size: grow the window with the bandwidth-delay
+            product up to this size, within L{window_budget}
+        @type max_window_size: C{int}
+        @param coalesce_delay: merge small writes into full packets for up
+            to this many seconds, C{0} merges writes of one reactor iteration
+        @type coalesce_delay: C{float}
         @return: instance of C{DirectTcpIpChannelConnector}
         @rtype: L{DirectTcpIpChannelConnector}
         """
         reactor = reactor or self.transport.sshclient.reactor
-        connector = DirectTcpIpChannelConnector(self, host, port, factory, timeout, reactor, loseconnection_on_protocollose, loseconnection_on_protocolfailed)
+        connector = DirectTcpIpChannelConnector(self, host, port, factory, timeout, reactor, loseconnection_on_protocollose, loseconnection_on_protocolfailed,
+                                                window_size, max_packet, max_window_size, coalesce_delay)
         connector.connect()
         return connector
 
@@ -362,83 +762,165 @@ class SSHUserAuthClient (userauth.SSHUserAuthClient):
     """
     A service implementing the client side of 'ssh-userauth'.
     Supports password and multiple private keys verification (with password)
+
+    Every key is offered at most once per connection, in the order given by
+    L{auth_hints}: the key accepted last time by the same host, port and user
+    first, keys it rejected recently last.
+
+    @cvar key_cache: cache private key files are read through, shared by all
+        connections by default
+    @cvar auth_hints: L{AuthHintCache} updated with the keys accepted and
+        rejected by servers, shared by all connections by default
+    @cvar agent: L{SSHAgent} providing agent keys, its connection and
+        identity list are shared by all connections by default
     """
 
     keys_to_try = ['id_dsa', 'id_rsa']
     keys_iter = None
     current_key = None
+    key_cache = private_key_cache
+    auth_hints = auth_hint_cache
+    agent = ssh_agent
 
-    def __init__(self, sshclient, instance):
+    def __init__(self, sshclient, instance, settings):
         """
         @param sshclient: Instance of L{SSHClient}
         @param instance: Instance of L{twisted.conch.ssh.service.SSHService} here: L{SSHConnection}
+        @param settings: parameters of the connection
+        @type settings: L{ConnectionSettings}
         """
-        userauth.SSHUserAuthClient.__init__(self, sshclient.username, instance)
+        userauth.SSHUserAuthClient.__init__(self, settings.username, instance)
         self.sshclient = sshclient
+        self.settings = settings
         self.found_keys = []
         self.found_keys_iter = None
         self.current_pkey = None
-        self.collect_keys()
+        # blobs of the keys held by the agent
+        self.agent_blobs = set()
+        # Deferreds waiting for collect_keys, None once keys are collected
+        self._key_waiters = []
+        self.collect_keys().addCallback(self._keysCollected)
     
     def collect_keys(self):
-        """ Loads private keys from ~/.ssh/ or ~/ssh/ directory """
+        """
+        Collects the pkey and key_filename keys passed in, agent keys and
+        private keys from ~/.ssh/ or ~/ssh/ directory, tried in this order.  Keys are read through L{key_cache}, so repeated
+        connections don't read key files; keys not in the cache are read and
+        decrypted in the reactor thread pool, so other connections keep
+        running meanwhile.
 
-        def load_key_from_file(key_filename):
-            """ Helper function for loading keys with password """
-            try:
-                key = keys.Key.fromFile(key_filename)
-            except keys.EncryptedKeyError, e:
-                if self.sshclient.password:
-                    try:
-                        key = keys.Key.fromFile(key_filename, passphrase = self.sshclient.password)
-                    except keys.EncryptedKeyError, e:
-                        raise e
-                else:
-                    raise e
-            return key
-        
-        from itertools import cycle
-        found_keys = []
-        
-        if self.sshclient.pkey is not None:
-            log.msg('Adding SSH key %s' % self.sshclient.pkey.fingerprint())
-            found_keys.append(self.sshclient.pkey)
-        
-        for key_filename in self.sshclient.key_filenames:
-            pkey = load_key_from_file(key_filename)
-            log.msg('Adding SSH key %s from %s' % (pkey.fingerprint(), key_filename))
-            found_keys.append(pkey)
-            
-        if self.sshclient.look_for_keys:
+        @return: L{Deferred} fired with the list of keys found
+        """
+        # like paramiko: the keys passed in, then the agent, then ~/.ssh/
+        candidates = []
+        for key_filename in self.settings.key_filenames:
+            candidates.append((key_filename, True))
+        if self.settings.allow_agent and self.agent.available():
+            # None stands for the agent identities
+            candidates.append((None, False))
+        if self.settings.look_for_keys:
             for pkey_name in self.keys_to_try:
-                pkey_file = os.path.expanduser('~/.ssh/%s' % pkey_name)
-                if os.path.isfile(pkey_file):
-                    pkey = load_key_from_file(pkey_file)
-                    log.msg('Adding SSH key %s from %s' % (pkey.fingerprint(), pkey_file))
-                    found_keys.append(pkey)
-
-                pkey_file = os.path.expanduser('~/ssh/%s' % pkey_name)
-                if os.path.isfile(pkey_file):
-                    pkey = load_key_from_file(pkey_file)
-                    log.msg('Adding SSH key %s from %s' % (pkey.fingerprint(), pkey_file))
+                candidates.append((os.path.expanduser('~/.ssh/%s' % pkey_name), False))
+                candidates.append((os.path.expanduser('~/ssh/%s' % pkey_name), False))
+
+        reactor = self.sshclient.reactor
+        loading = []
+        for key_filename, required in candidates:
+            if key_filename is None:
+                loading.append(self.agent.identities())
+                continue
+            hit, pkey = self.key_cache.peek(key_filename, self.settings.password)
+            if hit:
+                loading.append(defer.succeed(pkey))
+            else:
+                loading.append(threads.deferToThreadPool(reactor, reactor.getThreadPool(), self.key_cache.load,
+                                                         key_filename, self.settings.password))
+        d = defer.DeferredList(loading, consumeErrors=True)
+        d.addCallback(self._cbCollectKeys, candidates)
+        return d
+
+    def _cbCollectKeys(self, results, candidates):
+        found_keys = []
+        # blobs of the keys in found_keys
+        seen = set()
+
+        if self.settings.pkey is not None:
+            log.msg('Adding SSH key %s' % self.settings.pkey.fingerprint())
+            found_keys.append(self.settings.pkey)
+            seen.add(self.settings.pkey.blob())
+
+        for (success, result), (key_filename, required) in zip(results, candidates):
+            if key_filename is None:
+                if not success:
+                    log.msg('Unable to get SSH agent keys: %s' % result.getErrorMessage())
+                    continue
+                for pkey in result:
+                    # keys passed in and held by the agent keep their place
+                    # and are signed with by the agent
+                    self.agent_blobs.add(pkey.blob())
+                    if pkey.blob() in seen:
+                        log.msg('SSH key %s is held by agent' % pkey.fingerprint())
+                        continue
+                    log.msg('Adding SSH key %s from agent' % pkey.fingerprint())
                     found_keys.append(pkey)
-            
-        self.found_keys = found_keys
-        self.found_keys_iter = cycle(self.found_keys)
-
+                    seen.add(pkey.blob())
+            elif not success:
+                log.msg('Unable to load SSH key from %s: %s' % (key_filename, result.getErrorMessage()))
+            elif result is None:
+                if required:
+                    log.msg('No such private key file: %s' % key_filename)
+            elif result.blob() in seen:
+                log.msg('SSH key %s from %s is already listed' % (result.fingerprint(), key_filename))
+            else:
+                log.msg('Adding SSH key %s from %s' % (result.fingerprint(), key_filename))
+                found_keys.append(result)
+                seen.add(result.blob())
+        return found_keys
+
+    def _keysCollected(self, found_keys):
+        self.found_keys = self.auth_hints.order(self._destination(), found_keys)
+        self.found_keys_iter = iter(self.found_keys)
+        waiters, self._key_waiters = self._key_waiters, None
+        for d in waiters:
+            d.callback(None)
+
+    def whenKeysCollected(self):
+        """
+        @return: L{Deferred} fired once L{collect_keys} finished
+        """
+        if self._key_waiters is None:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._key_waiters.append(d)
+        return d
+
+    def auth_publickey(self):
+        """ Waits for keys being collected before trying public key authentication. """
+        d = self.whenKeysCollected()
+        d.addCallback(lambda ignored: userauth.SSHUserAuthClient.auth_publickey(self))
+        return d
 
     def getPassword(self):
         """ Returns password if set """
-        if self.sshclient.password:
-            return defer.succeed(self.sshclient.password)
+        if self.settings.password:
+            return defer.succeed(self.settings.password)
         return None
     
+    def _destination(self):
+        """ Returns the key L{auth_hints} are stored under """
+        return (self.settings.hostname, self.settings.port, self.user)
+
     def getPublicKey(self):
         """ Return a public key, allows key rotation - methods gets called multiple times if key is not valid """
         if not self.found_keys:
             return
 
-        self.current_pkey = self.found_keys_iter.next()
+        if self.current_pkey is not None:
+            # called again only after the server refused the previous key
+            self.auth_hints.rejected(self._destination(), self.current_pkey)
+        self.current_pkey = next(self.found_keys_iter, None)
+        if self.current_pkey is None:
+            return
         return self.current_pkey.public()
 
     def getPrivateKey(self):
@@ -446,4 +928,19 @@ class SSHUserAuthClient (userauth.SSHUserAuthClient):
         if not self.current_pkey:
             return
         
-        return defer.succeed(self.current_pkey)
+        pkey = self.current_pkey
+        return self.whenKeysCollected().addCallback(lambda ignored: pkey)
+
+    def signData(self, publicKey, signData):
+        """ Signs with the agent when the key is held by it, otherwise with L{getPrivateKey} """
+        blob = publicKey.blob()
+        if blob in self.agent_blobs:
+            return self.agent.sign(blob, signData)
+        return userauth.SSHUserAuthClient.signData(self, publicKey, signData)
+
+    def ssh_USERAUTH_SUCCESS(self, packet):
+        """ Remembers the key accepted by the server for next connections. """
+        self.transport.authenticated = time.time()
+        if self.lastAuth == 'publickey' and self.current_pkey is not None:
+            self.auth_hints.accepted(self._destination(), self.current_pkey)
+        return userauth.SSHUserAuthClient.ssh_USERAUTH_SUCCESS(self, packet)
@@ -0,0 +1,3 @@
+"""
+Tests of I{TwistedSSHClient}, run with C{trial}.
+"""
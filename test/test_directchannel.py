@@ -0,0 +1,114 @@
+"""
+Tests of L{directchannel}.
+"""
+
+from twisted.internet import error, protocol, task
+from twisted.trial import unittest
+
+from ..directchannel import DirectTcpIpChannelClient
+
+
+class FakeConnection (object):
+    """ Records the channels closed and windows adjusted """
+
+    def __init__(self):
+        self.closed = []
+        self.adjusted = []
+
+    def sendClose(self, channel):
+        channel.localClosed = True
+        self.closed.append(channel)
+        if channel.remoteClosed:
+            channel.closed()
+
+    def receiveClose(self, channel):
+        """ Like L{twisted.conch.ssh.connection.SSHConnection.ssh_CHANNEL_CLOSE} """
+        channel.closeReceived()
+        channel.remoteClosed = True
+        if channel.localClosed:
+            channel.closed()
+
+    def adjustWindow(self, channel, bytesToAdd):
+        self.adjusted.append((channel, bytesToAdd))
+
+
+class Received (protocol.Protocol):
+
+    def connectionMade(self):
+        self.data = ''
+        self.reason = None
+
+    def dataReceived(self, data):
+        self.data += data
+
+    def connectionLost(self, reason):
+        self.reason = reason
+
+
+class FakeConnector (object):
+
+    def __init__(self):
+        self.connection = FakeConnection()
+        self.protocol = Received()
+
+    def buildProtocol(self, addr):
+        return self.protocol
+
+    def connectionLost(self, reason):
+        pass
+
+
+class PausedCloseTests (unittest.TestCase):
+    """ Data held while the channel is paused is delivered before it's closed """
+
+    def setUp(self):
+        self.connector = FakeConnector()
+        self.channel = DirectTcpIpChannelClient('127.0.0.1', 80, self.connector, task.Clock())
+        self.channel._connectDone()
+        self.protocol = self.connector.protocol
+
+    def test_closeWhilePaused(self):
+        self.channel.pauseProducing()
+        self.channel.dataReceived('x' * 5000)
+        self.connector.connection.receiveClose(self.channel)
+        self.assertEqual(self.protocol.data, '')
+        self.assertIdentical(self.protocol.reason, None)
+
+        self.channel.resumeProducing()
+        self.assertEqual(self.protocol.data, 'x' * 5000)
+        self.protocol.reason.trap(error.ConnectionDone)
+        self.assertEqual(self.connector.connection.closed, [self.channel])
+
+    def test_eofAndCloseWhilePaused(self):
+        self.channel.pauseProducing()
+        self.channel.dataReceived('x' * 3000)
+        self.channel.dataReceived('y' * 2000)
+        self.channel.eofReceived()
+        self.connector.connection.receiveClose(self.channel)
+        self.assertIdentical(self.protocol.reason, None)
+
+        self.channel.resumeProducing()
+        self.assertEqual(self.protocol.data, 'x' * 3000 + 'y' * 2000)
+        self.protocol.reason.trap(error.ConnectionDone)
+
+    def test_pausedAgainWhileDelivering(self):
+        self.channel.pauseProducing()
+        self.channel.dataReceived('a')
+        self.channel.dataReceived('b')
+        self.connector.connection.receiveClose(self.channel)
+        self.protocol.dataReceived = lambda data: (Received.dataReceived(self.protocol, data),
+                                                   self.channel.pauseProducing())
+        self.channel.resumeProducing()
+        self.assertEqual(self.protocol.data, 'a')
+        self.assertIdentical(self.protocol.reason, None)
+        self.channel.resumeProducing()
+        self.assertEqual(self.protocol.data, 'ab')
+        self.assertIdentical(self.protocol.reason, None)
+        self.channel.resumeProducing()
+        self.protocol.reason.trap(error.ConnectionDone)
+
+    def test_closeNotPaused(self):
+        self.channel.dataReceived('x')
+        self.connector.connection.receiveClose(self.channel)
+        self.assertEqual(self.protocol.data, 'x')
+        self.protocol.reason.trap(error.ConnectionDone)
@@ -0,0 +1,97 @@
+"""
+Tests of L{fleet}.
+"""
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from ..errors import CircuitOpenException, SSHRemoteErrorException
+from ..fleet import FleetConnector
+
+
+class FakeSSHClient (object):
+
+    def __init__(self):
+        self.reactor = task.Clock()
+        self.opened = []
+
+    def open_connection(self, hostname):
+        d = defer.Deferred()
+        self.opened.append(d)
+        return d
+
+
+class CircuitBreakerTests (unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.client = FakeSSHClient()
+        self.fleet = FleetConnector(self.client, concurrency=3, stagger=0, breaker_threshold=1,
+                                    breaker_timeout=10, clock=lambda: self.now, random=lambda: 0)
+        self.results = []
+
+    def runTargets(self, targets):
+        d = self.fleet.run(targets, on_result=lambda target, success, result: self.results.append(result))
+        self.flush()
+        return d
+
+    def flush(self):
+        for i in xrange(10):
+            self.client.reactor.advance(0)
+
+    def openCircuit(self):
+        self.runTargets(['host'])
+        self.client.opened.pop().errback(SSHRemoteErrorException(2, 'protocol error'))
+        self.flush()
+        self.assertTrue(self.fleet.circuit_open('host'))
+        self.now = 20.0
+        del self.results[:]
+
+    def test_skipped(self):
+        self.openCircuit()
+        self.now = 5.0
+        self.runTargets(['host', 'host'])
+        self.assertEqual(self.client.opened, [])
+        self.assertEqual(len(self.results), 2)
+
+    def test_singleProbe(self):
+        """
+        After the timeout a single target is connected, the others fail fast
+        while it's running.
+        """
+        self.openCircuit()
+        self.runTargets(['host', 'host', 'host'])
+        self.assertEqual(len(self.client.opened), 1)
+        self.assertEqual(len(self.results), 2)
+        for result in self.results:
+            result.trap(CircuitOpenException)
+
+    def test_probeSucceeded(self):
+        self.openCircuit()
+        self.runTargets(['host', 'host'])
+        self.client.opened.pop().callback('connection')
+        self.flush()
+        self.assertEqual(self.fleet.circuit_open('host'), None)
+        self.runTargets(['host', 'host'])
+        self.assertEqual(len(self.client.opened), 2)
+
+    def test_probeFailed(self):
+        self.openCircuit()
+        self.runTargets(['host'])
+        self.client.opened.pop().errback(SSHRemoteErrorException(2, 'protocol error'))
+        self.flush()
+        self.assertEqual(self.fleet.circuit_open('host'), 30.0)
+        self.runTargets(['host'])
+        self.assertEqual(self.client.opened, [])
+
+    def test_probeNotCounted(self):
+        """
+        A probe failing with an error not counted by the breaker lets the next
+        target probe.
+        """
+        self.openCircuit()
+        self.runTargets(['host'])
+        self.client.opened.pop().errback(ValueError())
+        self.flush()
+        self.runTargets(['host', 'host'])
+        self.assertEqual(len(self.client.opened), 1)
@@ -0,0 +1,234 @@
+"""
+Tests of L{hostkeys}.
+"""
+
+import base64, os
+
+from Crypto.Hash import SHA, HMAC
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import rsa
+from twisted.conch.ssh import keys
+from twisted.conch.test import keydata
+from twisted.internet import task
+from twisted.python import failure
+from twisted.trial import unittest
+
+from ..hostkeys import HashedHostMatcher, HostKeys, HostKeysReloader, HostPatternMatcher, SQLiteHostKeys
+
+
+RSA_KEY = keys.Key.fromString(keydata.publicRSA_openssh)
+RSA_BLOB = base64.b64encode(RSA_KEY.blob())
+OTHER_KEY = keys.Key(rsa.generate_private_key(65537, 1024, default_backend()).public_key())
+OTHER_BLOB = base64.b64encode(OTHER_KEY.blob())
+
+
+class HashedHostMatcherTests (unittest.TestCase):
+
+    def test_match(self):
+        matcher = HashedHostMatcher()
+        for i in xrange(20):
+            salt = chr(i) * 20
+            matcher.add(salt, HMAC.HMAC(salt, 'host%d.example.com' % i, SHA).digest(), i)
+        self.assertEqual(len(matcher), 20)
+        self.assertEqual(matcher.match('host7.example.com'), [7])
+        self.assertEqual(matcher.match('host7.example.org'), [])
+
+    def test_sharedSalt(self):
+        matcher = HashedHostMatcher()
+        salt = 's' * 20
+        matcher.add(salt, HMAC.HMAC(salt, 'a', SHA).digest(), 1)
+        matcher.add(salt, HMAC.HMAC(salt, 'b', SHA).digest(), 2)
+        matcher.add(salt, HMAC.HMAC(salt, 'a', SHA).digest(), 3)
+        self.assertEqual(len(matcher), 1)
+        self.assertEqual(sorted(matcher.match('a')), [1, 3])
+        self.assertEqual(matcher.match('b'), [2])
+
+    def test_hashHost(self):
+        hashed = HostKeys.hash_host('host.example.com')
+        salt, digest = [s.decode('base64') for s in hashed.split('|')[2:4]]
+        matcher = HashedHostMatcher()
+        matcher.add(salt, digest, 'entry')
+        self.assertEqual(matcher.match('host.example.com'), ['entry'])
+
+
+class HostKeyDatabaseCacheTests (unittest.TestCase):
+    """ Entries read from a L{SQLiteHostKeys} database are cached, bounded """
+
+    def setUp(self):
+        self.hostkeys = SQLiteHostKeys(':memory:')
+        self.hostkeys.database._entries.maxsize = 4
+        self.hostkeys.database.insert_lines(['host%d.example.com ssh-rsa %s' % (i, RSA_BLOB) for i in xrange(10)])
+
+    def test_bounded(self):
+        for i in xrange(10):
+            self.assertEqual(self.hostkeys.lookup('host%d.example.com' % i)['RSA'].blob(), RSA_KEY.blob())
+        self.assertEqual(len(self.hostkeys.database._entries), 4)
+        self.assertEqual(len(self.hostkeys.keys()), 10)
+        self.assertEqual(len(self.hostkeys.database._entries), 4)
+
+    def test_changeEvicted(self):
+        entries = self.hostkeys.lookup('host1.example.com')
+        for i in xrange(2, 10):
+            self.hostkeys.lookup('host%d.example.com' % i)
+        self.hostkeys.add('host1.example.com', 'RSA', OTHER_KEY)
+        for i in xrange(2, 10):
+            self.hostkeys.lookup('host%d.example.com' % i)
+        self.assertTrue(self.hostkeys.check('host1.example.com', OTHER_KEY))
+        self.assertFalse(self.hostkeys.check('host1.example.com', RSA_KEY))
+        self.assertIn('host1.example.com ssh-rsa %s\n' % OTHER_BLOB, self.hostkeys.to_lines())
+
+
+class HostPatternMatcherTests (unittest.TestCase):
+
+    def test_suffix(self):
+        matcher = HostPatternMatcher()
+        matcher.add('*.example.com', 1)
+        self.assertEqual(matcher.match('host.example.com'), [1])
+        self.assertEqual(matcher.match('a.b.example.com'), [1])
+        self.assertEqual(matcher.match('example.com'), [])
+        self.assertEqual(matcher.match('host.example.org'), [])
+
+    def test_wildcards(self):
+        matcher = HostPatternMatcher()
+        matcher.add('host?.example.com', 1)
+        matcher.add('10.0.*.1', 2)
+        matcher.add('*', 3)
+        self.assertEqual(sorted(matcher.match('host1.example.com')), [1, 3])
+        self.assertEqual(matcher.match('host12.example.com'), [3])
+        self.assertEqual(sorted(matcher.match('10.0.5.1')), [2, 3])
+        self.assertEqual(matcher.match('10.0.5.2'), [3])
+
+    def test_literalCharacters(self):
+        matcher = HostPatternMatcher()
+        matcher.add('[host*]:2222', 1)
+        self.assertEqual(matcher.match('[host1]:2222'), [1])
+        self.assertEqual(matcher.match('host1:2222'), [])
+
+
+class HostKeysMatchingTests (unittest.TestCase):
+    """ Keys of lines with patterns, negations and markers """
+
+    def load(self, *lines):
+        filename = self.mktemp()
+        f = open(filename, 'w')
+        f.write(''.join([line + '\n' for line in lines]))
+        f.close()
+        hostkeys = HostKeys()
+        hostkeys.load(filename)
+        return hostkeys
+
+    def test_wildcard(self):
+        hostkeys = self.load('*.example.com ssh-rsa ' + RSA_BLOB)
+        self.assertTrue(hostkeys.check('host.example.com', RSA_KEY))
+        self.assertFalse(hostkeys.check('host.example.org', RSA_KEY))
+
+    def test_wildcardDoesNotShadow(self):
+        hostkeys = self.load('*.example.com ssh-rsa ' + RSA_BLOB,
+                             'host.example.com ssh-rsa ' + OTHER_BLOB)
+        self.assertTrue(hostkeys.check('host.example.com', OTHER_KEY))
+        self.assertTrue(hostkeys.check('host.example.com', RSA_KEY))
+        self.assertFalse(hostkeys.check('other.example.com', OTHER_KEY))
+        self.assertEqual(hostkeys.get_keys('host.example.com', 'RSA'), [RSA_KEY, OTHER_KEY])
+
+    def test_hashedAndWildcard(self):
+        hostkeys = self.load('*.example.com ssh-rsa ' + RSA_BLOB,
+                             HostKeys.hash_host('host.example.com') + ' ssh-rsa ' + OTHER_BLOB)
+        self.assertTrue(hostkeys.check('host.example.com', OTHER_KEY))
+
+    def test_negation(self):
+        hostkeys = self.load('*.example.com,!bad.example.com ssh-rsa ' + RSA_BLOB)
+        self.assertTrue(hostkeys.check('good.example.com', RSA_KEY))
+        self.assertFalse(hostkeys.check('bad.example.com', RSA_KEY))
+        self.assertEqual(hostkeys.lookup('bad.example.com'), None)
+
+    def test_revoked(self):
+        hostkeys = self.load('host.example.com ssh-rsa ' + RSA_BLOB,
+                             '@revoked * ssh-rsa ' + RSA_BLOB)
+        self.assertTrue(hostkeys.is_revoked(RSA_KEY.blob()))
+        self.assertFalse(hostkeys.is_revoked(OTHER_KEY.blob()))
+        self.assertFalse(hostkeys.check('host.example.com', RSA_KEY))
+
+    def test_certAuthority(self):
+        hostkeys = self.load('@cert-authority *.example.com ssh-rsa ' + RSA_BLOB)
+        self.assertEqual(hostkeys.lookup('host.example.com'), None)
+        self.assertFalse(hostkeys.check('host.example.com', RSA_KEY))
+        self.assertEqual(hostkeys.to_lines(), ['@cert-authority *.example.com ssh-rsa %s\n' % RSA_BLOB])
+
+
+class SynchronousThreadPool (object):
+
+    def callInThreadWithCallback(self, onResult, function, *args, **kwargs):
+        try:
+            result = function(*args, **kwargs)
+        except:
+            onResult(False, failure.Failure())
+        else:
+            onResult(True, result)
+
+
+class SynchronousReactor (task.Clock):
+    """ Clock running thread pool calls at once """
+
+    def getThreadPool(self):
+        return SynchronousThreadPool()
+
+    def callFromThread(self, function, *args, **kwargs):
+        function(*args, **kwargs)
+
+
+class HostKeysReloaderTests (unittest.TestCase):
+
+    def setUp(self):
+        self.filename = self.mktemp()
+        self.mtime = 1000000000
+        self.write('host.example.com ssh-rsa %s\n' % RSA_BLOB)
+        self.hostkeys = HostKeys()
+        self.reactor = SynchronousReactor()
+        self.reloader = HostKeysReloader(self.hostkeys, self.filename, self.reactor, interval=1)
+        self.reloader.start()
+        self.addCleanup(self.reloader.stop)
+
+    def write(self, data, mode='w'):
+        f = open(self.filename, mode)
+        f.write(data)
+        f.close()
+        self.mtime += 10
+        os.utime(self.filename, (self.mtime, self.mtime))
+
+    def test_append(self):
+        self.write('other.example.com ssh-rsa %s\n' % OTHER_BLOB, 'a')
+        self.reactor.advance(1)
+        self.assertEqual((self.reloader.tail_loads, self.reloader.reloads), (1, 0))
+        self.assertTrue(self.hostkeys.check('other.example.com', OTHER_KEY))
+        self.assertTrue(self.hostkeys.check('host.example.com', RSA_KEY))
+
+    def test_rewriteSameSize(self):
+        self.write('last.example.com ssh-rsa %s\n' % RSA_BLOB, 'a')
+        self.reactor.advance(1)
+        size = os.path.getsize(self.filename)
+        # the rotated key is shorter, a comment keeps the size of the file
+        # and the end of the file is unchanged
+        line = 'host.example.com ssh-rsa %s\n' % OTHER_BLOB
+        last = 'last.example.com ssh-rsa %s\n' % RSA_BLOB
+        f = open(self.filename, 'r+')
+        f.truncate(0)
+        f.write(line + '#' * (size - len(line) - len(last) - 1) + '\n' + last)
+        f.close()
+        self.assertEqual(os.path.getsize(self.filename), size)
+        self.mtime += 10
+        os.utime(self.filename, (self.mtime, self.mtime))
+        self.reactor.advance(1)
+        self.assertEqual(self.reloader.reloads, 1)
+        self.assertTrue(self.hostkeys.check('host.example.com', OTHER_KEY))
+        self.assertFalse(self.hostkeys.check('host.example.com', RSA_KEY))
+        self.assertTrue(self.hostkeys.check('last.example.com', RSA_KEY))
+
+    def test_partialLine(self):
+        line = 'other.example.com ssh-rsa %s\n' % OTHER_BLOB
+        self.write(line[:20], 'a')
+        self.reactor.advance(1)
+        self.assertFalse(self.hostkeys.check('other.example.com', OTHER_KEY))
+        self.write(line[20:], 'a')
+        self.reactor.advance(1)
+        self.assertTrue(self.hostkeys.check('other.example.com', OTHER_KEY))
+        self.assertEqual(self.reloader.reloads, 0)
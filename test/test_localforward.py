@@ -0,0 +1,87 @@
+"""
+Tests of L{localforward}.
+"""
+
+from twisted.internet import address, defer, task
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from ..directchannel import DirectTcpIpChannelConnector
+from ..localforward import LocalForwarder, _LocalFactory
+from .test_directchannel import FakeConnection
+
+
+class FakeSSHConnection (FakeConnection):
+    """ Opens direct-tcpip channels, recording them instead of sending the open """
+
+    def __init__(self, reactor):
+        FakeConnection.__init__(self)
+        self.reactor = reactor
+        self.opening = []
+        self.sent = []
+        self.transport = self
+        self.transport.transport = self
+
+    def getHost(self):
+        return address.IPv4Address('TCP', '127.0.0.1', 22)
+
+    def openChannel(self, channel, extra=''):
+        self.opening.append(channel)
+
+    def sendData(self, channel, data):
+        self.sent.append((channel, data))
+
+    def connectTCP(self, host, port, factory, timeout):
+        connector = DirectTcpIpChannelConnector(self, host, port, factory, timeout, self.reactor)
+        connector.connect()
+        return connector
+
+
+class FakePool (object):
+
+    def __init__(self):
+        self.reactor = task.Clock()
+        self.sshconnection = FakeSSHConnection(self.reactor)
+        self.leased = 0
+
+    def acquire(self, hostname, port, username, **kwargs):
+        self.leased += 1
+        return defer.succeed(self.sshconnection)
+
+    def release(self, sshconnection):
+        self.leased -= 1
+
+
+class LeaseTests (unittest.TestCase):
+    """ The lease of a channel is kept until the channel is gone """
+
+    def setUp(self):
+        self.pool = FakePool()
+        self.forwarder = LocalForwarder(self.pool, ['bastion'], 'db', 5432, username='user', timeout=10)
+        self.local = _LocalFactory(self.forwarder).buildProtocol(None)
+        self.local.makeConnection(proto_helpers.StringTransport())
+        self.pool.reactor.advance(0)
+        self.channel, = self.pool.sshconnection.opening
+
+    def timeout(self):
+        self.pool.reactor.advance(10)
+        self.assertTrue(self.local.transport.disconnecting)
+        self.assertEqual(self.forwarder.failed, 1)
+        self.assertEqual(self.pool.leased, 1)
+
+    def test_refused(self):
+        self.channel.openFailed(Exception('refused'))
+        self.assertEqual(self.pool.leased, 0)
+
+    def test_lateOpenAfterTimeout(self):
+        self.timeout()
+        self.channel.channelOpen('')
+        self.assertEqual(self.pool.sshconnection.closed, [self.channel])
+        self.assertEqual(self.pool.leased, 1)
+        self.pool.sshconnection.receiveClose(self.channel)
+        self.assertEqual(self.pool.leased, 0)
+
+    def test_refusedAfterTimeout(self):
+        self.timeout()
+        self.channel.openFailed(Exception('refused'))
+        self.assertEqual(self.pool.leased, 0)
@@ -0,0 +1,213 @@
+"""
+Tests of L{socksforward}.
+"""
+
+import socket
+
+from twisted.internet import error
+from twisted.python import failure
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from ..socksforward import SOCKSForwarder, _SOCKSFactory
+from .test_localforward import FakePool
+
+
+def reply(code):
+    return '\x05' + chr(code) + '\x00\x01' + '\x00' * 6
+
+
+class SOCKSTestCase (unittest.TestCase):
+
+    def setUp(self):
+        pool = FakePool()
+        self.reactor = pool.reactor
+        self.sshconnection = pool.sshconnection
+        self.forwarder = SOCKSForwarder(self.sshconnection, max_per_destination=1, timeout=10)
+
+    def connect(self):
+        socks = _SOCKSFactory(self.forwarder).buildProtocol(None)
+        socks.makeConnection(proto_helpers.StringTransport())
+        return socks
+
+    def send(self, socks, data, bytewise=True):
+        if bytewise:
+            for c in data:
+                socks.dataReceived(c)
+        else:
+            socks.dataReceived(data)
+        self.reactor.advance(0)
+
+    def disconnect(self, socks):
+        socks.connectionLost(failure.Failure(error.ConnectionDone()))
+
+    def channel(self):
+        """ Returns the only channel opened so far """
+        channel, = self.sshconnection.opening
+        return channel
+
+
+class ParserTests (SOCKSTestCase):
+    """ Requests are parsed once complete, however they're split """
+
+    def test_socks4(self):
+        socks = self.connect()
+        self.send(socks, '\x04\x01\x00\x50' + socket.inet_aton('10.0.0.1') + 'user\x00')
+        channel = self.channel()
+        self.assertEqual((channel.host, channel.port), ('10.0.0.1', 80))
+        self.assertEqual(socks.transport.value(), '')
+
+    def test_socks4a(self):
+        socks = self.connect()
+        self.send(socks, '\x04\x01\x00\x50\x00\x00\x00\x01user\x00Example.COM\x00')
+        channel = self.channel()
+        self.assertEqual((channel.host, channel.port), ('Example.COM', 80))
+        self.assertEqual(self.forwarder.destinations, {'example.com': 1})
+
+    def test_socks5Domain(self):
+        socks = self.connect()
+        self.send(socks, '\x05\x01\x00')
+        self.assertEqual(socks.transport.value(), '\x05\x00')
+        self.send(socks, '\x05\x01\x00\x03\x0bexample.com\x01\xbb')
+        channel = self.channel()
+        self.assertEqual((channel.host, channel.port), ('example.com', 443))
+
+    def test_socks5IPv6(self):
+        socks = self.connect()
+        self.send(socks, '\x05\x01\x00\x05\x01\x00\x04' + socket.inet_pton(socket.AF_INET6, '::1') + '\x00\x16',
+                  bytewise=False)
+        channel = self.channel()
+        self.assertEqual((channel.host, channel.port), ('::1', 22))
+
+    def test_noAcceptableMethod(self):
+        socks = self.connect()
+        self.send(socks, '\x05\x01\x02')
+        self.assertEqual(socks.transport.value(), '\x05\xff')
+        self.assertTrue(socks.transport.disconnecting)
+
+    def test_unknownVersion(self):
+        socks = self.connect()
+        self.send(socks, '\x06')
+        self.assertEqual(socks.transport.value(), '')
+        self.assertTrue(socks.transport.disconnecting)
+
+    def test_requestVersion(self):
+        socks = self.connect()
+        self.send(socks, '\x05\x01\x00' + '\x04\x01\x00\x01' + socket.inet_aton('10.0.0.1') + '\x00\x50')
+        self.assertEqual(socks.transport.value(), '\x05\x00' + reply(0x01))
+        self.assertTrue(socks.transport.disconnecting)
+        self.assertEqual(self.sshconnection.opening, [])
+
+    def test_reserved(self):
+        socks = self.connect()
+        self.send(socks, '\x05\x01\x00' + '\x05\x01\x01\x01' + socket.inet_aton('10.0.0.1') + '\x00\x50')
+        self.assertEqual(socks.transport.value(), '\x05\x00' + reply(0x01))
+        self.assertEqual(self.sshconnection.opening, [])
+
+    def test_addressType(self):
+        socks = self.connect()
+        self.send(socks, '\x05\x01\x00' + '\x05\x01\x00\x02' + socket.inet_aton('10.0.0.1') + '\x00\x50')
+        self.assertEqual(socks.transport.value(), '\x05\x00' + reply(0x08))
+        self.assertEqual(self.sshconnection.opening, [])
+
+    def test_command(self):
+        socks = self.connect()
+        self.send(socks, '\x05\x01\x00' + '\x05\x02\x00\x01' + socket.inet_aton('10.0.0.1') + '\x00\x50')
+        self.assertEqual(socks.transport.value(), '\x05\x00' + reply(0x07))
+        self.assertTrue(socks.transport.disconnecting)
+
+    def test_socks4Command(self):
+        socks = self.connect()
+        self.send(socks, '\x04\x02\x00\x50' + socket.inet_aton('10.0.0.1') + '\x00')
+        self.assertEqual(socks.transport.value(), '\x00\x5b' + '\x00' * 6)
+        self.assertEqual(self.sshconnection.opening, [])
+
+
+class ReplyTests (SOCKSTestCase):
+
+    def test_succeeded(self):
+        """
+        Data sent ahead of the reply is forwarded once the channel is open.
+        """
+        socks = self.connect()
+        self.send(socks, '\x05\x01\x00' + '\x05\x01\x00\x01' + socket.inet_aton('10.0.0.1') + '\x00\x50' + 'GET',
+                  bytewise=False)
+        channel = self.channel()
+        # set by the connection from the open confirmation
+        channel.remoteWindowLeft = channel.remoteMaxPacket = 32768
+        channel.channelOpen('')
+        self.assertEqual(socks.transport.value(), '\x05\x00' + reply(0x00))
+        self.assertEqual(self.sshconnection.sent, [(channel, 'GET')])
+        self.assertEqual(self.forwarder.bytes_sent, 3)
+
+    def test_socks4Succeeded(self):
+        socks = self.connect()
+        self.send(socks, '\x04\x01\x00\x50' + socket.inet_aton('10.0.0.1') + '\x00')
+        self.channel().channelOpen('')
+        self.assertEqual(socks.transport.value(), '\x00\x5a' + '\x00' * 6)
+
+    def test_refused(self):
+        socks = self.connect()
+        self.send(socks, '\x05\x01\x00' + '\x05\x01\x00\x01' + socket.inet_aton('10.0.0.1') + '\x00\x50')
+        self.channel().openFailed(Exception('refused'))
+        self.assertEqual(socks.transport.value(), '\x05\x00' + reply(0x05))
+        self.assertEqual(self.forwarder.stats()['failed'], 1)
+
+    def test_timeout(self):
+        socks = self.connect()
+        self.send(socks, '\x05\x01\x00' + '\x05\x01\x00\x01' + socket.inet_aton('10.0.0.1') + '\x00\x50')
+        self.reactor.advance(10)
+        self.assertEqual(socks.transport.value(), '\x05\x00' + reply(0x04))
+
+
+class DestinationLimitTests (SOCKSTestCase):
+    """ A destination slot is held until the channel is closed or refused """
+
+    request = '\x04\x01\x00\x50\x00\x00\x00\x01\x00example.com\x00'
+
+    def test_notAllowed(self):
+        self.send(self.connect(), self.request)
+        socks = self.connect()
+        self.send(socks, self.request)
+        self.assertEqual(socks.transport.value(), '\x00\x5b' + '\x00' * 6)
+        self.assertEqual(self.forwarder.rejected, 1)
+        self.assertEqual(len(self.sshconnection.opening), 1)
+
+    def test_channelClosed(self):
+        socks = self.connect()
+        self.send(socks, self.request)
+        channel = self.channel()
+        channel.channelOpen('')
+        self.disconnect(socks)
+        self.assertEqual(self.forwarder.destinations, {})
+        self.assertEqual(self.forwarder.active, 0)
+
+    def test_closedWhileOpening(self):
+        socks = self.connect()
+        self.send(socks, self.request)
+        self.disconnect(socks)
+        self.assertEqual(self.forwarder.destinations, {'example.com': 1})
+        channel = self.channel()
+        channel.channelOpen('')
+        self.assertEqual(self.sshconnection.closed, [channel])
+        self.assertEqual(self.forwarder.destinations, {})
+
+    def test_timeout(self):
+        socks = self.connect()
+        self.send(socks, self.request)
+        self.reactor.advance(10)
+        self.disconnect(socks)
+        self.assertEqual(self.forwarder.destinations, {'example.com': 1})
+        channel = self.channel()
+        channel.channelOpen('')
+        self.assertEqual(self.forwarder.destinations, {'example.com': 1})
+        self.sshconnection.receiveClose(channel)
+        self.assertEqual(self.forwarder.destinations, {})
+        self.assertEqual(self.forwarder.active, 0)
+
+    def test_refusedAfterTimeout(self):
+        socks = self.connect()
+        self.send(socks, self.request)
+        self.reactor.advance(10)
+        self.channel().openFailed(Exception('refused'))
+        self.assertEqual(self.forwarder.destinations, {})
@@ -0,0 +1,100 @@
+"""
+Tests of L{sshclient}.
+"""
+
+from twisted.conch.ssh import keys
+from twisted.conch.test import keydata
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from ..caches import AuthHintCache, PrivateKeyCache
+from ..sshclient import ConnectionSettings, SSHClient, SSHClientTransport, SSHConnection, SSHUserAuthClient
+from ..errors import BadHostKeyException, UnknownHostKeyException
+from .test_hostkeys import RSA_BLOB, RSA_KEY, OTHER_BLOB, OTHER_KEY, SynchronousReactor
+
+
+class FakeTransport (object):
+
+    def __init__(self):
+        self.lost = []
+
+    def connectionLost(self, reason):
+        self.lost.append(reason)
+
+
+class VerifyHostKeyTests (unittest.TestCase):
+
+    def setUp(self):
+        self.client = SSHClient(task.Clock())
+        filename = self.mktemp()
+        f = open(filename, 'w')
+        f.write('*.example.com ssh-rsa %s\nhost.example.com ssh-rsa %s\n' % (RSA_BLOB, OTHER_BLOB))
+        f.close()
+        self.client.load_host_keys(filename)
+
+    def verify(self, hostname, key):
+        transport = SSHClientTransport()
+        transport.sshclient = self.client
+        transport.settings = ConnectionSettings(hostname, 22, 'user', None, None, None, False, False)
+        transport.transport = FakeTransport()
+        d = transport.verifyHostKey(key.blob(), key.fingerprint())
+        return transport.transport.lost, d
+
+    def test_anyMatchingLine(self):
+        lost, d = self.verify('host.example.com', OTHER_KEY)
+        self.assertEqual(lost, [])
+        self.assertEqual(self.successResultOf(d), 1)
+        lost, d = self.verify('host.example.com', RSA_KEY)
+        self.assertEqual(lost, [])
+        self.successResultOf(d)
+
+    def test_badKey(self):
+        lost, d = self.verify('other.example.com', OTHER_KEY)
+        lost[0].trap(BadHostKeyException)
+        self.failureResultOf(d)
+
+    def test_unknownHost(self):
+        lost, d = self.verify('host.example.org', OTHER_KEY)
+        lost[0].trap(UnknownHostKeyException)
+        self.failureResultOf(d)
+
+
+class FakeAgent (object):
+
+    def __init__(self, identities):
+        self._identities = identities
+
+    def available(self):
+        return True
+
+    def identities(self):
+        return defer.succeed(self._identities)
+
+
+class CollectKeysTests (unittest.TestCase):
+    """ Keys are offered in the order pkey, key_filename, agent, ~/.ssh/ """
+
+    def collect(self, agent_keys, **kwargs):
+        class UserAuthClient (SSHUserAuthClient):
+            agent = FakeAgent(agent_keys)
+            key_cache = PrivateKeyCache()
+            auth_hints = AuthHintCache()
+        settings = ConnectionSettings('host.example.com', 22, 'user', None, look_for_keys=False, **kwargs)
+        return UserAuthClient(SSHClient(SynchronousReactor()), SSHConnection(), settings)
+
+    def keyFile(self, data):
+        filename = self.mktemp()
+        f = open(filename, 'w')
+        f.write(data)
+        f.close()
+        return filename
+
+    def test_order(self):
+        dsa = keys.Key.fromString(keydata.privateDSA_openssh)
+        auth = self.collect([OTHER_KEY], pkey=dsa, key_filename=self.keyFile(keydata.privateRSA_openssh))
+        self.assertEqual([k.public() for k in auth.found_keys], [dsa.public(), RSA_KEY, OTHER_KEY])
+
+    def test_heldByAgent(self):
+        auth = self.collect([OTHER_KEY, RSA_KEY], key_filename=self.keyFile(keydata.privateRSA_openssh))
+        self.assertEqual([k.public() for k in auth.found_keys], [RSA_KEY, OTHER_KEY])
+        self.assertIn(RSA_KEY.blob(), auth.agent_blobs)